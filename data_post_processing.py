@@ -10,44 +10,131 @@ import tqdm
 import pathlib
 import osmnx as ox
 import networkx as nx
+import scipy.sparse
+import scipy.sparse.csgraph
+from scipy.spatial import cKDTree
 # add ../privtrace to python path
 import sys
 sys.path.append("../privtrace")
 
 # from tools.data_reader import DataReader
 
-# construct a graph using the adjacency information (adjss) with the weights (road_lengths)
-# adjss: list of adjacency lists
-# i.e., adjss[i] is a list of nodes that are adjacent to node i
-# road_lengths: list of road lengths
-
-def construct_graph(adjss, road_lengths):
-    G = nx.Graph()
-    for i in range(len(adjss)):
-        for j in range(len(adjss[i])):
-            G.add_edge(i, adjss[i][j], weight=road_lengths[i])
-    return G
+def latlons_to_unit_vectors(lats, lons):
+    # the points on the unit sphere, where the euclidean distance is monotone in the great-circle distance
+    lats = np.radians(np.asarray(lats, dtype=float))
+    lons = np.radians(np.asarray(lons, dtype=float))
+    return np.stack([np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)], axis=-1)
+
+def snap_to_nodes(node_lats, node_lons, lats, lons):
+    """
+    find the nearest node of each latlon at once by a KD-tree over the node coordinates
+    return the array of the indice of the nodes
+    """
+    tree = cKDTree(latlons_to_unit_vectors(node_lats, node_lons))
+    _, indice = tree.query(latlons_to_unit_vectors(lats, lons))
+    return indice
+
+def graph_to_csr(G, weight):
+    """
+    convert the networkx graph G to a CSR matrix with the weight attribute (the minimum one for the parallel edges as in nx.shortest_path)
+    return the CSR matrix and the list of the nodes (the index of the list is the row of the matrix)
+    """
+    nodes = list(G.nodes)
+    node_to_id = {node: i for i, node in enumerate(nodes)}
+    edges = [(node_to_id[u], node_to_id[v], data.get(weight, 1)) for u, v, data in G.edges(data=True)]
+    if not G.is_directed():
+        edges += [(v, u, length) for u, v, length in edges]
+    if len(edges) == 0:
+        return scipy.sparse.csr_matrix((len(nodes), len(nodes))), nodes
+    rows, cols, lengths = (np.array(values) for values in zip(*edges))
+    order = np.lexsort((lengths, cols, rows))
+    rows, cols, lengths = rows[order], cols[order], lengths[order].astype(float)
+    first = np.r_[True, (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])]
+    return scipy.sparse.csr_matrix((lengths[first], (rows[first], cols[first])), shape=(len(nodes), len(nodes))), nodes
+
+def batched_shortest_paths(graph, sources, targets, directed=True, unweighted=False, chunk_size=64):
+    """
+    find the shortest paths of the pairs of (source, target) on the CSR graph
+    the duplicated pairs are solved once, and the pairs are grouped by the source so that one dijkstra serves all the targets of a source
+    chunk_size: the number of sources searched at once (the memory is chunk_size * n_nodes)
+    return the dict from (source, target) to the list of the nodes of the path (None if target is not reachable)
+    """
+    pairs = sorted(set(zip(np.asarray(sources).tolist(), np.asarray(targets).tolist())))
+    source_to_targets = {}
+    for source, target in pairs:
+        source_to_targets.setdefault(source, []).append(target)
+    unique_sources = list(source_to_targets.keys())
+
+    paths = {}
+    for start in tqdm.tqdm(range(0, len(unique_sources), chunk_size)):
+        chunk = unique_sources[start:start+chunk_size]
+        _, predecessors = scipy.sparse.csgraph.dijkstra(graph, directed=directed, indices=chunk, return_predecessors=True, unweighted=unweighted)
+        for row, source in enumerate(chunk):
+            for target in source_to_targets[source]:
+                path = [target]
+                while path[-1] != source and predecessors[row, path[-1]] >= 0:
+                    path.append(predecessors[row, path[-1]])
+                paths[(source, target)] = path[::-1] if path[-1] == source else None
+    return paths
+
+def remove_consecutive_duplicates(traj):
+    return [traj[0]] + [traj[i] for i in range(1, len(traj)) if traj[i] != traj[i-1]]
 
 def post_process_chengdu(trajs):
     df = pd.read_csv("/data/chengdu/raw/edge_adj.txt", header=None).values[:,1:].astype(int)
     # remove -1
     adjss = [[v-1 for v in adjs if v != -1] for adjs in df]
 
-    df = pd.read_csv("/data/chengdu/raw/edge_property.txt", header=None)
-    road_lengths = [float(v[1]) for v in df.values]
+    # the graph of the adjacency lists has no "length" attribute, so nx.shortest_path(weight='length') counted the hops
+    # the same shortest paths are found by the unweighted search on the undirected CSR graph
+    rows = np.array([i for i, adjs in enumerate(adjss) for _ in adjs], dtype=np.int64)
+    cols = np.array([v for adjs in adjss for v in adjs], dtype=np.int64)
+    n_nodes = max(len(adjss), cols.max()+1 if len(cols) > 0 else 0)
+    graph = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_nodes, n_nodes))
 
-    G = construct_graph(adjss, road_lengths)
+    trajs = np.asarray(trajs)
+    paths = batched_shortest_paths(graph, trajs[:, 0], trajs[:, 1], directed=False, unweighted=True)
 
     post_processed = []
-    for traj in tqdm.tqdm(trajs):
-        source = traj[0]
-        target = traj[1]
-
-        shortest_path = nx.shortest_path(G, source=source, target=target, weight='length')
+    for source, target in trajs[:, :2].tolist():
+        shortest_path = paths[(source, target)]
+        if shortest_path is None:
+            raise nx.NetworkXNoPath(f"No path between {source} and {target}.")
         post_processed.append(shortest_path)
     
     return post_processed
 
+def batched_meta_post_process(gene_traj, original_grid, post_process_grid, G):
+    """
+    batched version of the complement in meta_post_process
+    the start and the end points are snapped to the nodes at once, the shortest paths are found by batched_shortest_paths, and the nodes are converted to the states by one grid lookup
+    """
+    gene_traj = [traj for traj in gene_traj if len(traj) > 1]
+    if len(gene_traj) == 0:
+        return []
+    graph, nodes = graph_to_csr(G, 'length')
+    node_lats = np.array([G.nodes[node]['y'] for node in nodes])
+    node_lons = np.array([G.nodes[node]['x'] for node in nodes])
+    node_states = post_process_grid.latlons_to_states(node_lats, node_lons)
+
+    # the nearest node of the center of each state
+    states = sorted(set(traj[i] for traj in gene_traj for i in [0, 1]))
+    center_latlons = np.array([original_grid.state_to_center_latlon(state) for state in states])
+    state_to_node = dict(zip(states, snap_to_nodes(node_lats, node_lons, center_latlons[:, 0], center_latlons[:, 1]).tolist()))
+
+    sources = [state_to_node[traj[0]] for traj in gene_traj]
+    targets = [state_to_node[traj[1]] for traj in gene_traj]
+    paths = batched_shortest_paths(graph, sources, targets)
+
+    our_trajs = []
+    for source, target in zip(sources, targets):
+        path = paths[(source, target)]
+        if path is None:
+            continue
+        traj = [state if state >= 0 else None for state in node_states[path].tolist()]
+        our_trajs.append(remove_consecutive_duplicates(traj))
+    return our_trajs
+
 
 def post_process(dataset, data_name, training_data_name, save_name):
 
@@ -105,34 +192,7 @@ def meta_post_process(params, n_bins, *, logger):
     G = ox.graph_from_bbox(lat_range[1], lat_range[0], lon_range[0], lon_range[1], network_type='drive')
 
     logger.info("complement trajectories")
-    our_trajs = []
-    for i in tqdm.tqdm(range(len(gene_traj))):
-        if len(gene_traj[i]) == 1:
-            continue
-        location_1 = original_grid.state_to_center_latlon(gene_traj[i][0])
-        location_2 = original_grid.state_to_center_latlon(gene_traj[i][1])
-
-        # compute the Euclidean distance between location_1 and location_2
-        dist = ox.distance.euclidean_dist_vec(location_1[0], location_1[1], location_2[0], location_2[1])
-
-        # find the nearest node to location_1
-        node_1 = ox.nearest_nodes(G, location_1[1], location_1[0])
-        # find the nearest node to location_2
-        node_2 = ox.nearest_nodes(G, location_2[1], location_2[0])
-        # find the shortest path
-        try:
-            path = nx.shortest_path(G, node_1, node_2, weight='length')
-        except:
-            # print("a")
-            continue
-
-        traj = []
-        for node in path:
-            traj.append(post_process_grid.latlon_to_state(G.nodes[node]['y'], G.nodes[node]['x']))
-
-        our_trajs.append([traj[0]] + [traj[i] for i in range(1, len(traj)) if traj[i] != traj[i-1]])
-    
-    return our_trajs
+    return batched_meta_post_process(gene_traj, original_grid, post_process_grid, G)
 
 def privtrace_state_to_latlon(state, f):
     lat_left, lat_right, lon_left, lon_right = f[0][state]
@@ -4,7 +4,7 @@ import pathlib
 import argparse
 import pandas as pd
 import numpy as np
-from my_utils import get_datadir, load, save, set_logger, load_latlon_range, get_original_dataset_name
+from my_utils import get_datadir, load, load_chunks, save, set_logger, load_latlon_range, get_original_dataset_name
 from name_config import make_save_name
 from grid import Grid
 import tqdm
@@ -13,10 +13,12 @@ from geopy.distance import geodesic
 import make_pair_to_route
 import concurrent.futures
 import functools
+import itertools
 from make_raw_data import make_raw_data_random, make_raw_data_rotation
 import subprocess
 import sqlite3
 from name_config import make_training_data_path
+from route_store import open_route_store, export_route_db, is_exported_from, match_routes
 
 def compute_distance_matrix(state_to_latlon, n_locations):
 
@@ -86,19 +88,94 @@ def process_trajectory(trajectory, location_threshold, time_threshold, startend)
     return stay_trajectory, time_trajectory
 
 
-def make_stay_trajectory(trajectories, time_threshold, location_threshold, startend=False):
+EARTH_RADIUS = 6371008.8
 
-    print(f"make stay-point trajectory with threshold {location_threshold}m and {time_threshold}hour")
+def haversine(lat1, lon1, lats2, lons2):
+    # the great-circle distances in meters from (lat1, lon1), which approximate geodesic within 0.5%
+    lat1, lon1, lats2, lons2 = np.radians(lat1), np.radians(lon1), np.radians(lats2), np.radians(lons2)
+    a = np.sin((lats2-lat1)/2)**2 + np.cos(lat1)*np.cos(lats2)*np.sin((lons2-lon1)/2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
 
-    partial_process_trajectory = functools.partial(process_trajectory, location_threshold=location_threshold, time_threshold=time_threshold, startend=startend)
+def find_stay_points(times, lats, lons, location_threshold, time_threshold, block_size=64):
+    """
+    the numpy version of the scan of process_trajectory for one trajectory with two or more records
+    from the anchor, the distances to the following records are computed by blocks (doubling the size) until a record farther than location_threshold is found, which becomes the next anchor
+    return the indice of the stay points and the pairs of the indice of their (start, end) times
+    """
+    n = len(times)
+    stay_indice = [0]
+    time_indice = [(0, 0)]
+    if (location_threshold == 0) and (time_threshold == 0):
+        # every record is a stay point
+        return stay_indice + list(range(n-1)) + [n-1], time_indice + [(i, i+1) for i in range(n-1)] + [(n-1, n-1)]
+
+    anchor = 0
+    while True:
+        next_anchor = None
+        start = anchor + 1
+        size = block_size
+        while start < n:
+            end = min(n, start+size)
+            over = np.flatnonzero(haversine(lats[anchor], lons[anchor], lats[start:end], lons[start:end]) > location_threshold)
+            if len(over) > 0:
+                next_anchor = start + over[0]
+                break
+            start = end
+            size *= 2
+
+        if next_anchor is None:
+            # the last record is the last stay point with the time from the anchor
+            stay_indice.append(n-1)
+            time_indice.append((anchor, n-1))
+            break
+        if times[next_anchor] - times[anchor] >= time_threshold*60:
+            stay_indice.append(anchor)
+            time_indice.append((anchor, next_anchor))
+        anchor = next_anchor
+        if anchor == n-1:
+            stay_indice.append(n-1)
+            time_indice.append((n-1, n-1))
+            break
+    return stay_indice, time_indice
+
+def process_trajectories(trajectories, location_threshold, time_threshold, startend=False):
+    """
+    the numpy version of process_trajectory for a chunk of trajectories
+    the records of the chunk are flattened into arrays with the offsets of the trajectories
+    the distance is haversine instead of geodesic
+    """
+    if startend:
+        trajectories = [[trajectory[0], trajectory[-1]] for trajectory in trajectories]
+    lengths = [len(trajectory) for trajectory in trajectories]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    records = np.array([record[:3] for trajectory in trajectories for record in trajectory], dtype=float).reshape(-1, 3)
+    times, lats, lons = records[:, 0], records[:, 1], records[:, 2]
+    times_list, lats_list, lons_list = times.tolist(), lats.tolist(), lons.tolist()
 
     stay_trajectories = []
     time_trajectories = []
+    for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        if end - start == 1:
+            stay_indice, time_indice = [0], [(0, 0)]
+        else:
+            stay_indice, time_indice = find_stay_points(times[start:end], lats[start:end], lons[start:end], location_threshold, time_threshold)
+        stay_trajectories.append([(lats_list[start+i], lons_list[start+i]) for i in stay_indice])
+        time_trajectories.append([(times_list[start+i], times_list[start+j]) for i, j in time_indice])
+    return stay_trajectories, time_trajectories
 
+def make_stay_trajectory(trajectories, time_threshold, location_threshold, startend=False, chunk_size=1000):
+
+    print(f"make stay-point trajectory with threshold {location_threshold}m and {time_threshold}hour")
+
+    partial_process_trajectories = functools.partial(process_trajectories, location_threshold=location_threshold, time_threshold=time_threshold, startend=startend)
+
+    # the workers process chunks of trajectories to amortize the pickling
+    chunks = [trajectories[i:i+chunk_size] for i in range(0, len(trajectories), chunk_size)]
     with concurrent.futures.ProcessPoolExecutor() as executor:
-        results = list(tqdm.tqdm(executor.map(partial_process_trajectory, trajectories), total=len(trajectories)))
-        
-    stay_trajectories, time_trajectories = zip(*results)
+        results = list(tqdm.tqdm(executor.map(partial_process_trajectories, chunks), total=len(chunks)))
+
+    stay_trajectories = tuple(stay_trajectory for stay_trajectories_, _ in results for stay_trajectory in stay_trajectories_)
+    time_trajectories = tuple(time_trajectory for _, time_trajectories_ in results for time_trajectory in time_trajectories_)
 
     
     if startend:
@@ -156,53 +233,56 @@ def compless(state_trajectory, time_trajectory, cost=False):
 
 
 def make_complessed_dataset(time_trajectories, trajectories, grid, indice=None):
+    """
+    convert the latlon trajectories to the state trajectories and remove the consecutive same states (as compless)
+    the states of all the records are found by one batched grid lookup on the flat arrays, and the runs of the same state are found at once respecting the boundaries of the trajectories
+    the locations out of the grid are None
+    the trajectories with one state are removed
+    """
+    if indice is None:
+        selected_indice = list(range(len(trajectories)))
+    else:
+        indice = set(indice)
+        selected_indice = [ind for ind in range(len(trajectories)) if ind in indice]
+
+    lengths = np.array([len(trajectories[ind]) for ind in selected_indice], dtype=np.int64)
+    flat_latlons = np.array([latlon for ind in selected_indice for latlon in trajectories[ind]], dtype=float).reshape(-1, 2)
+    flat_times = [time for ind in selected_indice for time in time_trajectories[ind][:len(trajectories[ind])]]
+    assert len(flat_times) == len(flat_latlons), "time trajectory is shorter than the trajectory"
+    states = grid.latlons_to_states(flat_latlons[:, 0], flat_latlons[:, 1])
+
+    # a run starts at the start of a trajectory or at a change of the state
+    trajectory_starts = np.cumsum(lengths) - lengths
+    is_run_start = np.ones(len(states), dtype=bool)
+    is_run_start[1:] = np.diff(states) != 0
+    is_run_start[trajectory_starts[lengths > 0]] = True
+    run_starts = np.flatnonzero(is_run_start)
+    run_ends = np.append(run_starts[1:], len(states)) - 1
+    n_runs = np.bincount(np.repeat(np.arange(len(lengths)), lengths)[run_starts], minlength=len(lengths))
+    run_offsets = (np.cumsum(n_runs) - n_runs).tolist()
+
+    run_states = [state if state >= 0 else None for state in states[run_starts].tolist()]
+    run_times = [(flat_times[start][0], flat_times[end][1]) for start, end in zip(run_starts.tolist(), run_ends.tolist())]
+
     dataset = []
     times = []
-    if indice is None:
-        indice = range(len(trajectories))
     added_indice = []
-
-    for ind in tqdm.tqdm(range(len(trajectories))):
-        if ind not in indice:
+    for ind, offset, n_run in zip(selected_indice, run_offsets, n_runs.tolist()):
+        if n_run <= 1:
             continue
-
-        trajectory = trajectories[ind]
-        time_trajectory = time_trajectories[ind]
-        state_trajectory = []
-        for lat, lon in trajectory:
-            state = grid.latlon_to_state(lat, lon)
-            state_trajectory.append(state)
-
-
-        # if None in state_trajectory:
-        #     print("WARNING: FOUND OUT OF RANGE LOCATION, THE TRAJECTORY IS REMOVED")
-        #     print(ind, trajectory)
-        #     print(state_trajectory)
-        #     continue
-
-        state_trajectory, complessed_time_trajectory = compless(state_trajectory, time_trajectory)
-
-        if len(state_trajectory) <= 1:
-            # print("removed because of length")
-            # print(state_trajectory)
-            continue
-
-        dataset.append(state_trajectory)
-        times.append(complessed_time_trajectory)
+        dataset.append(run_states[offset:offset+n_run])
+        times.append(run_times[offset:offset+n_run])
         added_indice.append(ind)
-
-        assert len(state_trajectory) == len(complessed_time_trajectory), f"state trajectory length {len(state_trajectory)} != time trajectory length {len(complessed_time_trajectory)}"
-        # times.append([time for time, _, _ in trajectory])
     return dataset, times, added_indice
 
 def check_in_range(trajs, grid):
-    new_trajs = []
-    for traj in tqdm.tqdm(trajs):
-        new_traj = []
-        for time, lat, lon in traj:
-            new_traj.append(grid.is_in_range(lat, lon))
-        if all(new_traj):
-            new_trajs.append(traj)
+    # the trajectories with a record out of the range of the grid are removed (the records are checked at once)
+    lengths = np.array([len(traj) for traj in trajs], dtype=np.int64)
+    records = np.array([record[:3] for traj in trajs for record in traj], dtype=float).reshape(-1, 3)
+    lats, lons = records[:, 1], records[:, 2]
+    in_range = grid.are_in_range(lats, lons)
+    n_out_of_range = np.bincount(np.repeat(np.arange(len(trajs)), lengths)[~in_range], minlength=len(trajs))
+    new_trajs = [traj for traj, n in zip(trajs, n_out_of_range.tolist()) if n == 0]
     print(f"remove {len(trajs)-len(new_trajs)} trajectories")
     return new_trajs
 
@@ -254,52 +334,104 @@ def make_db(dataset, lat_range, lon_range, n_bins, truncate, logger):
     
     # send(db_save_dir / "paths.db")
 
+def make_route_store(db_path, n_bins, logger):
+    # the binary route store of the state routes in paths.db, which is made next to paths.db
+    # the store is exported again if paths.db is rebuilt after the export
+    store_dir = pathlib.Path(db_path).parent / "routes"
+    if not is_exported_from(store_dir, db_path):
+        logger.info(f"export {db_path} to the route store {store_dir}")
+        export_route_db(db_path, store_dir, n_states=(n_bins+2)**2)
+    else:
+        logger.info(f"route store already exists in {store_dir}")
+    return store_dir
+
+def make_route_oracle(dataset, lat_range, lon_range, n_bins, truncate, logger, route_limit=0):
+    # the routes are computed on demand and cached in route_cache.bin instead of paths.db
+    # route_limit: the length (m) at which the search stops (0: derived from truncate, which gives the same routes as paths.db)
+    original_dataset = get_original_dataset_name(dataset)
+    cache_name = "route_cache.bin" if route_limit == 0 else f"route_cache_limit{route_limit:g}.bin"
+    cache_path = get_datadir() / original_dataset / "pair_to_route" / f"{n_bins}_tr{truncate}" / cache_name
+    graph_data_dir = get_datadir() / dataset / "raw"
+    oracle = make_pair_to_route.RouteOracle.from_data_dir(n_bins, graph_data_dir, lat_range, lon_range, truncate, cache_path, limit=None if route_limit == 0 else route_limit)
+    if not np.isfinite(oracle.limit):
+        logger.info("WARNING: the route search is not bounded since truncate is 0 and route_limit is not given")
+    logger.info(f"make route oracle with the search limit {oracle.limit} and the cache {cache_path}")
+    return oracle
+
 def make_reversible_stay_traj(traj, road_db):
-    # open database
-    with sqlite3.connect(road_db) as conn:
-        reversible_stay_traj = [traj[0]]
-        c = conn.cursor()
-        cursor1 = 0
-        while True:
-            for cursor2 in range(cursor1+1, len(traj)+1):
-                if cursor2 == len(traj):
-                    reversible_stay_traj.append(traj[cursor2-1])
-                    cursor1 = cursor2
-                    break
-
-                from_state = traj[cursor1]
-                to_state = traj[cursor2]
-                query = f"SELECT route FROM state_edge_to_route WHERE start_state={from_state} AND end_state={to_state}"
-                c.execute(query)
-                route = c.fetchone()
-                # if route is the same as the partial traj from cursor to cursor2, then we can reverse the traj
-                if route is not None:
-                    route = eval(route[0])
-                    # print(route, traj[cursor1:cursor2+1])
-                    if route == traj[cursor1:cursor2+1]:
-                        continue
-                
-                assert cursor2-1 != cursor1, f"the adjacent states should be connected by the road network, but {traj[cursor1]} and {traj[cursor2]} are not connected {route}"
+    # road_db: the route store, its directory, or paths.db
+    route_store = open_route_store(road_db)
+    reversible_stay_traj = [traj[0]]
+    cursor1 = 0
+    while True:
+        for cursor2 in range(cursor1+1, len(traj)+1):
+            if cursor2 == len(traj):
                 reversible_stay_traj.append(traj[cursor2-1])
-                cursor1 = cursor2-1
-                break
-            if cursor1 == len(traj):
+                cursor1 = cursor2
                 break
+
+            from_state = traj[cursor1]
+            to_state = traj[cursor2]
+            route = route_store.route(from_state, to_state)
+            # if route is the same as the partial traj from cursor to cursor2, then we can reverse the traj
+            if route is not None:
+                # print(route, traj[cursor1:cursor2+1])
+                if route == traj[cursor1:cursor2+1]:
+                    continue
+            
+            assert cursor2-1 != cursor1, f"the adjacent states should be connected by the road network, but {traj[cursor1]} and {traj[cursor2]} are not connected {route}"
+            reversible_stay_traj.append(traj[cursor2-1])
+            cursor1 = cursor2-1
+            break
+        if cursor1 == len(traj):
+            break
     return reversible_stay_traj
 
 
 def make_reversible_trajs(trajs, road_db):
-    reversible_trajs = []
-    for traj in tqdm.tqdm(trajs):
-        reversible_trajs.append(make_reversible_stay_traj(traj, road_db))
-    return reversible_trajs
-
-def run(dataset_name, lat_range, lon_range, n_bins, time_threshold, location_threshold, size, seed, truncate, logger):
+    """
+    batched version of make_reversible_stay_traj
+    the cursors of all the trajectories are advanced together, so that the routes are looked up once per round for the distinct pairs
+    """
+    route_store = open_route_store(road_db)
+    if len(trajs) == 0:
+        return []
+    lengths = np.array([len(traj) for traj in trajs], dtype=np.int64)
+    assert lengths.min() > 0, "the trajectories should not be empty"
+    states = np.fromiter(itertools.chain.from_iterable(trajs), dtype=np.int64, count=lengths.sum())
+    starts = np.cumsum(lengths) - lengths
+    ends = starts + lengths
+
+    # cursor1 and cursor2 as the positions in states
+    cursor1 = starts.copy()
+    cursor2 = starts + 1
+    breakpoints = []
+    active = np.flatnonzero(cursor2 < ends)
+    with tqdm.tqdm(total=int(lengths.sum() - len(trajs))) as pbar:
+        while len(active) > 0:
+            matched = match_routes(route_store, states, cursor1[active], cursor2[active])
+            # if route is the same as the partial traj from cursor1 to cursor2, then cursor2 is extended
+            cursor2[active[matched]] += 1
+            # otherwise, the state before cursor2 is kept and the route restarts from it
+            stopped = active[~matched]
+            assert np.all(cursor2[stopped]-1 != cursor1[stopped]), f"the adjacent states should be connected by the road network, but {[(states[cursor1[i]], states[cursor2[i]]) for i in stopped if cursor2[i]-1 == cursor1[i]]} are not connected"
+            breakpoints.append(cursor2[stopped]-1)
+            cursor1[stopped] = cursor2[stopped]-1
+            active = active[cursor2[active] < ends[active]]
+            pbar.update(int(matched.sum()))
+
+    # the kept states are the first state, the breakpoints, and the last state of each trajectory
+    positions = np.sort(np.concatenate([starts, ends-1] + breakpoints))
+    counts = np.bincount(np.repeat(np.arange(len(trajs)), lengths)[positions], minlength=len(trajs))
+    return [reversible_stay_traj.tolist() for reversible_stay_traj in np.split(states[positions], np.cumsum(counts)[:-1])]
+
+def run(dataset_name, lat_range, lon_range, n_bins, time_threshold, location_threshold, size, seed, truncate, logger, lazy_route=False, max_chunk_bytes=2**30, route_limit=0):
     """
     training_data is POI_id (aka state) trajectory
     state is made by grid of n_bins, which means there are (n_bins+2)*(n_bins+2) states in lat_range and lon_range
     and state trajectory is converted to stay-point trajectory by time_threshold and location_threshold
     then, the sequential duplication is removed
+    the raw data is streamed by chunks of max_chunk_bytes, and the result does not depend on the chunk size
     """
 
     save_name = make_save_name(dataset_name, n_bins, time_threshold, location_threshold, seed)
@@ -321,51 +453,65 @@ def run(dataset_name, lat_range, lon_range, n_bins, time_threshold, location_thr
             # training_data_dir.mkdir(exist_ok=True, parents=True)
 
             raw_data_path = training_data_dir.parent.parent / f"raw_data.csv"
-            logger.info(f"load raw data from {raw_data_path}")
-            raw_trajs = load(raw_data_path, size, seed)
 
             logger.info(f"make grid lat {lat_range} lon {lon_range} n_bins {n_bins}")
             ranges = Grid.make_ranges_from_latlon_range_and_nbins(lat_range, lon_range, n_bins)
             grid = Grid(ranges)
-            logger.info(f"check in range")
-            raw_trajs = check_in_range(raw_trajs, grid)
 
-            if dataset_name in ["chengdu", "geolife_mm"]:
+            is_road = dataset_name in ["chengdu", "geolife_mm"]
+            if is_road:
                 # for the road network dataset, we make stay trajectory with road network information
-                db_path = make_db(dataset_name, lat_range, lon_range, n_bins, truncate, logger)
-
-                # represent route trajectory by states
-                route_time_trajs, route_trajs = make_stay_trajectory(raw_trajs, 0, 0)
-                route_trajs, route_time_trajs, indice = make_complessed_dataset(route_time_trajs, route_trajs, grid)
-                # copy db_path to ./temp
-                subprocess.run(["cp", db_path, "./"])
-                # convert to reversible stay trajectory from the route trajectory
-                print("make reversible trajs using", db_path)
-                print(route_trajs[:10])
-                trajs = make_reversible_trajs(route_trajs, "./paths.db")
-                times = [[0 for _ in traj] for traj in trajs]
-
-                logger.info(f"save route complessed dataset to {training_data_dir / f'route_training_data.csv'}")
-                save(training_data_dir / f"route_training_data.csv", route_trajs)
-                logger.info(f"save route time dataset to {training_data_dir / f'route_training_data_time.csv'}")
-                save(training_data_dir / f"route_training_data_time.csv", route_time_trajs)
+                if lazy_route:
+                    # the routes are computed only for the pairs that appear in the trajectories
+                    route_source = make_route_oracle(dataset_name, lat_range, lon_range, n_bins, truncate, logger, route_limit)
+                else:
+                    db_path = make_db(dataset_name, lat_range, lon_range, n_bins, truncate, logger)
+                    # the route store is memory-mapped, so it is not copied to the local directory unlike paths.db
+                    route_source = make_route_store(db_path, n_bins, logger)
+                logger.info(f"make reversible trajs using {route_source}")
+                output_names = ["route_training_data.csv", "route_training_data_time.csv", "training_data.csv", "training_data_time.csv"]
             else:
                 logger.info(f"make stay trajectory by {time_threshold}min and {location_threshold}m")
-                time_trajs, trajs = make_stay_trajectory(raw_trajs, time_threshold, location_threshold)
-                logger.info("make complessed dataset by the grid")
-                trajs, times, indice = make_complessed_dataset(time_trajs, trajs, grid)
-                # send(training_data_dir / "indice.json")
-
-                times = [[time[0] for time in traj] for traj in times]
-            # route_dataset, route_times, _ = make_complessed_dataset(route_time_trajs, route_trajs, grid, indice)
-            # route_times = [[time[0] for time in traj] for traj in route_times]
-            # time_save_path = training_data_dir / f"route_training_data_time.csv"
-            # logger.info(f"save route time dataset to {time_save_path}")
-            # save(time_save_path, route_times)
-
-            # save_path = training_data_dir / f"route_training_data.csv"
-            # logger.info(f"save route complessed dataset to {save_path}")
-            # save(save_path, route_dataset)
+                output_names = ["training_data.csv", "training_data_time.csv"]
+
+            # the raw data is processed chunk by chunk so that the memory usage is bounded by max_chunk_bytes of the raw text
+            # the outputs are appended to temporary files which are renamed after they are completed
+            tmp_paths = {name: training_data_dir / f"{name}.tmp" for name in output_names}
+            for tmp_path in tmp_paths.values():
+                open(tmp_path, "w").close()
+            indice = []
+            n_in_range = 0
+            logger.info(f"load raw data from {raw_data_path} by chunks of {max_chunk_bytes} bytes")
+            for i, raw_trajs in enumerate(load_chunks(raw_data_path, size, seed, max_chunk_bytes)):
+                logger.info(f"check in range of chunk {i} ({len(raw_trajs)} trajectories)")
+                raw_trajs = check_in_range(raw_trajs, grid)
+
+                if is_road:
+                    # represent route trajectory by states
+                    route_time_trajs, route_trajs = make_stay_trajectory(raw_trajs, 0, 0)
+                    route_trajs, route_time_trajs, chunk_indice = make_complessed_dataset(route_time_trajs, route_trajs, grid)
+                    # convert to reversible stay trajectory from the route trajectory
+                    trajs = make_reversible_trajs(route_trajs, route_source)
+                    times = [[0 for _ in traj] for traj in trajs]
+
+                    save(tmp_paths["route_training_data.csv"], route_trajs, option="a")
+                    save(tmp_paths["route_training_data_time.csv"], route_time_trajs, option="a")
+                else:
+                    time_trajs, trajs = make_stay_trajectory(raw_trajs, time_threshold, location_threshold)
+                    trajs, times, chunk_indice = make_complessed_dataset(time_trajs, trajs, grid)
+                    times = [[time[0] for time in traj] for traj in times]
+
+                save(tmp_paths["training_data.csv"], trajs, option="a")
+                save(tmp_paths["training_data_time.csv"], times, option="a")
+                # the indice are the positions in the whole in-range trajectories
+                indice.extend([index + n_in_range for index in chunk_indice])
+                n_in_range += len(raw_trajs)
+
+            # training_data.csv is renamed at the end of run since its existence means that the training data is made
+            for name in output_names:
+                if name != "training_data.csv":
+                    logger.info(f"save {name} to {training_data_dir / name}")
+                    tmp_paths[name].replace(training_data_dir / name)
 
             gps = make_gps_data(training_data_dir, lat_range, lon_range, n_bins)
             make_distance_data(training_data_dir, n_bins, gps, logger)
@@ -374,18 +520,23 @@ def run(dataset_name, lat_range, lon_range, n_bins, time_threshold, location_thr
         with open(training_data_dir / "indice.json", "w") as f:
             json.dump(indice, f)
 
-        save_path = training_data_dir / f"training_data.csv"
-        logger.info(f"save complessed dataset to {save_path}")
-        save(save_path, trajs)
-        
-        time_save_path = training_data_dir / f"training_data_time.csv"
-        logger.info(f"save time dataset to {time_save_path}")
-        save(time_save_path, times)
+        if dataset_name in ["rotation", "random"]:
+            tmp_paths = {"training_data.csv": training_data_dir / "training_data.csv.tmp"}
+            save(tmp_paths["training_data.csv"], trajs)
+            
+            time_save_path = training_data_dir / f"training_data_time.csv"
+            logger.info(f"save time dataset to {time_save_path}")
+            save(time_save_path, times)
 
         logger.info(f"saving setting to {training_data_dir}/params.json")
         with open(training_data_dir / "params.json", "w") as f:
             json.dump({"dataset": dataset_name, "n_locations": (n_bins+2)**2, "n_bins": n_bins, "seed": args.seed}, f)
 
+        # training_data.csv is the last output so that an interrupted run is not taken as finished
+        save_path = training_data_dir / f"training_data.csv"
+        logger.info(f"save complessed dataset to {save_path}")
+        tmp_paths["training_data.csv"].replace(save_path)
+
     else:
         logger.info(f"training data already exists in {training_data_dir}")
 
@@ -401,6 +552,9 @@ if __name__ == "__main__":
     parser.add_argument('--location_threshold', type=int)
     parser.add_argument('--truncate', type=int)
     parser.add_argument('--save_name', type=str)
+    parser.add_argument('--lazy_route', action='store_true', help='compute the routes on demand instead of precomputing all the state pairs')
+    parser.add_argument('--route_limit', type=float, default=0, help='the length (m) at which the route search of --lazy_route stops (0: derived from truncate)')
+    parser.add_argument('--max_chunk_mb', type=int, default=1024, help='the size of the raw data processed at once (the peak memory is a few times of it)')
     args = parser.parse_args()
     
     lat_range, lon_range = load_latlon_range(args.dataset)
@@ -413,4 +567,4 @@ if __name__ == "__main__":
     if args.dataset in ["peopleflow", "peopleflow_test"]:
         args.time_threshold = args.time_threshold / 60
 
-    run(args.dataset, lat_range, lon_range, args.n_bins, args.time_threshold, args.location_threshold, args.max_size, args.seed, args.truncate, logger)
\ No newline at end of file
+    run(args.dataset, lat_range, lon_range, args.n_bins, args.time_threshold, args.location_threshold, args.max_size, args.seed, args.truncate, logger, lazy_route=args.lazy_route, max_chunk_bytes=args.max_chunk_mb*2**20, route_limit=args.route_limit)
\ No newline at end of file
@@ -1,6 +1,10 @@
 from torch.utils.data import Dataset
 import torch
 import numpy as np
+from opacus.utils.uniform_sampler import DistributedUniformWithReplacementSampler
+from opacus.utils.batch_memory_manager import BatchMemoryManager, BatchSplittingSampler
+import math
+import pathlib
 from my_utils import construct_default_quadtree
 from logging import getLogger, config
 logger = getLogger(__name__)
@@ -175,7 +179,7 @@ class TrajectoryDataset(Dataset):
         return {label: self.make_reference(label) for label in self.label_to_format.keys()}
     
     #Init dataset
-    def __init__(self, data, time_data, n_locations, n_time_split, real_start=True, dataset_name="dataset", route_data=None):
+    def __init__(self, data, time_data, n_locations, n_time_split, real_start=True, dataset_name="dataset", route_data=None, data_paths=None):
         assert len(data) == len(time_data)
         
         self.data = data
@@ -205,6 +209,8 @@ class TrajectoryDataset(Dataset):
 
         self.time_ranges = [(self._label_to_time(i), self._label_to_time(i+1)) for i in range(n_time_split)]
         self.computed_auxiliary_information = False
+        # the files that the data are loaded from (this identifies the data in the cache of the auxiliary information)
+        self.data_paths = [] if data_paths is None else [pathlib.Path(path) for path in data_paths]
 
         self.n_bins_for_distance = 30
 
@@ -256,6 +262,11 @@ class TrajectoryDataset(Dataset):
         time_end_idx = TrajectoryDataset.time_end_idx(self.n_time_split)
 
         def padded_collate(batch):
+            if len(batch) == 0:
+                # an empty batch of Poisson sampling
+                empty = torch.zeros((0, 1)).long()
+                return {"input":empty, "target":empty, "time":empty, "time_target":empty, "reference":[]}
+
             max_len = max([len(x["trajectory"]) for x in batch])
             inputs = []
             targets = []
@@ -301,4 +312,75 @@ class TrajectoryDataset(Dataset):
             return {"input":torch.Tensor(inputs).long(), "target":torch.Tensor(targets).long(), "time":torch.Tensor(times).long(), "time_target":torch.Tensor(target_times).long(), "reference":references}
 
         return padded_collate
-        
\ No newline at end of file
+
+
+class SynchronizedDistributedUniformWithReplacementSampler(DistributedUniformWithReplacementSampler):
+    '''
+    DistributedUniformWithReplacementSampler that also yields empty batches
+    so that all ranks take the same number of optimizer steps (otherwise, all_reduce of the gradients is deadlocked)
+    '''
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.shuffle_seed + self.epoch)
+            indices = torch.randperm(self.total_size, generator=g)
+        else:
+            indices = torch.arange(self.total_size)
+
+        # the subset of the dataset assigned to this rank
+        indices = indices[self.rank : self.total_size : self.num_replicas]
+
+        # Poisson sampling of each record in the subset
+        for _ in range(self.num_batches):
+            mask = torch.rand(self.num_samples, generator=self.generator) < self.sample_rate
+            yield indices[mask.nonzero(as_tuple=False).reshape(-1)].tolist()
+
+
+class LengthBucketedBatchSplittingSampler(BatchSplittingSampler):
+    '''
+    BatchSplittingSampler that sorts each (Poisson-sampled) logical batch by the lengths of the trajectories before splitting it into physical batches
+    so that each physical batch is padded only to the length of similar trajectories
+    the logical batch itself is not changed and the optimizer steps once per logical batch, so the DP accounting is the same
+    '''
+    def __init__(self, *, sampler, max_batch_size, optimizer, lengths):
+        super().__init__(sampler=sampler, max_batch_size=max_batch_size, optimizer=optimizer)
+        self.lengths = lengths
+
+    def __iter__(self):
+        for batch_idxs in self.sampler:
+            if len(batch_idxs) == 0:
+                self.optimizer.signal_skip_step(do_skip=False)
+                yield []
+                continue
+
+            # the same number of physical batches as BatchSplittingSampler
+            batch_idxs = sorted(list(batch_idxs), key=lambda index: self.lengths[index])
+            split_idxs = np.array_split(batch_idxs, math.ceil(len(batch_idxs) / self.max_batch_size))
+            split_idxs = [idxs.tolist() for idxs in split_idxs]
+            for idxs in split_idxs[:-1]:
+                self.optimizer.signal_skip_step(do_skip=True)
+                yield idxs
+            self.optimizer.signal_skip_step(do_skip=False)
+            yield split_idxs[-1]
+
+
+class LengthBucketedBatchMemoryManager(BatchMemoryManager):
+    '''
+    BatchMemoryManager whose physical batches are length-homogeneous (see LengthBucketedBatchSplittingSampler)
+    '''
+    def __enter__(self):
+        data_loader = self.data_loader
+        lengths = [len(trajectory) for trajectory in data_loader.dataset.data]
+        return torch.utils.data.DataLoader(
+            dataset=data_loader.dataset,
+            batch_sampler=LengthBucketedBatchSplittingSampler(sampler=data_loader.batch_sampler, max_batch_size=self.max_physical_batch_size, optimizer=self.optimizer, lengths=lengths),
+            num_workers=data_loader.num_workers,
+            collate_fn=data_loader.collate_fn,
+            pin_memory=data_loader.pin_memory,
+            timeout=data_loader.timeout,
+            worker_init_fn=data_loader.worker_init_fn,
+            multiprocessing_context=data_loader.multiprocessing_context,
+            generator=data_loader.generator,
+            prefetch_factor=data_loader.prefetch_factor,
+            persistent_workers=data_loader.persistent_workers,
+        )
@@ -5,12 +5,17 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import argparse
 import pickle
+import os
 
 from name_config import make_model_dir, make_training_data_path, make_save_name, result_name
-from my_utils import construct_default_quadtree, noise_normalize, save, plot_density, get_datadir, set_logger, get_original_dataset_name
+from my_utils import construct_default_quadtree, noise_normalize, save, plot_density, get_datadir, set_logger, get_original_dataset_name, DensityPlotWriter
+from route_store import open_route_store
 from collections import Counter
 import numpy as np
 import scipy
+import scipy.optimize
+import scipy.sparse
+import scipy.sparse.csgraph
 import random
 import pathlib
 import sqlite3
@@ -18,6 +23,10 @@ import tqdm
 import json
 import pyemd
 import subprocess
+import multiprocessing
+import queue
+import concurrent.futures
+import hashlib
 
 import sys
 sys.path.append("./competitors/privtrace")
@@ -62,20 +71,54 @@ def make_downsampling_dict(from_bin, to_bin):
     
     return downsample_dict
 
-def downsample_trajs(trajs, downsampling_dict):
-    new_trajs = []
-    indice = []
-    for id, traj in enumerate(trajs):
+def make_downsampling_array(from_bin, to_bin):
+    '''
+    the arithmetic version of make_downsampling_dict: the row and the column at to_bin are the integer division of those at from_bin
+    this agrees with make_downsampling_dict on the states that it maps, and also maps the states on the borders of the coarse states (when (from_bin+2) is not a multiple of (to_bin+2))
+    '''
+    assert from_bin > to_bin, "from_bin must be larger than to_bin"
+    n_from = from_bin + 2
+    n_to = to_bin + 2
+    indice = np.arange(n_from) * n_to // n_from
+    return (indice.reshape(-1, 1) * n_to + indice.reshape(1, -1)).reshape(-1)
 
-        new_traj = [downsampling_dict[traj[0]]]
-        for i in range(len(traj)-1):
-            downsampled_state = downsampling_dict[traj[i+1]]
-            if downsampled_state != new_traj[-1]:
-                new_traj.append(downsampled_state)
-        # if len(new_traj) > 1:
-        new_trajs.append(new_traj)
-        indice.append(id)
-    return new_trajs, indice
+def downsample_trajs(trajs, downsampling, time_trajs=None):
+    '''
+    downsampling: the array of make_downsampling_array (or the dict of make_downsampling_dict)
+    the consecutive same states after downsampling are merged into one, and the time of the first one is kept if time_trajs is given
+    '''
+    if type(downsampling) is dict:
+        downsampling_array = np.full(max(downsampling.keys())+1, -1, dtype=np.int64)
+        downsampling_array[list(downsampling.keys())] = list(downsampling.values())
+        downsampling = downsampling_array
+
+    # flatten the trajectories to remap them at once
+    lengths = np.fromiter((len(traj) for traj in trajs), dtype=np.int64, count=len(trajs))
+    assert (lengths > 0).all(), "empty trajectory cannot be downsampled"
+    flat_states = np.fromiter((state for traj in trajs for state in traj), dtype=np.int64, count=lengths.sum())
+    downsampled_states = downsampling[flat_states]
+    assert (downsampled_states >= 0).all(), "some states are not mapped by downsampling"
+
+    # keep the first state of each trajectory and the states that differ from the previous one
+    starts = np.cumsum(lengths) - lengths
+    keep = np.ones(len(flat_states), dtype=bool)
+    keep[1:] = downsampled_states[1:] != downsampled_states[:-1]
+    keep[starts] = True
+    new_lengths = np.bincount(np.repeat(np.arange(len(trajs)), lengths)[keep], minlength=len(trajs))
+    new_starts = (np.cumsum(new_lengths) - new_lengths).tolist()
+    new_lengths = new_lengths.tolist()
+
+    new_states = downsampled_states[keep].tolist()
+    new_trajs = [new_states[start:start+length] for start, length in zip(new_starts, new_lengths)]
+    indice = list(range(len(trajs)))
+    if time_trajs is None:
+        return new_trajs, indice
+
+    flat_times = [time for time_traj in time_trajs for time in time_traj]
+    assert len(flat_times) == len(flat_states), "time_trajs must have the same lengths as trajs"
+    new_times = [flat_times[i] for i in np.where(keep)[0]]
+    new_time_trajs = [new_times[start:start+length] for start, length in zip(new_starts, new_lengths)]
+    return new_trajs, indice, new_time_trajs
 
 def make_counting_functions(n_base_locations, **kwargs):
 
@@ -148,6 +191,123 @@ def make_counting_functions(n_base_locations, **kwargs):
     return evaluating_metrics, evaluation_functions, counters
 
 
+def count_generated(targets, generated_stay_trajs, generated_route_trajs):
+    '''
+    targets: list of (downsampling, dataset, counters)
+    the generated trajectories are downsampled by downsampling (if it is not None) and counted by the counting functions of the dataset
+    '''
+    for downsampling, dataset, counters in targets:
+        stay_trajs, route_trajs = generated_stay_trajs, generated_route_trajs
+        if downsampling is not None:
+            stay_trajs, _ = downsample_trajs(generated_stay_trajs, downsampling)
+            route_trajs = stay_trajs if generated_route_trajs is generated_stay_trajs else downsample_trajs(generated_route_trajs, downsampling)[0]
+        for counting_function, counter in zip(dataset.counting_functions, counters):
+            counting_function(stay_trajs, route_trajs, dataset, counter)
+
+
+def count_batches(worker_id, targets, batch_queue, result_queue):
+    '''
+    counting worker of the pipelined evaluation
+    counts the generated batches from batch_queue until None is received, and then sends the partial counters of each target
+    '''
+    while True:
+        batch = batch_queue.get()
+        if batch is None:
+            break
+        generated_stay_trajs, generated_route_trajs = batch
+        count_generated(targets, generated_stay_trajs, generated_route_trajs)
+    result_queue.put((worker_id, [counters for _, _, counters in targets]))
+
+
+def check_workers(workers):
+    for worker in workers:
+        if worker.exitcode not in [None, 0]:
+            raise RuntimeError(f"counting worker exited with {worker.exitcode}")
+
+
+def put_to_workers(batch_queue, batch, workers):
+    # block until the queue has a space while checking that the workers are alive
+    while True:
+        try:
+            batch_queue.put(batch, timeout=1)
+            return
+        except queue.Full:
+            check_workers(workers)
+
+
+def gather_from_workers(result_queue, workers):
+    partial_counters = {}
+    while len(partial_counters) < len(workers):
+        try:
+            worker_id, counters = result_queue.get(timeout=1)
+            partial_counters[worker_id] = counters
+        except queue.Empty:
+            check_workers(workers)
+    # merge in the order of the workers
+    return [partial_counters[worker_id] for worker_id in range(len(workers))]
+
+
+def merge_counters(counters, partial_counters_list, weights=None):
+    # weights: the multiplicity of each partial counters (used for bootstrap)
+    if weights is None:
+        weights = [1] * len(partial_counters_list)
+    for partial_counters, weight in zip(partial_counters_list, weights):
+        if weight == 0:
+            continue
+        for counter, partial_counter in zip(counters, partial_counters):
+            if type(counter) is not list:
+                counter, partial_counter = [counter], [partial_counter]
+            for counter_, partial_counter_ in zip(counter, partial_counter):
+                if weight == 1:
+                    counter_ += partial_counter_
+                else:
+                    counter_ += Counter({key: value * weight for key, value in partial_counter_.items()})
+
+
+def compute_convergence_metrics(counters, evaluating_metrics_names, dataset, **kwargs):
+    '''
+    the js of each metric (averaged over the test locations), whose confidence intervals decide the stop of the adaptive evaluation
+    the emd is not included since it is too costly to be computed for every bootstrap sample
+    '''
+    metrics = {}
+    for key, counter, real_counter in zip(evaluating_metrics_names, counters, dataset.real_counters):
+        n_vocabs = dataset.n_bins_for_distance if key == "distance" else dataset.n_locations
+        if key in ["target", "destination", "route", "emp_next"]:
+            metrics[f"{key}_jss"] = np.mean([compute_divergence(real_counter_, sum(real_counter_.values()), counter_, sum(counter_.values()), n_vocabs, axis=1) for counter_, real_counter_ in zip(counter, real_counter)])
+        else:
+            metrics[f"{key}_js"] = compute_divergence(real_counter, sum(real_counter.values()), counter, sum(counter.values()), n_vocabs, axis=1)
+    return metrics
+
+
+def compute_bootstrap_intervals(block_counters, evaluating_metrics_names, dataset, rng, **kwargs):
+    '''
+    95% bootstrap confidence intervals of the convergence metrics
+    the blocks of the generated data are resampled with replacement and their partial counters are merged
+    rng: the random state of the bootstrap, which is made once per evaluation so that the rounds draw different weights (and the sampling of the generator is not affected)
+    the intervals are extended to include the estimate on all the blocks
+    '''
+    n_blocks = len(block_counters)
+    _, _, counters = make_counting_functions(len(dataset.top_base_locations), **kwargs)
+    merge_counters(counters, block_counters)
+    estimates = compute_convergence_metrics(counters, evaluating_metrics_names, dataset, **kwargs)
+    samples = []
+    for _ in range(kwargs["n_bootstrap"]):
+        weights = rng.multinomial(n_blocks, [1/n_blocks] * n_blocks)
+        _, _, counters = make_counting_functions(len(dataset.top_base_locations), **kwargs)
+        merge_counters(counters, block_counters, weights)
+        samples.append(compute_convergence_metrics(counters, evaluating_metrics_names, dataset, **kwargs))
+    intervals = {}
+    for name, estimate in estimates.items():
+        lower, upper = np.percentile([sample[name] for sample in samples], [2.5, 97.5]).tolist()
+        intervals[name] = [min(lower, estimate), max(upper, estimate)]
+    return intervals
+
+
+def find_not_converged(intervals, tolerance):
+    # the names of the metrics whose confidence intervals are not narrower than tolerance (empty if converged)
+    return [name for name, (lower, upper) in intervals.items() if upper - lower >= tolerance]
+
+
 def post_process_generated(generated, **kwargs):
 
     if len(generated) == 2:
@@ -180,7 +340,70 @@ def post_process_generated(generated, **kwargs):
         
     return generated_stay_trajs, generated_route_trajs
 
-def evaluate(generator, dataset, save_dir, logger, **kwargs):
+def compute_results(counters, evaluating_metrics_names, dataset, n_gene_traj, img_dir, plot_writer, logger, prefix="", **kwargs):
+    # prefix: the prefix of the names of the results and the plots (e.g., for the results at a coarser resolution)
+    results = {}
+    first_location_counts = counters[evaluating_metrics_names.index("first_location")]
+    real_first_location_counts = dataset.real_counters[dataset.evaluating_metrics_names.index("first_location")]
+
+    for key, key2, counter, real_counter in zip(evaluating_metrics_names, dataset.evaluating_metrics_names, counters, dataset.real_counters):
+        if key == "distance":
+            n_vocabs = dataset.n_bins_for_distance
+        else:
+            n_vocabs = dataset.n_locations
+
+        # evaluation of conditional metrics
+        if key in ["target", "destination", "route", "emp_next"]:
+            results[f"{prefix}{key}_kls_eachdim"] = [compute_divergence(real_counter_, real_first_location_counts[location], counter_, first_location_counts[location], n_vocabs, save_path=img_dir / f"{prefix}{key}_{i}.png", location=location, plot_writer=plot_writer) for i, (counter_, real_counter_, location) in enumerate(zip(counter, real_counter, dataset.top_base_locations))]
+            results[f"{prefix}{key}_jss_eachdim"] = [compute_divergence(real_counter_, real_first_location_counts[location], counter_, first_location_counts[location], n_vocabs, type="kl") for counter_, real_counter_, location in zip(counter, real_counter, dataset.top_base_locations)]
+            results[f"{prefix}{key}_kls_positivedim"] = [compute_divergence(real_counter_, real_first_location_counts[location], counter_, first_location_counts[location], n_vocabs, positive=True) for counter_, real_counter_, location in zip(counter, real_counter, dataset.top_base_locations)]
+            results[f"{prefix}{key}_jss_positivedim"] = [compute_divergence(real_counter_, real_first_location_counts[location], counter_, first_location_counts[location], n_vocabs, positive=True, type="kl") for counter_, real_counter_, location in zip(counter, real_counter, dataset.top_base_locations)]
+            results[f"{prefix}{key}_jss"] = [compute_divergence(real_counter_, sum(real_counter_.values()), counter_, sum(counter_.values()), n_vocabs, axis=1) for counter_, real_counter_ in zip(counter, real_counter)]
+            results[f"{prefix}{key}_emd"] = [compute_divergence(real_counter_, sum(real_counter_.values()), counter_, sum(counter_.values()), n_vocabs, type="emd", distance_matrix=dataset.distance_matrix, emd_backend=kwargs["emd_backend"]) for counter_, real_counter_ in zip(counter, real_counter)]
+
+            logger.info(f"computed divergence for {key}: {np.mean(results[f'{prefix}{key}_jss'])}")
+        # if key in ["target", "destination", "route", "emp_next"]:
+        #     results[f"{key}_kls_eachdim"] = [compute_divergence(real_counter, n_traj, counter_, counters["first_location"][location], n_vocabs, save_path=img_dir / f"{key}_{i}.png", location=location) for i, (counter_, real_counter, n_traj, location) in enumerate(zip(counter, real_counters[key], n_trajs[key], dataset.top_base_locations))]
+        #     results[f"{key}_jss_eachdim"] = [compute_divergence(real_counter, n_traj, counter_, counters["first_location"][location], n_vocabs, type="kl") for counter_, real_counter, n_traj, location in zip(counter, real_counters[key], n_trajs[key], dataset.top_base_locations)]
+        #     results[f"{key}_kls_positivedim"] = [compute_divergence(real_counter, n_traj, counter_, counters["first_location"][location], n_vocabs, positive=True) for counter_, real_counter, n_traj, location in zip(counter, real_counters[key], n_trajs[key], dataset.top_base_locations)]
+        #     results[f"{key}_jss_positivedim"] = [compute_divergence(real_counter, n_traj, counter_, counters["first_location"][location], n_vocabs, positive=True, type="kl") for counter_, real_counter, n_traj, location in zip(counter, real_counters[key], n_trajs[key], dataset.top_base_locations)]
+        #     results[f"{key}_jss"] = [compute_divergence(real_counter, sum(real_counter.values()), counter_, sum(counter_.values()), n_vocabs, axis=1) for counter_, real_counter in zip(counter, real_counters[key])]
+        #     results[f"{key}_emd"] = [compute_divergence(real_counter, sum(real_counter.values()), counter_, sum(counter_.values()), n_vocabs, type="emd", distance_matrix=dataset.distance_matrix) for counter_, real_counter, n_traj in zip(counter, real_counters[key], n_trajs[key])]
+        # elif key == "second_emp_next":
+        #     results[f"{key}_jss"] = [compute_divergence(real_counter, sum(real_counter.values()), counter_, sum(counter_.values()), n_vocabs, axis=1) for counter_, real_counter in zip(counter, real_counters[key])]
+        # elif key == "global":
+        #     results[f"{key}_kls_eachdim"] = [compute_divergence(real_counter, n_traj, counter_, n_gene_traj, n_vocabs) for counter_, real_counter, n_traj in zip(counter, real_counters[key], n_trajs[key])]
+        #     results[f"{key}_kls_positivedim"] = [compute_divergence(real_counter, n_traj, counter_, n_gene_traj, n_vocabs, positive=True) for counter_, real_counter, n_traj in zip(counter, real_counters[key], n_trajs[key])]
+        #     results[f"{key}_jss_eachdim"] = [compute_divergence(real_counter, n_traj, counter_, n_gene_traj, n_vocabs, type="kl") for counter_, real_counter, n_traj in zip(counter, real_counters[key], n_trajs[key])]
+        #     results[f"{key}_jss_positivedim"] = [compute_divergence(real_counter, n_traj, counter_, n_gene_traj, n_vocabs, positive=True, type="kl") for counter_, real_counter, n_traj in zip(counter, real_counters[key], n_trajs[key])]
+        #     results[f"{key}_jss"] = [compute_divergence(real_counter, sum(real_counter.values()), counter_, sum(counter_.values()), n_vocabs, axis=1) for counter_, real_counter in zip(counter, real_counters[key])]
+        # evaluation of global metrics
+        else:
+            results[f"{prefix}{key}_kl_eachdim"] = compute_divergence(real_counter, len(dataset.data), counter, n_gene_traj, n_vocabs)
+            results[f"{prefix}{key}_kl_positivedim"] = compute_divergence(real_counter, len(dataset.data), counter, n_gene_traj, n_vocabs, positive=True)
+            results[f"{prefix}{key}_js_eachdim"] = compute_divergence(real_counter, len(dataset.data), counter, n_gene_traj, n_vocabs, type="kl")
+            results[f"{prefix}{key}_js_positivedim"] = compute_divergence(real_counter, len(dataset.data), counter, n_gene_traj, n_vocabs, positive=True, type="kl")
+            results[f"{prefix}{key}_js"] = compute_divergence(real_counter, sum(real_counter.values()), counter, sum(counter.values()), n_vocabs, axis=1)
+
+            logger.info(f"computed divergence for {key}: {results[f'{prefix}{key}_js']}")
+        # # compute js divergence
+        # if key in ["target", "destination", "route"]:
+        #     results[f"{key}_jss"] = []
+        #     for i, (counter_, real_counter) in enumerate(zip(counter, real_counters[key])):
+        #         results[f"{key}_jss"].append(compute_divergence(real_counter, sum(real_counter.values()), counter_, sum(counter_.values()), n_vocabs, axis=1))
+        #         # plot_density(counter_, dataset.n_locations, img_dir / f"{key}_{i}.png", dataset.top_base_locations[i], coef=1/counters["first_location"][dataset.top_base_locations[i]])
+        # elif key == "global":
+        #     for i, (counter_, real_counter) in enumerate(zip(counter, real_counters[key])):
+        #         results[f"{key}_jss_{i}"] = compute_divergence(real_counter, sum(real_counter.values()), counter_, sum(counter_.values()), n_vocabs, axis=1)
+        #         # plot_density(counter_, dataset.n_locations, img_dir / f"{key}_{i}.png")
+        # else:
+        #     results[f"{key}_js"] = compute_divergence(real_counters[key], sum(real_counters[key].values()), counter, sum(counter.values()), n_vocabs, axis=1)
+        #     # plot_density(counter, n_vocabs, img_dir / f"{key}.png")
+
+    return results
+
+
+def evaluate(generator, dataset, save_dir, logger, plot_writer=None, **kwargs):
 
     # n_bins = int(np.sqrt(dataset.n_locations)-2)
     # print("???")
@@ -229,6 +452,28 @@ def evaluate(generator, dataset, save_dir, logger, **kwargs):
         n_gene_traj = 0
         n_invalid = 0
         evaluating_metrics_names, _, counters = make_counting_functions(len(dataset.top_base_locations), **kwargs)
+        # the generated trajectories are also counted at the coarser resolutions of evaluation_bins
+        targets = [(None, dataset, counters)] + [(downsampled_dataset.downsampling, downsampled_dataset, make_counting_functions(len(downsampled_dataset.top_base_locations), **kwargs)[2]) for downsampled_dataset in dataset.downsampled_datasets]
+        # pipelined evaluation: this process only samples, and the counting workers accumulate the partial counters
+        # the random states are used only by this process, so the counts are the same as the sequential evaluation
+        n_counting_workers = kwargs["n_counting_workers"] if dataset.counting_functions else 0
+        # adaptive evaluation: the generated batches are counted into blocks, and the generation stops when the bootstrap confidence intervals of all the metrics are narrower than the tolerance
+        adaptive = kwargs["adaptive_evaluation"] and bool(dataset.counting_functions)
+        if adaptive:
+            if n_counting_workers > 0:
+                logger.info("the adaptive evaluation counts the batches in this process")
+            n_counting_workers = 0
+            block_counters = [make_counting_functions(len(dataset.top_base_locations), **kwargs)[2] for _ in range(kwargs["n_bootstrap_blocks"])]
+            n_batches = 0
+            intervals = None
+            bootstrap_rng = np.random.default_rng(0)
+        if n_counting_workers > 0:
+            context = multiprocessing.get_context("fork")
+            batch_queue = context.Queue(maxsize=2*n_counting_workers)
+            result_queue = context.Queue()
+            counting_workers = [context.Process(target=count_batches, args=(worker_id, targets, batch_queue, result_queue), daemon=True) for worker_id in range(n_counting_workers)]
+            for counting_worker in counting_workers:
+                counting_worker.start()
         while (n_gene_traj < len(dataset.references)) and dataset.counting_functions:
             mini_batch_size =  min([1000, len(dataset.references)])
             # sample mini_batch_size references from dataset.references
@@ -244,8 +489,12 @@ def evaluate(generator, dataset, save_dir, logger, **kwargs):
             generated_stay_trajs, generated_route_trajs = post_process_generated(generated, **kwargs)
 
             # counting to make each distribution
-            for counting_function, counter in zip(dataset.counting_functions, counters):
-                counting_function(generated_stay_trajs, generated_route_trajs, dataset, counter)
+            if n_counting_workers > 0:
+                put_to_workers(batch_queue, (generated_stay_trajs, generated_route_trajs), counting_workers)
+            elif adaptive:
+                count_generated([(None, dataset, block_counters[n_batches % len(block_counters)])] + targets[1:], generated_stay_trajs, generated_route_trajs)
+            else:
+                count_generated(targets, generated_stay_trajs, generated_route_trajs)
                 # if result is list:
                 #     for result_, counter_ in zip(result, counter):
                 #         counter_ += result_
@@ -289,8 +538,35 @@ def evaluate(generator, dataset, save_dir, logger, **kwargs):
             # evaluate the same number of generated data as the ten times of that of original data
             n_gene_traj += len(generated_route_trajs)
 
+            # check the convergence every time all the blocks get a new batch
+            if adaptive:
+                n_batches += 1
+                intervals = None
+                if n_batches % len(block_counters) == 0:
+                    intervals = compute_bootstrap_intervals(block_counters, evaluating_metrics_names, dataset, bootstrap_rng, **kwargs)
+                    not_converged = find_not_converged(intervals, kwargs["evaluation_tolerance"])
+                    logger.info(f"adaptive evaluation: {n_gene_traj} generated, not converged: {not_converged}")
+                    if len(not_converged) == 0:
+                        break
+
             # save
 
+        if n_counting_workers > 0:
+            for _ in counting_workers:
+                put_to_workers(batch_queue, None, counting_workers)
+            partial_counters_list = gather_from_workers(result_queue, counting_workers)
+            for i, (_, _, counters_) in enumerate(targets):
+                merge_counters(counters_, [partial_counters[i] for partial_counters in partial_counters_list])
+            for counting_worker in counting_workers:
+                counting_worker.join()
+
+        if adaptive:
+            if intervals is None:
+                intervals = compute_bootstrap_intervals(block_counters[:n_batches], evaluating_metrics_names, dataset, bootstrap_rng, **kwargs)
+            merge_counters(counters, block_counters)
+            results["n_generated"] = n_gene_traj
+            results["confidence_intervals"] = intervals
+
         # save(pathlib.Path(kwargs["save_path"]) / f"evaluated_{epoch}.csv", gene_trajs)
         # print(f"saved evaluated file ({len(gene_trajs)}) to", pathlib.Path(kwargs["save_path"]) / f"evaluated_{epoch}.csv")]
         logger.info(f"generating {n_gene_traj} trajectories, there existed {n_invalid} invalid trajectories")
@@ -300,63 +576,15 @@ def evaluate(generator, dataset, save_dir, logger, **kwargs):
         # img_dir = save_dir / f"imgs_trun{kwargs['truncation']}_{kwargs['to_bin']}" / kwargs["name"]
         img_dir = save_dir / "imgs"
         img_dir.mkdir(exist_ok=True)
+        # the distributions are dumped to npz instead of rendering them here
+        if plot_writer is None:
+            plot_writer = DensityPlotWriter(img_dir / "densities.npz", render=kwargs["render_plots"])
 
-        first_location_counts = counters[evaluating_metrics_names.index("first_location")]
-        real_first_location_counts = dataset.real_counters[dataset.evaluating_metrics_names.index("first_location")]
-    
-        for key, key2, counter, real_counter in zip(evaluating_metrics_names, dataset.evaluating_metrics_names, counters, dataset.real_counters):
-            if key == "distance":
-                n_vocabs = dataset.n_bins_for_distance
-            else:
-                n_vocabs = dataset.n_locations
-
-            # evaluation of conditional metrics
-            if key in ["target", "destination", "route", "emp_next"]:
-                results[f"{key}_kls_eachdim"] = [compute_divergence(real_counter_, real_first_location_counts[location], counter_, first_location_counts[location], n_vocabs, save_path=img_dir / f"{key}_{i}.png", location=location) for i, (counter_, real_counter_, location) in enumerate(zip(counter, real_counter, dataset.top_base_locations))]
-                results[f"{key}_jss_eachdim"] = [compute_divergence(real_counter_, real_first_location_counts[location], counter_, first_location_counts[location], n_vocabs, type="kl") for counter_, real_counter_, location in zip(counter, real_counter, dataset.top_base_locations)]
-                results[f"{key}_kls_positivedim"] = [compute_divergence(real_counter_, real_first_location_counts[location], counter_, first_location_counts[location], n_vocabs, positive=True) for counter_, real_counter_, location in zip(counter, real_counter, dataset.top_base_locations)]
-                results[f"{key}_jss_positivedim"] = [compute_divergence(real_counter_, real_first_location_counts[location], counter_, first_location_counts[location], n_vocabs, positive=True, type="kl") for counter_, real_counter_, location in zip(counter, real_counter, dataset.top_base_locations)]
-                results[f"{key}_jss"] = [compute_divergence(real_counter_, sum(real_counter_.values()), counter_, sum(counter_.values()), n_vocabs, axis=1) for counter_, real_counter_ in zip(counter, real_counter)]
-                results[f"{key}_emd"] = [compute_divergence(real_counter_, sum(real_counter_.values()), counter_, sum(counter_.values()), n_vocabs, type="emd", distance_matrix=dataset.distance_matrix) for counter_, real_counter_ in zip(counter, real_counter)]
-
-                logger.info(f"computed divergence for {key}: {np.mean(results[f'{key}_jss'])}")
-            # if key in ["target", "destination", "route", "emp_next"]:
-            #     results[f"{key}_kls_eachdim"] = [compute_divergence(real_counter, n_traj, counter_, counters["first_location"][location], n_vocabs, save_path=img_dir / f"{key}_{i}.png", location=location) for i, (counter_, real_counter, n_traj, location) in enumerate(zip(counter, real_counters[key], n_trajs[key], dataset.top_base_locations))]
-            #     results[f"{key}_jss_eachdim"] = [compute_divergence(real_counter, n_traj, counter_, counters["first_location"][location], n_vocabs, type="kl") for counter_, real_counter, n_traj, location in zip(counter, real_counters[key], n_trajs[key], dataset.top_base_locations)]
-            #     results[f"{key}_kls_positivedim"] = [compute_divergence(real_counter, n_traj, counter_, counters["first_location"][location], n_vocabs, positive=True) for counter_, real_counter, n_traj, location in zip(counter, real_counters[key], n_trajs[key], dataset.top_base_locations)]
-            #     results[f"{key}_jss_positivedim"] = [compute_divergence(real_counter, n_traj, counter_, counters["first_location"][location], n_vocabs, positive=True, type="kl") for counter_, real_counter, n_traj, location in zip(counter, real_counters[key], n_trajs[key], dataset.top_base_locations)]
-            #     results[f"{key}_jss"] = [compute_divergence(real_counter, sum(real_counter.values()), counter_, sum(counter_.values()), n_vocabs, axis=1) for counter_, real_counter in zip(counter, real_counters[key])]
-            #     results[f"{key}_emd"] = [compute_divergence(real_counter, sum(real_counter.values()), counter_, sum(counter_.values()), n_vocabs, type="emd", distance_matrix=dataset.distance_matrix) for counter_, real_counter, n_traj in zip(counter, real_counters[key], n_trajs[key])]
-            # elif key == "second_emp_next":
-            #     results[f"{key}_jss"] = [compute_divergence(real_counter, sum(real_counter.values()), counter_, sum(counter_.values()), n_vocabs, axis=1) for counter_, real_counter in zip(counter, real_counters[key])]
-            # elif key == "global":
-            #     results[f"{key}_kls_eachdim"] = [compute_divergence(real_counter, n_traj, counter_, n_gene_traj, n_vocabs) for counter_, real_counter, n_traj in zip(counter, real_counters[key], n_trajs[key])]
-            #     results[f"{key}_kls_positivedim"] = [compute_divergence(real_counter, n_traj, counter_, n_gene_traj, n_vocabs, positive=True) for counter_, real_counter, n_traj in zip(counter, real_counters[key], n_trajs[key])]
-            #     results[f"{key}_jss_eachdim"] = [compute_divergence(real_counter, n_traj, counter_, n_gene_traj, n_vocabs, type="kl") for counter_, real_counter, n_traj in zip(counter, real_counters[key], n_trajs[key])]
-            #     results[f"{key}_jss_positivedim"] = [compute_divergence(real_counter, n_traj, counter_, n_gene_traj, n_vocabs, positive=True, type="kl") for counter_, real_counter, n_traj in zip(counter, real_counters[key], n_trajs[key])]
-            #     results[f"{key}_jss"] = [compute_divergence(real_counter, sum(real_counter.values()), counter_, sum(counter_.values()), n_vocabs, axis=1) for counter_, real_counter in zip(counter, real_counters[key])]
-            # evaluation of global metrics
-            else:
-                results[f"{key}_kl_eachdim"] = compute_divergence(real_counter, len(dataset.data), counter, n_gene_traj, n_vocabs)
-                results[f"{key}_kl_positivedim"] = compute_divergence(real_counter, len(dataset.data), counter, n_gene_traj, n_vocabs, positive=True)
-                results[f"{key}_js_eachdim"] = compute_divergence(real_counter, len(dataset.data), counter, n_gene_traj, n_vocabs, type="kl")
-                results[f"{key}_js_positivedim"] = compute_divergence(real_counter, len(dataset.data), counter, n_gene_traj, n_vocabs, positive=True, type="kl")
-                results[f"{key}_js"] = compute_divergence(real_counter, sum(real_counter.values()), counter, sum(counter.values()), n_vocabs, axis=1)
-
-                logger.info(f"computed divergence for {key}: {results[f'{key}_js']}")
-            # # compute js divergence
-            # if key in ["target", "destination", "route"]:
-            #     results[f"{key}_jss"] = []
-            #     for i, (counter_, real_counter) in enumerate(zip(counter, real_counters[key])):
-            #         results[f"{key}_jss"].append(compute_divergence(real_counter, sum(real_counter.values()), counter_, sum(counter_.values()), n_vocabs, axis=1))
-            #         # plot_density(counter_, dataset.n_locations, img_dir / f"{key}_{i}.png", dataset.top_base_locations[i], coef=1/counters["first_location"][dataset.top_base_locations[i]])
-            # elif key == "global":
-            #     for i, (counter_, real_counter) in enumerate(zip(counter, real_counters[key])):
-            #         results[f"{key}_jss_{i}"] = compute_divergence(real_counter, sum(real_counter.values()), counter_, sum(counter_.values()), n_vocabs, axis=1)
-            #         # plot_density(counter_, dataset.n_locations, img_dir / f"{key}_{i}.png")
-            # else:
-            #     results[f"{key}_js"] = compute_divergence(real_counters[key], sum(real_counters[key].values()), counter, sum(counter.values()), n_vocabs, axis=1)
-            #     # plot_density(counter, n_vocabs, img_dir / f"{key}.png")
+        results.update(compute_results(counters, evaluating_metrics_names, dataset, n_gene_traj, img_dir, plot_writer, logger, **kwargs))
+        for _, downsampled_dataset, counters_ in targets[1:]:
+            results.update(compute_results(counters_, evaluating_metrics_names, downsampled_dataset, n_gene_traj, img_dir, plot_writer, logger, prefix=f"bin{downsampled_dataset.n_bins}_", **kwargs))
+
+        plot_writer.close()
 
     return results
 
@@ -376,6 +604,14 @@ def get_stay_point(generated_route_trajs, generated_time_trajs, time_threshold):
     return stay_trajs
 
 def compensate_trajs(trajs, db_path):
+    '''
+    db_path: the route store, its directory, or paths.db
+    the routes of all the consecutive pairs are looked up at once
+    '''
+    route_store = open_route_store(db_path)
+    pairs = sorted(set((traj[i], traj[i+1]) for traj in trajs for i in range(len(traj)-1)))
+    pair_to_route = dict(zip(pairs, route_store.routes([pair[0] for pair in pairs], [pair[1] for pair in pairs]))) if len(pairs) > 0 else {}
+
     valid_ids = []
     new_trajs = []
     counter = 0
@@ -387,7 +623,7 @@ def compensate_trajs(trajs, db_path):
         else:
             new_traj = [traj[0]]
             for i in range(len(traj)-1):
-                edges = compensate_edge_by_map(traj[i], traj[i+1], db_path)
+                edges = pair_to_route[(traj[i], traj[i+1])] or []
                 invalid_path = invalid_path or (len(edges) == 0)
                 new_traj.extend(edges[1:])
             if not invalid_path:
@@ -399,26 +635,126 @@ def compensate_trajs(trajs, db_path):
     return new_trajs, valid_ids
 
 def compensate_edge_by_map(from_state, to_state, db_path):
+    # db_path: the route store, its directory, or paths.db
+    state_route = open_route_store(db_path).route(from_state, to_state)
+    if state_route is None:
+        # print("WARNING: path not exist", from_state, to_state)
+        return []
+    return state_route
 
-    with sqlite3.connect(db_path) as conn:
-        c = conn.cursor()
-        c.execute(f"SELECT route FROM state_edge_to_route WHERE start_state={from_state} AND end_state={to_state}")
-        edges = c.fetchone()
-        if edges is None:
-            # print("WARNING: path not exist", from_state, to_state)
-            return []
-        else:
-            state_route = eval(edges[0])
-            if len(state_route) == 0:
-                # print("WARNING: path not exist", from_state, to_state)
-                return []
-            # choose the shortest one
-            # shortest_route = min(state_routes, key=lambda x: len(x))
-            return state_route
 
 
+def compute_emd_on_support(first_hist, second_hist, distance_matrix):
+    '''
+    exact emd restricted to the non-zero bins of the histograms
+    the transportation problem is solved by the dual simplex method on the sliced cost matrix
+    '''
+    first_support = np.where(first_hist > 0)[0]
+    second_support = np.where(second_hist > 0)[0]
+    first_mass = first_hist[first_support].astype(np.float64)
+    # rescale to the same total mass so that the equality constraints are feasible
+    second_mass = second_hist[second_support].astype(np.float64) * first_mass.sum() / second_hist[second_support].sum()
+    n_first, n_second = len(first_support), len(second_support)
+    if n_first == 1 or n_second == 1:
+        # the transport plan is unique
+        return float((np.outer(first_mass, second_mass) / first_mass.sum() * distance_matrix[np.ix_(first_support, second_support)]).sum())
+
+    cost = np.asarray(distance_matrix[np.ix_(first_support, second_support)], dtype=np.float64).reshape(-1)
+    # flow[i, j] is the variable i*n_second+j
+    row_constraints = scipy.sparse.kron(scipy.sparse.eye(n_first), np.ones((1, n_second)))
+    col_constraints = scipy.sparse.kron(np.ones((1, n_first)), scipy.sparse.eye(n_second))
+    # one constraint is redundant since the total masses are equal
+    A_eq = scipy.sparse.vstack([row_constraints, col_constraints.tocsr()[:-1]]).tocsc()
+    b_eq = np.concatenate([first_mass, second_mass[:-1]])
+    result = scipy.optimize.linprog(cost, A_eq=A_eq, b_eq=b_eq, bounds=(0, None), method="highs-ds")
+    if not result.success:
+        raise ValueError(f"emd is not solved: {result.message}")
+    return float(result.fun)
+
+
+def make_grid_edges(n_locations):
+    # the directed edges between the 4-neighbour cells of the square grid (state = i*n_x+j)
+    n_x = int(np.sqrt(n_locations))
+    assert n_x * n_x == n_locations, "grid emd requires a square grid"
+    states = np.arange(n_locations).reshape(n_x, n_x)
+    sources = np.concatenate([states[:-1].reshape(-1), states[:, :-1].reshape(-1)])
+    targets = np.concatenate([states[1:].reshape(-1), states[:, 1:].reshape(-1)])
+    # both directions
+    return np.concatenate([sources, targets]), np.concatenate([targets, sources])
+
+
+# the last distance matrix checked by is_grid_metric and the result (the same matrix is used for all the histograms)
+_grid_metric_check = (None, False)
+
+def is_grid_metric(distance_matrix, n_samples=256):
+    '''
+    whether distance_matrix is the shortest path distance on the 4-neighbour grid with the costs of the adjacent cells in distance_matrix
+    the rows of n_samples sampled cells are compared with the shortest paths (all the rows if the grid is smaller)
+    '''
+    global _grid_metric_check
+    if _grid_metric_check[0] is distance_matrix:
+        return _grid_metric_check[1]
+
+    distance_matrix_ = np.asarray(distance_matrix, dtype=np.float64)
+    n_locations = len(distance_matrix_)
+    sources, targets = make_grid_edges(n_locations)
+    graph = scipy.sparse.csr_matrix((distance_matrix_[sources, targets], (sources, targets)), shape=(n_locations, n_locations))
+    indice = np.random.default_rng(0).choice(n_locations, min(n_samples, n_locations), replace=False)
+    # the zero costs are not taken as edges by csgraph, which only makes the shortest paths longer
+    shortest_paths = scipy.sparse.csgraph.dijkstra(graph, directed=True, indices=indice)
+    result = bool(np.allclose(shortest_paths, distance_matrix_[indice], rtol=1e-6, atol=1e-9*max(distance_matrix_.max(), 1)))
+    _grid_metric_check = (distance_matrix, result)
+    return result
+
+
+def compute_grid_emd(first_hist, second_hist, distance_matrix):
+    '''
+    exact emd when the ground metric is the shortest path distance on the 4-neighbour grid (e.g., manhattan distance between the cells)
+    the transport is computed as the min-cost flow on the grid graph, which has O(n_locations) edges instead of O(n_locations^2)
+    the edge costs are taken from distance_matrix between the adjacent cells
+    raises ValueError if distance_matrix is not such a metric (e.g., the geodesic distance between the cell centers)
+    '''
+    n_locations = len(first_hist)
+    if not is_grid_metric(distance_matrix):
+        raise ValueError("distance_matrix is not the shortest path distance on the grid")
+    first_hist = first_hist.astype(np.float64)
+    second_hist = second_hist.astype(np.float64) * first_hist.sum() / second_hist.sum()
+
+    sources, targets = make_grid_edges(n_locations)
+    cost = np.asarray(distance_matrix[sources, targets], dtype=np.float64)
+    n_edges = len(sources)
+
+    # flow conservation: outflow - inflow = supply - demand
+    edge_indice = np.arange(n_edges)
+    A_eq = scipy.sparse.csr_matrix((np.concatenate([np.ones(n_edges), -np.ones(n_edges)]), (np.concatenate([sources, targets]), np.concatenate([edge_indice, edge_indice]))), shape=(n_locations, n_edges))
+    b_eq = first_hist - second_hist
+    result = scipy.optimize.linprog(cost, A_eq=A_eq[:-1], b_eq=b_eq[:-1], bounds=(0, None), method="highs-ds")
+    if not result.success:
+        raise ValueError(f"emd is not solved: {result.message}")
+    return float(result.fun)
+
+
+def compute_emd(first_hist, second_hist, distance_matrix, emd_backend="pyemd"):
+    '''
+    emd_backend:
+        pyemd: dense emd over all the bins
+        support: exact emd restricted to the non-zero bins
+        grid: min-cost flow on the 4-neighbour grid graph if distance_matrix is the grid metric, otherwise support
+    '''
+    if emd_backend == "pyemd":
+        return pyemd.emd(first_hist, second_hist, distance_matrix)
+    elif emd_backend == "support":
+        return compute_emd_on_support(first_hist, second_hist, distance_matrix)
+    elif emd_backend == "grid":
+        if not is_grid_metric(distance_matrix):
+            # the grid backend is not exact for the other metrics
+            return compute_emd_on_support(first_hist, second_hist, distance_matrix)
+        return compute_grid_emd(first_hist, second_hist, distance_matrix)
+    else:
+        raise ValueError(f"unknown emd_backend {emd_backend}")
 
-def compute_divergence(real_count, n_real_traj, inferred_count, n_gene_traj, n_vocabs, axis=0, positive=False, type="kl", save_path=None, location=None, distance_matrix=None):
+
+def compute_divergence(real_count, n_real_traj, inferred_count, n_gene_traj, n_vocabs, axis=0, positive=False, type="kl", save_path=None, location=None, distance_matrix=None, emd_backend="pyemd", plot_writer=None):
     if n_real_traj == 0:
         print("WARNING: n_real_traj is zero")
         raise ValueError("no trajectory is evaluated")
@@ -428,22 +764,24 @@ def compute_divergence(real_count, n_real_traj, inferred_count, n_gene_traj, n_v
         n_gene_traj = n_vocabs
 
     real_distribution = compute_distribution_from_count(real_count, n_vocabs, n_real_traj)
-    if save_path is not None:
-        plot_density(real_distribution, n_vocabs, save_path.parent / ("real_" + save_path.stem), anotation=location)
-
     inferred_distribution = compute_distribution_from_count(inferred_count, n_vocabs, n_gene_traj)
     if save_path is not None:
-        plot_density(inferred_distribution, n_vocabs, save_path.parent / ("inferred_" + save_path.stem), anotation=location)
+        if plot_writer is not None:
+            plot_writer.add(real_distribution, n_vocabs, "real_" + save_path.stem, anotation=location)
+            plot_writer.add(inferred_distribution, n_vocabs, "inferred_" + save_path.stem, anotation=location)
+        else:
+            plot_density(real_distribution, n_vocabs, save_path.parent / ("real_" + save_path.stem), anotation=location)
+            plot_density(inferred_distribution, n_vocabs, save_path.parent / ("inferred_" + save_path.stem), anotation=location)
 
     if type == "emd":
         assert n_real_traj == sum(real_count.values()), "n_real_traj must be equal to sum(real_count.values())"
         assert n_gene_traj == sum(inferred_count.values()), "n_gene_traj must be equal to sum(inferred_count.values())"
-        # compute the earth mover's distance using pyemd
+        # compute the earth mover's distance
         # real_count and inferred_count will be density
         true_hist = real_distribution
         inferred_hist = inferred_distribution
         # print(true_hist.shape, inferred_hist.shape, distance_matrix.shape)
-        emd = pyemd.emd(inferred_hist, true_hist, distance_matrix)
+        emd = compute_emd(inferred_hist, true_hist, distance_matrix, emd_backend=emd_backend)
         return emd
 
     if axis == 0:
@@ -508,15 +846,41 @@ def make_target_distributions_of_all_layers(target_distribution, tree):
     return distributions[::-1]
 
 
+# the aggregation matrices of the quadtree for each n_bins (process-wide cache)
+_depth_aggregation_matrices = {}
+
+def get_depth_aggregation_matrices(n_bins):
+    '''
+    the sparse matrices (n_locations, 4**depth) that sum up the distribution on the leafs to the nodes at each depth (1, ..., max_depth)
+    the columns are sorted by node.oned_coordinate as in make_target_distributions_of_all_layers
+    '''
+    if n_bins not in _depth_aggregation_matrices:
+        tree = construct_default_quadtree(n_bins)
+        tree.make_self_complete()
+        n_locations = (n_bins+2)**2
+        matrices = []
+        for depth in range(1, tree.max_depth):
+            nodes = sorted(tree.get_nodes(depth), key=lambda node: node.oned_coordinate)
+            rows = [state for node in nodes for state in node.state_list]
+            cols = [i for i, node in enumerate(nodes) for _ in node.state_list]
+            matrices.append(scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_locations, len(nodes))))
+        # the leafs are the locations themselves
+        matrices.append(scipy.sparse.identity(n_locations, format="csr"))
+        _depth_aggregation_matrices[n_bins] = matrices
+    return _depth_aggregation_matrices[n_bins]
+
+
 def compute_distribution_js_for_each_depth(distribution, target_distribution):
+    # distribution, target_distribution: (n_locations,) or (batch_size, n_locations)
+    n_locations = np.shape(distribution)[-1]
+    distribution = np.asarray(distribution, dtype=np.float64).reshape(-1, n_locations)
+    target_distribution = np.asarray(target_distribution, dtype=np.float64).reshape(-1, n_locations)
     next_location_js_for_all_depth = []
-    n_locations = distribution.shape[-1]
-    tree = construct_default_quadtree(int(np.sqrt(n_locations))-2)
-    tree.make_self_complete()
-    target_next_location_distribution_for_all_depth = make_target_distributions_of_all_layers(torch.tensor(target_distribution).view(-1,n_locations), tree)
-    generated_next_location_distribution_for_all_depth = make_target_distributions_of_all_layers(torch.tensor(distribution).view(-1,n_locations), tree)
-    for depth in range(1, tree.max_depth+1):
-        next_location_js_for_all_depth.append(jensenshannon(target_next_location_distribution_for_all_depth[depth-1], generated_next_location_distribution_for_all_depth[depth-1], axis=1)**2)
+    for aggregation_matrix in get_depth_aggregation_matrices(int(np.sqrt(n_locations))-2):
+        # (batch_size, n_nodes) = (batch_size, n_locations) @ (n_locations, n_nodes)
+        target_distribution_at_depth = np.asarray((aggregation_matrix.T @ target_distribution.T).T)
+        distribution_at_depth = np.asarray((aggregation_matrix.T @ distribution.T).T)
+        next_location_js_for_all_depth.append(jensenshannon(target_distribution_at_depth, distribution_at_depth, axis=1)**2)
     return np.stack(next_location_js_for_all_depth, axis=1).tolist()
 
 
@@ -524,37 +888,35 @@ def evaluate_next_location_on_test_dataset(next_location_counts, top_k_locations
     # next_location_distributions = {key: noise_normalize(next_location_count) for key, next_location_count in next_location_counts.items()}
     # print(next_location_counts)
     next_location_distributions = {key: compute_distribution_from_count(next_location_count, n_locations, sum(next_location_count.values())) for key, next_location_count in zip(top_k_locations, next_location_counts)}
-    jss = []
 
-    outputs = []
-    for mini_batch in data_loader:
-        if hasattr(generator, "transition_matrix"):
-            input_locations = mini_batch["input"]
-            output = torch.exp(generator(input_locations[:, target_index]))
-        else:
-            device = next(iter(generator.parameters())).device
-            input_locations = mini_batch["input"].to(device)
-            references = [tuple(v) for v in mini_batch["reference"]]
-            input_times = mini_batch["time"].to(device)
-            # output = generator([input_locations, input_times], references)[0]
-            output, _ = generator([input_locations, input_times])[0]
-            # output = output[-1] if type(output) == list else output
-            output = generator.scoring_component.to_location_distribution(output, target_index)
-            # print(output.shape)
-            output = torch.exp(output).cpu().detach().numpy().tolist()
-            # print(torch.exp(output).cpu().detach().numpy()[:, target_index].shape)
-            # output = torch.exp(output).cpu().detach().numpy()[:, target_index].tolist()
-            outputs.extend(output)
-    
-    cursor = 0
-    for target, n_test_data in counters.items():
-        output = outputs[cursor:cursor+n_test_data]
-        inferred_distribution = np.mean(output, axis=0)
-        target_distribution = next_location_distributions[target]
-        jss.append(compute_distribution_js_for_each_depth(inferred_distribution, target_distribution))
-        # jss.append(jensenshannon(inferred_distribution, target_distribution)**2)
+    # the test data are sorted by the keys of counters, so the group of each record is given by its position
+    n_test_data = torch.tensor(list(counters.values()))
+    group_of_records = torch.repeat_interleave(torch.arange(len(counters)), n_test_data)
 
-        cursor += n_test_data
+    # the predicted distributions are summed up for each group on the device
+    summed_outputs = None
+    cursor = 0
+    with torch.inference_mode():
+        for mini_batch in data_loader:
+            if hasattr(generator, "transition_matrix"):
+                input_locations = mini_batch["input"]
+                output = torch.exp(generator(input_locations[:, target_index]))
+            else:
+                device = next(iter(generator.parameters())).device
+                # the prefix encoding is causal, so the inputs after target_index are not needed
+                input_locations = mini_batch["input"][:, :target_index+1].to(device)
+                input_times = mini_batch["time"][:, :target_index+1].to(device)
+                output, _ = generator([input_locations, input_times])[0]
+                output = torch.exp(generator.scoring_component.to_location_distribution(output, target_index))
+            if summed_outputs is None:
+                summed_outputs = torch.zeros(len(counters), output.shape[-1], dtype=torch.float64, device=output.device)
+            summed_outputs.index_add_(0, group_of_records[cursor:cursor+len(output)].to(output.device), output.double())
+            cursor += len(output)
+
+    inferred_distributions = (summed_outputs.cpu() / n_test_data.view(-1, 1)).numpy()
+    target_distributions = np.stack([next_location_distributions[target] for target in counters])
+    # the divergences of all the groups are computed at once
+    jss = [[js] for js in compute_distribution_js_for_each_depth(inferred_distributions, target_distributions)]
 
     print(jss)
     return jss
@@ -768,10 +1130,54 @@ def compute_global_counts_from_time_label(trajs, time_label_trajs, time_label):
 
 
 
-def compute_auxiliary_information(dataset, save_dir, test_thresh, logger, **kwargs):
+def make_downsampled_dataset(dataset, to_bin, save_dir, test_thresh, logger, **kwargs):
+    # the real data at the coarser resolution to_bin with its auxiliary information
+    from dataset import TrajectoryDataset
+
+    if to_bin >= dataset.n_bins:
+        raise ValueError(f"evaluation bin {to_bin} must be smaller than n_bins {dataset.n_bins}")
+    downsampling = make_downsampling_array(dataset.n_bins, to_bin)
+    trajs, _, time_trajs = downsample_trajs(dataset.data, downsampling, dataset.time_data)
+    route_trajs = trajs if dataset.route_data is dataset.data else downsample_trajs(dataset.route_data, downsampling)[0]
+    downsampled_dataset = TrajectoryDataset(trajs, time_trajs, (to_bin+2)**2, dataset.n_time_split, dataset_name=str(dataset), route_data=route_trajs, data_paths=dataset.data_paths)
+    downsampled_dataset.downsampling = downsampling
+    compute_auxiliary_information(downsampled_dataset, save_dir, test_thresh, logger, prefix=f"bin{to_bin}_", **{**kwargs, "evaluation_bins": []})
+    return downsampled_dataset
+
+def compute_auxiliary_information(dataset, save_dir, test_thresh, logger, prefix="", **kwargs):
     save_dir = pathlib.Path(save_dir)
     img_dir = save_dir.parent / f"imgs"
     img_dir.mkdir(exist_ok=True)
+    plot_writer = DensityPlotWriter(img_dir / f"{prefix}real_densities.npz", render=kwargs["render_plots"])
+
+    # the distance matrices of all the resolutions are checked before computing anything
+    distance_matrix_path = get_datadir() / str(dataset)  / f"distance_matrix_bin{int(np.sqrt(dataset.n_locations)) -2}.npy"
+    missing_paths = [str(path) for path in [distance_matrix_path] + [get_datadir() / str(dataset) / f"distance_matrix_bin{to_bin}.npy" for to_bin in kwargs["evaluation_bins"]] if not path.exists()]
+    if len(missing_paths) > 0:
+        raise FileNotFoundError(f"distance matrices are not found: {missing_paths}; make them by make_distance_data in data_pre_processing.py with the n_bins of the resolution")
+
+    # the distance matrix is only read, so it is memory-mapped (copy-on-write) instead of loaded
+    dataset.distance_matrix = np.load(distance_matrix_path, mmap_mode="c")
+
+    # the datasets at the coarser resolutions for the multi-resolution evaluation
+    dataset.downsampled_datasets = [make_downsampled_dataset(dataset, to_bin, save_dir, test_thresh, logger, **kwargs) for to_bin in kwargs["evaluation_bins"]]
+
+    # the statistics of the real data are cached by the data files, the settings, and the code
+    cache_path = None
+    if kwargs["cache_auxiliary_information"] and len(dataset.data_paths) == 0:
+        logger.info("WARNING the auxiliary information is not cached because the data files are unknown")
+    elif kwargs["cache_auxiliary_information"]:
+        cache_key = compute_auxiliary_information_cache_key(dataset, test_thresh, distance_matrix_path, **kwargs)
+        cache_path = get_datadir() / str(dataset) / "auxiliary_information" / f"{cache_key}.pkl"
+        if cache_path.exists():
+            logger.info(f"load auxiliary information from {cache_path}")
+            load_auxiliary_information(dataset, cache_path, **kwargs)
+            for time, real_global_count in enumerate(dataset.real_global_counts, 1):
+                if sum(real_global_count) != 0:
+                    plot_writer.add(real_global_count, dataset.n_locations, f"real_global_distribution_{int(time)}")
+            plot_writer.close()
+            logger.info(f"evaluating metrics: {dataset.evaluating_metrics_names}")
+            return
 
     # compute top_base_locations
     dataset.first_locations = [trajectory[0] for trajectory in dataset.data if len(trajectory) > 1]
@@ -828,7 +1234,9 @@ def compute_auxiliary_information(dataset, save_dir, test_thresh, logger, **kwar
         if sum(real_global_count) == 0:
             logger.info(f"no location at time {time}")
             continue
-        plot_density(real_global_count, dataset.n_locations, save_dir.parent / f"imgs" / f"real_global_distribution_{int(time)}.png")
+        plot_writer.add(real_global_count, dataset.n_locations, f"real_global_distribution_{int(time)}")
+    plot_writer.close()
+    dataset.real_global_counts = real_global_counts
 
     # global_counts_path = save_dir.parent / f"global_count.json"
     # # save the global counts
@@ -845,14 +1253,16 @@ def compute_auxiliary_information(dataset, save_dir, test_thresh, logger, **kwar
     # # compute time distribution
     # time_label_count = Counter(dataset.time_label_trajs)
     # time_distribution = {label: time_label_count[label] / len(dataset.time_label_trajs) for label in time_label_count.keys()}
-    dataset.distance_matrix = np.load(get_datadir() / str(dataset)  / f"distance_matrix_bin{int(np.sqrt(dataset.n_locations)) -2}.npy")
-
     dataset.evaluating_metrics_names, dataset.counting_functions, dataset.real_counters = make_counting_functions(len(dataset.top_base_locations), **kwargs)
     logger.info(f"evaluating metrics: {dataset.evaluating_metrics_names}")
     # counting to make each distribution
     for counting_function, counter in zip(dataset.counting_functions, dataset.real_counters):
         counting_function(dataset.data, dataset.route_data, dataset, counter)
 
+    if cache_path is not None:
+        logger.info(f"save auxiliary information to {cache_path}")
+        save_auxiliary_information(dataset, cache_path)
+
     # dataset.evaluating_metrics = []
     # dataset.real_counters = []
     # dataset.n_trajs = []
@@ -937,80 +1347,124 @@ def compute_auxiliary_information(dataset, save_dir, test_thresh, logger, **kwar
 
 
 
-def make_second_order_test_data_loader(dataset, n_test_locations):
+def make_prefix_index(trajs, order):
+    '''
+    make the index from the first (order) states to the ids of the trajectories whose length is larger than order
+    the ids of each prefix are in the order of trajs
+    '''
+    lengths = np.fromiter((len(traj) for traj in trajs), dtype=np.int64, count=len(trajs))
+    ids = np.where(lengths > order)[0]
+    if len(ids) == 0:
+        return {}
+    prefixes = np.fromiter((state for i in ids for state in trajs[i][:order]), dtype=np.int64, count=len(ids)*order).reshape(len(ids), order)
+    # encode each prefix to a scalar and group the ids by the prefix with a stable sort
+    offset = prefixes.min()
+    base = prefixes.max() - offset + 1
+    codes = np.zeros(len(ids), dtype=np.int64)
+    for k in range(order):
+        codes = codes * base + (prefixes[:, k] - offset)
+    order_of_codes = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order_of_codes]
+    sorted_ids = ids[order_of_codes]
+    starts = np.concatenate([[0], np.where(np.diff(sorted_codes) != 0)[0] + 1])
+    keys = prefixes[order_of_codes[starts]].tolist()
+    keys = [key[0] if order == 1 else tuple(key) for key in keys]
+    return dict(zip(keys, np.split(sorted_ids, starts[1:])))
+
+def make_test_data_loader(dataset, indice):
+    # the test data are the subset of the dataset itself
+    test_dataset = torch.utils.data.Subset(dataset, indice)
+    return torch.utils.data.DataLoader(test_dataset, num_workers=0, shuffle=False, pin_memory=True, batch_size=100, collate_fn=dataset.make_padded_collate())
 
-    from dataset import TrajectoryDataset
+def make_second_order_test_data_loader(dataset, n_test_locations):
 
     second_order_next_location_counts = dataset.second_order_next_location_counts
     n_test_locations = min(n_test_locations, len(second_order_next_location_counts))
     top_second_order_base_locations = sorted(second_order_next_location_counts, key=lambda x: sum(second_order_next_location_counts[x]), reverse=True)[:n_test_locations]
 
-    # retrieving the trajectories that start with the first_location_counts
-    counters = {}
-    trajs = []
-    time_trajs = []
-    first_second_locations = top_second_order_base_locations[:n_test_locations]
-    for first_location in first_second_locations:
-        trajs_for_the_first_location = []
-        time_trajs_for_the_first_location = []
-        for traj, time_traj in zip(dataset.data, dataset.time_data):
-            if len(traj) > 2:
-                if traj[0] == first_location[0] and traj[1] == first_location[1]:
-                    trajs_for_the_first_location.append(traj)
-                    time_trajs_for_the_first_location.append(time_traj)
-        counters[first_location] = len(trajs_for_the_first_location)
-        trajs.extend(trajs_for_the_first_location)
-        time_trajs.extend(time_trajs_for_the_first_location)
+    # retrieving the trajectories that start with the first two locations
+    prefix_index = make_prefix_index(dataset.data, 2)
+    empty = np.zeros(0, dtype=np.int64)
+    indice = [prefix_index.get(tuple(first_location), empty) for first_location in top_second_order_base_locations]
+    counters = {first_location: len(indice_) for first_location, indice_ in zip(top_second_order_base_locations, indice)}
+    indice = np.concatenate(indice).tolist() if len(indice) > 0 else []
     
-    print(f"number of test trajectories: {len(trajs)}")
+    print(f"number of test trajectories: {len(indice)}")
     print(f"number of test trajectories that start with: {counters}")
 
-    if len(trajs) == 0:
+    if len(indice) == 0:
         print("no trajectory (>2) is found")
         dataset.second_order_test_data_loader = None
         dataset.second_counters = None
         return None, None
     else:
-
-        second_order_test_dataset = TrajectoryDataset(trajs, time_trajs, dataset.n_locations, dataset.n_time_split)
-        second_order_test_data_loader = torch.utils.data.DataLoader(second_order_test_dataset, num_workers=0, shuffle=False, pin_memory=True, batch_size=100, collate_fn=second_order_test_dataset.make_padded_collate())
-        
+        second_order_test_data_loader = make_test_data_loader(dataset, indice)
         dataset.second_order_test_data_loader = second_order_test_data_loader
         dataset.second_counters = counters
         return second_order_test_data_loader, counters
 
 def make_first_order_test_data_loader(dataset, n_test_locations):
 
-    from dataset import TrajectoryDataset
-
     top_base_locations = dataset.top_base_locations
     n_test_locations = min(n_test_locations, len(top_base_locations))
 
     # retrieving the trajectories that start with the first_location_counts
-    counters = {}
-    trajs = []
-    time_trajs = []
-    first_locations = top_base_locations
-    for first_location in first_locations:
-        trajs_for_the_first_location = []
-        time_trajs_for_the_first_location = []
-        for traj, time_traj in zip(dataset.data, dataset.time_data):
-            if traj[0] == first_location and len(traj) > 1:
-                trajs_for_the_first_location.append(traj)
-                time_trajs_for_the_first_location.append(time_traj)
-        counters[first_location] = len(trajs_for_the_first_location)
-        trajs.extend(trajs_for_the_first_location)
-        time_trajs.extend(time_trajs_for_the_first_location)
+    prefix_index = make_prefix_index(dataset.data, 1)
+    empty = np.zeros(0, dtype=np.int64)
+    indice = [prefix_index.get(first_location, empty) for first_location in top_base_locations]
+    counters = {first_location: len(indice_) for first_location, indice_ in zip(top_base_locations, indice)}
+    indice = np.concatenate(indice).tolist() if len(indice) > 0 else []
     
-    print(f"number of test trajectories: {len(trajs)}")
+    print(f"number of test trajectories: {len(indice)}")
     print(f"number of test trajectories that start with: {counters}")
 
-    test_dataset = TrajectoryDataset(trajs, time_trajs, dataset.n_locations, dataset.n_time_split)
-    test_data_loader = torch.utils.data.DataLoader(test_dataset, num_workers=0, shuffle=False, pin_memory=True, batch_size=100, collate_fn=test_dataset.make_padded_collate())
-
-    dataset.first_order_test_data_loader = test_data_loader
+    dataset.first_order_test_indice = indice
     dataset.first_counters = counters
-    return test_data_loader, counters
+    dataset.first_order_test_data_loader = make_test_data_loader(dataset, indice)
+    return dataset.first_order_test_data_loader, counters
+
+# the attributes of the dataset computed by compute_auxiliary_information except for the ones that cannot be pickled
+AUXILIARY_INFORMATION_ATTRIBUTES = ["first_locations", "first_location_counts", "route_first_locations", "route_first_location_counts", "second_order_first_locations", "second_order_first_locations_counts",
+                                    "top_base_locations", "top_route_base_locations", "top_2nd_order_base_locations",
+                                    "next_location_counts", "first_next_location_counts", "second_next_location_counts", "second_order_next_location_counts",
+                                    "first_order_test_indice", "first_counters", "real_global_counts", "evaluating_metrics_names", "real_counters"]
+
+# the modules whose code the auxiliary information depends on (the counting, the dataset, load/save, and the grid lookup)
+AUXILIARY_INFORMATION_SOURCES = ["evaluation.py", "dataset.py", "my_utils.py", "grid.py"]
+
+def compute_auxiliary_information_cache_key(dataset, test_thresh, distance_matrix_path, **kwargs):
+    '''
+    the key changes if the data, the grid, the test location settings, the evaluated metrics, the distance matrix, or the code changes
+    the data files and the distance matrix are identified by their paths, sizes, and modification times instead of their contents
+    '''
+    hash = hashlib.sha256()
+    def file_key(path):
+        stat = pathlib.Path(path).stat()
+        return [str(pathlib.Path(path).resolve()), stat.st_size, stat.st_mtime_ns]
+    settings = {"dataset": str(dataset), "n_locations": dataset.n_locations, "n_time_split": dataset.n_time_split, "test_thresh": test_thresh, "distance_matrix": file_key(distance_matrix_path), "data": [file_key(path) for path in dataset.data_paths]}
+    settings.update({key: kwargs[key] for key in ["evaluate_passing", "evaluate_source", "evaluate_emp_next", "evaluate_target", "evaluate_destination", "evaluate_route", "evaluate_distance"]})
+    hash.update(json.dumps(settings, sort_keys=True).encode())
+    for source in AUXILIARY_INFORMATION_SOURCES:
+        hash.update((pathlib.Path(__file__).parent / source).read_bytes())
+    return hash.hexdigest()
+
+def save_auxiliary_information(dataset, cache_path):
+    cache_path = pathlib.Path(cache_path)
+    cache_path.parent.mkdir(exist_ok=True, parents=True)
+    # write to a temporary file and rename it so that a concurrent run never reads a partial cache
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        pickle.dump({name: getattr(dataset, name) for name in AUXILIARY_INFORMATION_ATTRIBUTES}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+def load_auxiliary_information(dataset, cache_path, **kwargs):
+    with open(cache_path, "rb") as f:
+        auxiliary_information = pickle.load(f)
+    for name, value in auxiliary_information.items():
+        setattr(dataset, name, value)
+    # the data loader and the counting functions are rebuilt from the cached values
+    dataset.first_order_test_data_loader = make_test_data_loader(dataset, dataset.first_order_test_indice)
+    _, dataset.counting_functions, _ = make_counting_functions(len(dataset.top_base_locations), **kwargs)
 
 # def compute_global_counts(trajectories, real_time_traj, time, n_locations, time_to_label):
 #     def location_at_time(trajectory, time_traj, t):
@@ -1206,10 +1660,49 @@ class MTNetGeneratorMock():
 
 #     return args
 
-def run(**kwargs):
-    from main import construct_dataset, construct_generator
+# the dataset with the auxiliary information shared with the evaluation workers by fork
+_shared_dataset = None
+
+def init_evaluation_worker(n_threads):
+    torch.set_num_threads(n_threads)
+
+
+def evaluate_checkpoint(i, model_path, dataset, model_dir, logger, seed=None, **kwargs):
+    from main import construct_generator, set_seed
 
     device = torch.device(f"cuda:{kwargs['cuda_number']}" if torch.cuda.is_available() else "cpu")
+    if dataset is None:
+        dataset = _shared_dataset
+    if seed is not None:
+        set_seed(seed)
+
+    logger.info(f"evaluate {model_path}")
+
+    # load model
+    if kwargs["model_name"] in ["hrnet", "baseline"]:
+        # pretraining_network, _ = construct_pretraining_network(kwargs["clustering"], kwargs["model_name"], dataset.n_locations, kwargs["memory_dim"], kwargs["memory_hidden_dim"], kwargs["location_embedding_dim"], kwargs["multilayer"], kwargs["consistent"], logger)
+        # if hasattr(pretraining_network, "remove_class_to_query"):
+        #     pretraining_network.remove_class_to_query()
+        generator = construct_generator(kwargs["model_name"], dataset.n_locations, dataset.n_time_split+1, kwargs["location_embedding_dim"], kwargs["time_embedding_dim"], kwargs["memory_hidden_dim"], kwargs["multitask"], kwargs["consistent"])
+        generator.load_state_dict(torch.load(model_path, map_location=device))
+        generator = generator.to(device)
+
+    # evaluate the model
+    plot_writer = DensityPlotWriter(model_dir / "imgs" / f"densities_{i}.npz", render=kwargs["render_plots"])
+    results = evaluate(generator, dataset, model_dir, logger, plot_writer=plot_writer, **kwargs)
+
+    # save the result
+    result_save_path = model_dir / result_name(i, kwargs["consistent"])
+    
+    logger.info("save result to " + str(result_save_path))
+    with open(result_save_path, "w") as f:
+        json.dump(results, f)
+    return result_save_path
+
+
+def run(**kwargs):
+    global _shared_dataset
+    from main import construct_dataset
 
     # find models
     model_dir = make_model_dir(**kwargs)
@@ -1229,32 +1722,24 @@ def run(**kwargs):
     dataset = construct_dataset(training_data_dir, None, kwargs["n_split"])
     compute_auxiliary_information(dataset, model_dir, kwargs["test_threshold"], logger, **kwargs)
 
-    # evaluation
-    for i, model_path in enumerate(model_paths):
-        # skip according to the interval
-        if i % kwargs["evaluation_interval"] != 0:
-            continue
+    # skip according to the interval
+    checkpoints = [(i, model_path) for i, model_path in enumerate(model_paths) if i % kwargs["evaluation_interval"] == 0]
 
-        logger.info(f"evaluate {model_path}")
-
-        # load model
-        if kwargs["model_name"] in ["hrnet", "baseline"]:
-            # pretraining_network, _ = construct_pretraining_network(kwargs["clustering"], kwargs["model_name"], dataset.n_locations, kwargs["memory_dim"], kwargs["memory_hidden_dim"], kwargs["location_embedding_dim"], kwargs["multilayer"], kwargs["consistent"], logger)
-            # if hasattr(pretraining_network, "remove_class_to_query"):
-            #     pretraining_network.remove_class_to_query()
-            generator = construct_generator(kwargs["model_name"], dataset.n_locations, dataset.n_time_split+1, kwargs["location_embedding_dim"], kwargs["time_embedding_dim"], kwargs["memory_hidden_dim"], kwargs["multitask"], kwargs["consistent"])
-            generator.load_state_dict(torch.load(model_path, map_location=device))
-            generator = generator.to(device)
-
-        # evaluate the model
-        results = evaluate(generator, dataset, model_dir, logger, **kwargs)
-
-        # save the result
-        result_save_path = model_dir / result_name(i, kwargs["consistent"])
-        
-        logger.info("save result to " + str(result_save_path))
-        with open(result_save_path, "w") as f:
-            json.dump(results, f)
+    # evaluation
+    # each checkpoint is evaluated with its own seed so that the results do not depend on the scheduling
+    if kwargs["n_evaluation_workers"] > 0:
+        # the workers inherit the dataset with the auxiliary information by fork instead of recomputing it
+        logger.info(f"evaluate {len(checkpoints)} checkpoints with {kwargs['n_evaluation_workers']} workers")
+        _shared_dataset = dataset
+        context = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=kwargs["n_evaluation_workers"], mp_context=context, initializer=init_evaluation_worker, initargs=(kwargs["n_threads_per_evaluation_worker"],)) as executor:
+            futures = [executor.submit(evaluate_checkpoint, i, model_path, None, model_dir, logger, seed=kwargs["model_seed"]+i, **kwargs) for i, model_path in checkpoints]
+            for future in futures:
+                future.result()
+        _shared_dataset = None
+    else:
+        for i, model_path in checkpoints:
+            evaluate_checkpoint(i, model_path, dataset, model_dir, logger, seed=kwargs["model_seed"]+i, **kwargs)
 
 
 
@@ -86,7 +86,7 @@ class Grid():
         return False
 
     def is_in_range(self, lat, lon):
-        return self.lat_range[0]-1e-5 <= lat < self.lat_range[1]+1e-5 and self.lon_range[0]-1e-5 <= lon < self.lon_range[1]+1e-5
+        return bool(self.are_in_range(lat, lon))
 
     # convert latlon to state by bisect search
     def latlon_to_state(self, lat, lon):
@@ -94,7 +94,53 @@ class Grid():
             if x_range[0] <= lon < x_range[1] and y_range[0] <= lat < y_range[1]:
                 return state
         return None
+
+    def make_state_table(self):
+        # if each cell spans one interval of the sorted edges of both axes, a latlon is located by binary search on the edges
+        # otherwise, (None, None, None) is returned
+        x_edges = np.unique([x for x_range, _ in self.grids.values() for x in x_range])
+        y_edges = np.unique([y for _, y_range in self.grids.values() for y in y_range])
+        state_table = np.full((len(x_edges)-1, len(y_edges)-1), -1, dtype=np.int64)
+        for state, (x_range, y_range) in self.grids.items():
+            i = np.searchsorted(x_edges, x_range[0])
+            j = np.searchsorted(y_edges, y_range[0])
+            if x_edges[i+1] != x_range[1] or y_edges[j+1] != y_range[1]:
+                return None, None, None
+            if state_table[i, j] == -1:
+                state_table[i, j] = state
+        return x_edges, y_edges, state_table
+
+    def latlons_to_states(self, lats, lons):
+        """
+        vectorized latlon_to_state
+        return the array of the states (-1 for the latlons out of the grid)
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        if not hasattr(self, "state_table"):
+            self.x_edges, self.y_edges, self.state_table = self.make_state_table()
+
+        if self.state_table is None:
+            # the first cell that contains the latlon as in latlon_to_state
+            states = np.full(lats.shape, -1, dtype=np.int64)
+            for state, (x_range, y_range) in self.grids.items():
+                states[(states == -1) & (x_range[0] <= lons) & (lons < x_range[1]) & (y_range[0] <= lats) & (lats < y_range[1])] = state
+            return states
+
+        i = np.searchsorted(self.x_edges, lons, side="right") - 1
+        j = np.searchsorted(self.y_edges, lats, side="right") - 1
+        in_grid = (i >= 0) & (i < self.state_table.shape[0]) & (j >= 0) & (j < self.state_table.shape[1])
+        return np.where(in_grid, self.state_table[np.clip(i, 0, self.state_table.shape[0]-1), np.clip(j, 0, self.state_table.shape[1]-1)], -1)
     
+    def are_in_range(self, lats, lons):
+        """
+        vectorized is_in_range (the range is extended by 1e-5)
+        return the boolean array of whether the latlons are in the range of the grid
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        return (self.lat_range[0]-1e-5 <= lats) & (lats < self.lat_range[1]+1e-5) & (self.lon_range[0]-1e-5 <= lons) & (lons < self.lon_range[1]+1e-5)
+
     def register_count(self, counts):
         self.counts = counts
 
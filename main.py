@@ -8,15 +8,20 @@ import json
 from scipy.spatial.distance import jensenshannon
 from collections import Counter
 import pathlib
+import math
+import os
+import copy
+import time
 
 from name_config import make_model_name, make_save_name, make_raw_data_path, make_training_data_path
-from my_utils import get_datadir, privtree_clustering, depth_clustering, noise_normalize, add_noise, plot_density, make_trajectories, set_logger, construct_default_quadtree, save, load, compute_num_params, set_budget
-from dataset import TrajectoryDataset, PretrainingDataset
+from my_utils import get_datadir, privtree_clustering, depth_clustering, noise_normalize, add_noise, plot_density, DensityPlotWriter, make_trajectories, set_logger, construct_default_quadtree, save, load, compute_num_params, set_budget
+from dataset import TrajectoryDataset, PretrainingDataset, SynchronizedDistributedUniformWithReplacementSampler, LengthBucketedBatchMemoryManager
 from models import compute_loss_generator, construct_generator
 import torch.nn.functional as F
 from opacus.utils.batch_memory_manager import BatchMemoryManager
 
-from opacus import PrivacyEngine
+from opacus import PrivacyEngine, GradSampleModule
+from opacus.distributed import DifferentiallyPrivateDistributedDataParallel as DPDDP
 from pytorchtools import EarlyStopping
 import evaluation
 
@@ -47,7 +52,12 @@ def train_with_discrete_time(generator, optimizer, loss_model, input_locations,
     #     output_locations, output_times = generator([input_locations, input_times], labels, target=target_locations)
     # else:
     # output_locations, output_times = generator([input_locations, input_times], labels)
-    (output_locations, output_times), _ = generator([input_locations, input_times])
+    if not is_dp and getattr(generator.scoring_component, "n_negative_samples", 0) > 0:
+        # sampled softmax: the output is the log distribution over the target and the negative samples
+        (output_locations, output_times), _ = generator([input_locations, input_times], target_locations=target_locations)
+        target_locations = generator.scoring_component.to_sampled_target(target_locations)
+    else:
+        (output_locations, output_times), _ = generator([input_locations, input_times])
     if train_all_layers:
         # target_locations = make_targets_of_all_layers(target_locations, generator.meta_net.tree)
         target_locations = make_targets_of_all_layers(target_locations, generator.location_encoding_component.tree)
@@ -98,6 +108,9 @@ def train_with_discrete_time(generator, optimizer, loss_model, input_locations,
         for name, param in generator.named_parameters():
             if param.grad is None:
                 continue
+            if param.grad.is_sparse:
+                norms.append(param.grad.coalesce().values().reshape(-1))
+                continue
             norms.append(param.grad.reshape(-1))
         norms = torch.cat(norms, dim=0)
         # print("are", norms.max(), norms.min())
@@ -106,11 +119,27 @@ def train_with_discrete_time(generator, optimizer, loss_model, input_locations,
 
     optimizer.step()
     losses = [loss.item() for loss in losses]
-    losses.append(np.mean(norms))
+    losses.append(np.mean(norms) if len(norms) > 0 else 0)
 
     return losses
 
 
+class SparseDenseAdam:
+    '''
+    Adam for the parameters with dense gradients and SparseAdam for those with sparse gradients (sparse_embedding and sampled softmax)
+    '''
+    def __init__(self, params, sparse_params, lr):
+        sparse_ids = [id(param) for param in sparse_params]
+        self.optimizers = [optim.Adam([param for param in params if id(param) not in sparse_ids], lr=lr), optim.SparseAdam(sparse_params, lr=lr)]
+
+    def zero_grad(self, set_to_none=True):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad(set_to_none=set_to_none)
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
 def train_epoch(data_loader, generator, optimizer, loss_model, train_all_layers, coef_location, coef_time):
     losses = []
     device = next(generator.parameters()).device
@@ -123,9 +152,26 @@ def train_epoch(data_loader, generator, optimizer, loss_model, train_all_layers,
 
         loss = train_with_discrete_time(generator, optimizer, loss_model, input_locations, target_locations, input_times, target_times, references, coef_location, coef_time, train_all_layers=train_all_layers)
         # print(norm)
-        losses.append(loss)
+        # an empty batch of Poisson sampling only takes part in the optimizer step
+        if len(input_locations) > 0:
+            losses.append(loss)
+
+    return losses
 
-    return np.mean(losses, axis=0)
+def all_reduce_mean_losses(losses):
+    '''
+    the mean of the losses of the batches of all the ranks
+    the sums and the counts are all-reduced so that a rank without a non-empty batch does not make the mean nan
+    '''
+    # the number of the loss values is not known by a rank without a batch
+    n_values = torch.tensor(len(losses[0]) if len(losses) > 0 else 0)
+    torch.distributed.all_reduce(n_values, op=torch.distributed.ReduceOp.MAX)
+    sum_count = torch.zeros(n_values.item()+1, dtype=torch.float64)
+    if len(losses) > 0:
+        sum_count[:-1] = torch.tensor(np.sum(losses, axis=0))
+        sum_count[-1] = len(losses)
+    torch.distributed.all_reduce(sum_count, op=torch.distributed.ReduceOp.SUM)
+    return (sum_count[:-1] / sum_count[-1]).numpy()
 
 def clustering(clustering_type, n_locations, logger):
     logger.info(f"clustering type: {clustering_type}")
@@ -168,7 +214,7 @@ def clustering(clustering_type, n_locations, logger):
         
 #     return pretraining_network, location_to_class
 
-def prepare_transition_matrix(location_to_class, transition_type, dataset, clipping, epsilon, save_dir, logger):
+def prepare_transition_matrix(location_to_class, transition_type, dataset, clipping, epsilon, save_dir, logger, plot_writer=None):
     n_classes = len(set(location_to_class.values()))
     transition_matrix = []
     for i in range(n_classes):
@@ -195,7 +241,10 @@ def prepare_transition_matrix(location_to_class, transition_type, dataset, clipp
         
         transition_matrix.append(target_count_i)
 
-        plot_density(target_count_i, dataset.n_locations, save_dir / "imgs" / f"class_next_location_distribution_{i}.png")
+        if plot_writer is not None:
+            plot_writer.add(target_count_i, dataset.n_locations, f"class_next_location_distribution_{i}")
+        else:
+            plot_density(target_count_i, dataset.n_locations, save_dir / "imgs" / f"class_next_location_distribution_{i}.png")
     
     return torch.stack(transition_matrix)
 
@@ -219,7 +268,7 @@ def compute_loss_for_pretraining(pretraining_network_output, target):
 
 
 
-def pre_training_pretraining_network(transition_matrix, privtree, n_iter, pretraining_network, patience, save_dir, pretraining_method, logger):
+def pre_training_pretraining_network(transition_matrix, privtree, n_iter, pretraining_network, patience, save_dir, pretraining_method, logger, plot_writer=None):
     device = next(pretraining_network.parameters()).device
     
     # class_encoder converts class to a vector which is used for the input of the temp_network, and this itself is not trained
@@ -261,9 +310,9 @@ def pre_training_pretraining_network(transition_matrix, privtree, n_iter, pretra
 
     # test
     logger.info("save test results to " + str(save_dir / "imgs" / f"pretraining_network_output_i.png"))
-    test_pretrained_network(pretraining_network, class_encoder, temp_network, len(transition_matrix), len(transition_matrix[0]), save_dir)
+    test_pretrained_network(pretraining_network, class_encoder, temp_network, len(transition_matrix), len(transition_matrix[0]), save_dir, plot_writer)
 
-def test_pretrained_network(pretraining_network, class_encoder, temp_network, n_classes, n_locations, save_dir):
+def test_pretrained_network(pretraining_network, class_encoder, temp_network, n_classes, n_locations, save_dir, plot_writer=None):
     device = next(pretraining_network.parameters()).device
 
     # plot the test output of meta_network
@@ -275,7 +324,10 @@ def test_pretrained_network(pretraining_network, class_encoder, temp_network, n_
         if type(meta_network_output) == list:
             meta_network_output = meta_network_output[-1]
         for i in range(n_classes):
-            plot_density(torch.exp(meta_network_output[i]).cpu().view(-1), n_locations, save_dir / "imgs" / f"pretraining_network_output_{i}.png")
+            if plot_writer is not None:
+                plot_writer.add(torch.exp(meta_network_output[i]).cpu().view(-1), n_locations, f"pretraining_network_output_{i}")
+            else:
+                plot_density(torch.exp(meta_network_output[i]).cpu().view(-1), n_locations, save_dir / "imgs" / f"pretraining_network_output_{i}.png")
         pretraining_network.train()
 
 
@@ -294,7 +346,8 @@ def construct_dataset(training_data_dir, route_data_path, n_time_split):
     # this is used for MTNet 
     route_trajectories = load(route_data_path) if route_data_path is not None else None
 
-    return TrajectoryDataset(trajectories, time_trajectories, n_locations, n_time_split, route_data=route_trajectories, dataset_name=dataset_name)
+    data_paths = [training_data_dir / "training_data.csv", training_data_dir / "training_data_time.csv"] + ([route_data_path] if route_data_path is not None else [])
+    return TrajectoryDataset(trajectories, time_trajectories, n_locations, n_time_split, route_data=route_trajectories, dataset_name=dataset_name, data_paths=data_paths)
 
 
 def set_seed(seed):
@@ -313,6 +366,12 @@ def check_hyperparameters(kwargs, dataset, logger):
     if kwargs["physical_batch_size"] == 0:
         kwargs["physical_batch_size"] = kwargs["batch_size"]
         logger.info("physical batch size is set as " + str(kwargs["physical_batch_size"]))
+    if (kwargs["sparse_embedding"] or kwargs["n_negative_samples"] > 0) and kwargs["is_dp"]:
+        raise ValueError("sparse_embedding and n_negative_samples are not supported for DP training because the noise of DP-SGD is dense")
+    if (kwargs["sparse_embedding"] or kwargs["n_negative_samples"] > 0) and kwargs["model_name"] != "baseline":
+        raise ValueError("sparse_embedding and n_negative_samples are only supported for the baseline model")
+    if kwargs["n_processes"] > 1 and not kwargs["is_dp"]:
+        raise ValueError("n_processes > 1 is only supported for DP training")
     if kwargs["consistent"] and not kwargs["multitask"]:
         raise ValueError("consistent is True but multitask is False")
     if kwargs["model_name"] != "hrnet" and kwargs["multitask"]:
@@ -328,6 +387,179 @@ def check_hyperparameters(kwargs, dataset, logger):
         else:
             logger.info(f"epsilon is fixed as: {kwargs['epsilon']}")
 
+def compute_tensors_bytes(tensors):
+    # the total bytes of the storages of the tensors (the views of the same storage are counted once)
+    storages = {}
+    for tensor in tensors:
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values())
+
+def tune_physical_batch_size(generator, dataset, batch_size, memory_budget, cache_path, logger, n_trials=3):
+    '''
+    find the fastest physical batch size of per-sample gradient computation that fits in memory_budget (GB)
+    the candidates are powers of two up to batch_size and each candidate is probed with forward/backward of the longest trajectories in the dataset
+    the result is cached in cache_path for each (model, n_locations, seq_len)
+    '''
+    device = next(generator.parameters()).device
+    key = f"{type(generator.location_encoding_component).__name__}_{type(generator.prefix_encoding_component).__name__}_{dataset.n_locations}_{dataset.seq_len}_{compute_num_params(generator)}_{device.type}_{memory_budget}"
+    cache = {}
+    if cache_path.exists():
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    if key in cache and cache[key] <= batch_size:
+        logger.info(f"load physical batch size {cache[key]} from {cache_path}")
+        return cache[key]
+
+    # the longest trajectories are used so that the chosen size is stable for all batches
+    indice = np.argsort([len(trajectory) for trajectory in dataset.data])[::-1]
+    collate_fn = dataset.make_padded_collate()
+
+    candidates = []
+    physical_batch_size = 1
+    while physical_batch_size < batch_size:
+        candidates.append(physical_batch_size)
+        physical_batch_size *= 2
+    candidates.append(batch_size)
+
+    best_physical_batch_size = 1
+    best_throughput = 0
+    for physical_batch_size in candidates:
+        probe_generator = GradSampleModule(copy.deepcopy(generator))
+        batch = collate_fn([dataset[indice[i % len(indice)]] for i in range(physical_batch_size)])
+        try:
+            elapsed_times = []
+            for _ in range(n_trials):
+                if device.type == "cuda":
+                    torch.cuda.reset_peak_memory_stats(device)
+                start_time = time.time()
+                # the tensors saved for backward (the activations) are recorded to estimate the memory usage on cpu
+                saved_tensors = []
+                with torch.autograd.graph.saved_tensors_hooks(lambda tensor: saved_tensors.append(tensor) or tensor, lambda tensor: tensor):
+                    (output_locations, output_times), _ = probe_generator([batch["input"].to(device), batch["time"].to(device)])
+                    losses = compute_loss_generator(batch["target"].to(device), batch["time_target"].to(device), output_locations, output_times, 1, 1)
+                # the inputs of the layers captured by the hooks of GradSampleModule (released in backward)
+                saved_tensors += [tensor for module in probe_generator.modules() for activations in getattr(module, "activations", []) for tensor in activations]
+                sum(losses).backward()
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                    used_memory = torch.cuda.max_memory_allocated(device)
+                else:
+                    # the activations, the per-sample gradients, the gradients, and the parameters
+                    used_memory = compute_tensors_bytes(saved_tensors + [tensor for param in probe_generator.parameters() for tensor in [param, param.grad, getattr(param, "grad_sample", None)] if tensor is not None])
+                del saved_tensors
+                elapsed_times.append(time.time() - start_time)
+                probe_generator.zero_grad(set_to_none=True)
+        except RuntimeError as e:
+            if "out of memory" not in str(e):
+                raise e
+            logger.info(f"physical batch size {physical_batch_size}: out of memory")
+            break
+        finally:
+            del probe_generator
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+
+        if used_memory > memory_budget * 1024**3:
+            logger.info(f"physical batch size {physical_batch_size}: {used_memory / 1024**3:.3f}GB exceeds the budget {memory_budget}GB")
+            break
+        # the first trial is a warm-up
+        throughput = physical_batch_size / np.median(elapsed_times[1:] if n_trials > 1 else elapsed_times)
+        logger.info(f"physical batch size {physical_batch_size}: {throughput:.1f} samples/s, {used_memory / 1024**3:.3f}GB")
+        if throughput >= best_throughput:
+            best_throughput = throughput
+            best_physical_batch_size = physical_batch_size
+
+    cache[key] = best_physical_batch_size
+    cache_path.parent.mkdir(exist_ok=True, parents=True)
+    with open(cache_path, "w") as f:
+        json.dump(cache, f)
+    logger.info(f"physical batch size is tuned as {best_physical_batch_size} and cached to {cache_path}")
+    return best_physical_batch_size
+
+def train(rank, generator, dataset, save_dir, logger, kwargs):
+    '''
+    train the generator with early stopping
+    when n_processes > 1, this is the process of the rank, and each Poisson-sampled logical batch is sharded across the processes
+    the clipped per-sample gradients are summed over the processes by all_reduce and the noise is added only once (by the rank 0)
+    '''
+    world_size = kwargs["n_processes"]
+    sparse_parameters = generator.sparse_parameters()
+    if world_size > 1:
+        os.environ["MASTER_ADDR"] = "127.0.0.1"
+        os.environ["MASTER_PORT"] = str(kwargs["master_port"])
+        torch.distributed.init_process_group("gloo", rank=rank, world_size=world_size)
+        torch.set_num_threads(max([1, os.cpu_count() // world_size]))
+        # the models of the ranks are synchronized with that of the rank 0
+        generator = DPDDP(generator)
+
+    # make data loader
+    collate_fn = dataset.make_padded_collate(kwargs["remove_first_value"], kwargs["remove_duplicate"])
+    if world_size > 1:
+        # the same sampling rate as the Poisson sampling of the single process
+        sample_rate = 1 / math.ceil(len(dataset) / kwargs["batch_size"])
+        sampler_generator = torch.Generator().manual_seed(kwargs["model_seed"] * world_size + rank)
+        sampler = SynchronizedDistributedUniformWithReplacementSampler(total_size=len(dataset), sample_rate=sample_rate, shuffle_seed=kwargs["model_seed"], generator=sampler_generator)
+        data_loader = torch.utils.data.DataLoader(dataset, num_workers=0, pin_memory=True, batch_sampler=sampler, collate_fn=collate_fn)
+    else:
+        data_loader = torch.utils.data.DataLoader(dataset, num_workers=0, shuffle=True, pin_memory=True, batch_size=kwargs["batch_size"], collate_fn=collate_fn)
+
+    # set optimizer
+    if len(sparse_parameters) > 0:
+        optimizer = SparseDenseAdam(generator.parameters(), sparse_parameters, kwargs["learning_rate"])
+    else:
+        optimizer = optim.Adam(generator.parameters(), lr=kwargs["learning_rate"])
+    # make generator, optimizer, and data_loader private if is_dp
+    if kwargs["is_dp"]:
+        logger.info("privating the model")
+        privacy_engine = PrivacyEngine(accountant=kwargs["accountant_mode"])
+        # the data loader of the multiple processes is already Poisson sampling
+        generator, optimizer, data_loader = privacy_engine.make_private(module=generator, optimizer=optimizer, data_loader=data_loader, noise_multiplier=kwargs["noise_multiplier"], max_grad_norm=kwargs["clipping_bound"], poisson_sampling=world_size == 1)
+        eval_generator = generator._module.module if world_size > 1 else generator._module
+    else:
+        logger.info("not privating the model")
+        eval_generator = generator
+
+    # traning the generator with early stopping
+    early_stopping = EarlyStopping(patience=kwargs["patience"], verbose=True, path=save_dir / "checkpoint.pt", trace_func=logger.info)
+    logger.info(f"early stopping patience: {kwargs['patience']}")
+    for epoch in tqdm.tqdm(range(kwargs["n_epochs"]), disable=rank != 0):
+
+        # save model
+        if rank == 0:
+            logger.info(f"save model to {save_dir / f'model_{epoch}.pt'}")
+            torch.save(eval_generator.state_dict(), save_dir / f"model_{epoch}.pt")
+
+        # training
+        if not kwargs["is_dp"]:
+            losses = train_epoch(data_loader, generator, optimizer, compute_loss_generator, kwargs["multitask"], kwargs["coef_location"], kwargs["coef_time"])
+            epsilon = 0
+        else:
+            if world_size > 1:
+                sampler.set_epoch(epoch)
+            # length_bucketing makes the physical batches of each logical batch length-homogeneous
+            batch_memory_manager = LengthBucketedBatchMemoryManager if kwargs["length_bucketing"] else BatchMemoryManager
+            with batch_memory_manager(data_loader=data_loader, max_physical_batch_size=min([kwargs["physical_batch_size"], kwargs["batch_size"]]), optimizer=optimizer) as new_data_loader:
+                losses = train_epoch(new_data_loader, generator, optimizer, compute_loss_generator, kwargs["multitask"], kwargs["coef_location"], kwargs["coef_time"])
+            epsilon = privacy_engine.get_epsilon(kwargs["dp_delta"])
+
+        # average the losses over the batches (of all the ranks)
+        losses = all_reduce_mean_losses(losses) if world_size > 1 else np.mean(losses, axis=0)
+
+        # early stopping is decided by the rank 0
+        early_stop = torch.tensor(0)
+        if rank == 0:
+            early_stopping(np.sum(losses[:-1]), eval_generator)
+            logger.info(f'epoch: {early_stopping.epoch} epsilon: {epsilon} | best loss: {early_stopping.best_score} | current loss: location {losses[:-2]}, time {losses[-2]}, norm {losses[-1]}')
+            early_stop = torch.tensor(int(early_stopping.early_stop))
+        if world_size > 1:
+            torch.distributed.broadcast(early_stop, 0)
+        if early_stop.item():
+            break
+
+    if world_size > 1:
+        torch.distributed.destroy_process_group()
+
 def run(**kwargs):
 
     # set seed
@@ -357,11 +589,8 @@ def run(**kwargs):
     # check hyperparaneters
     check_hyperparameters(kwargs, dataset, logger)
 
-    # make data loader
-    data_loader = torch.utils.data.DataLoader(dataset, num_workers=0, shuffle=True, pin_memory=True, batch_size=kwargs["batch_size"], collate_fn=dataset.make_padded_collate(kwargs["remove_first_value"], kwargs["remove_duplicate"]))
-
     # construct generator
-    generator = construct_generator(kwargs["model_name"], dataset.n_locations, dataset.n_time_split+1, kwargs["location_embedding_dim"], kwargs["time_embedding_dim"], kwargs["memory_hidden_dim"], kwargs["multitask"], kwargs["consistent"])
+    generator = construct_generator(kwargs["model_name"], dataset.n_locations, dataset.n_time_split+1, kwargs["location_embedding_dim"], kwargs["time_embedding_dim"], kwargs["memory_hidden_dim"], kwargs["multitask"], kwargs["consistent"], kwargs["sparse_embedding"], kwargs["n_negative_samples"])
     logger.info(f"number of parameters: {compute_num_params(generator)}")
     generator.to(device)
 
@@ -369,47 +598,26 @@ def run(**kwargs):
     if kwargs["pre_n_iter"] != 0:
         # classify locations according to the clustering type with location semantics without dataset
         location_to_class, privtree = clustering(kwargs['clustering'], dataset.n_locations, logger)
+        # the distributions are dumped to npz and rendered off the training loop
+        plot_writer = DensityPlotWriter(save_dir / "imgs" / "pretraining_densities.npz", render=kwargs["render_plots"])
         # prepare (DP) transition matrix
-        transition_matrix = prepare_transition_matrix(location_to_class, kwargs["transition_type"], dataset, kwargs["clipping_for_transition_matrix"], kwargs["epsilon"], save_dir, logger)
+        transition_matrix = prepare_transition_matrix(location_to_class, kwargs["transition_type"], dataset, kwargs["clipping_for_transition_matrix"], kwargs["epsilon"], save_dir, logger, plot_writer)
         # pre-training with the transition matrix
-        pre_training_pretraining_network(transition_matrix, privtree, kwargs["pre_n_iter"], generator, kwargs["pre_training_patience"], save_dir, kwargs["pretraining_method"], logger)
-
-    # set optimizer
-    optimizer = optim.Adam(generator.parameters(), lr=kwargs["learning_rate"])
-    # make generator, optimizer, and data_loader private if is_dp
-    if kwargs["is_dp"]:
-        logger.info("privating the model")
-        privacy_engine = PrivacyEngine(accountant=kwargs["accountant_mode"])
-        generator, optimizer, data_loader = privacy_engine.make_private(module=generator, optimizer=optimizer, data_loader=data_loader, noise_multiplier=kwargs["noise_multiplier"], max_grad_norm=kwargs["clipping_bound"])
-        eval_generator = generator._module
+        pre_training_pretraining_network(transition_matrix, privtree, kwargs["pre_n_iter"], generator, kwargs["pre_training_patience"], save_dir, kwargs["pretraining_method"], logger, plot_writer)
+        plot_writer.close()
+
+    # tune the physical batch size for the per-sample gradient computation
+    if kwargs["is_dp"] and kwargs["tune_physical_batch_size"]:
+        kwargs["physical_batch_size"] = tune_physical_batch_size(generator, dataset, kwargs["batch_size"], kwargs["physical_batch_size_memory_budget"], get_datadir() / "physical_batch_size.json", logger)
+
+    # training
+    if kwargs["n_processes"] > 1:
+        # data-parallel DP-SGD on cpu; the processes inherit the generator and the dataset by fork
+        logger.info(f"train with {kwargs['n_processes']} processes")
+        torch.multiprocessing.start_processes(train, args=(generator, dataset, save_dir, logger, kwargs), nprocs=kwargs["n_processes"], start_method="fork")
     else:
-        logger.info("not privating the model")
-        eval_generator = generator
-
-    # traning the generator with early stopping
-    early_stopping = EarlyStopping(patience=kwargs["patience"], verbose=True, path=save_dir / "checkpoint.pt", trace_func=logger.info)
-    logger.info(f"early stopping patience: {kwargs['patience']}")
-    for epoch in tqdm.tqdm(range(kwargs["n_epochs"])):
+        train(0, generator, dataset, save_dir, logger, kwargs)
 
-        # save model
-        logger.info(f"save model to {save_dir / f'model_{epoch}.pt'}")
-        torch.save(eval_generator.state_dict(), save_dir / f"model_{epoch}.pt")
-
-        # training
-        if not kwargs["is_dp"]:
-            losses = train_epoch(data_loader, generator, optimizer, compute_loss_generator, kwargs["multitask"], kwargs["coef_location"], kwargs["coef_time"])
-            epsilon = 0
-        else:
-            with BatchMemoryManager(data_loader=data_loader, max_physical_batch_size=min([kwargs["physical_batch_size"], kwargs["batch_size"]]), optimizer=optimizer) as new_data_loader:
-                losses = train_epoch(new_data_loader, generator, optimizer, compute_loss_generator, kwargs["multitask"], kwargs["coef_location"], kwargs["coef_time"])
-            epsilon = privacy_engine.get_epsilon(kwargs["dp_delta"])
-
-        # early stopping
-        early_stopping(np.sum(losses[:-1]), eval_generator)
-        logger.info(f'epoch: {early_stopping.epoch} epsilon: {epsilon} | best loss: {early_stopping.best_score} | current loss: location {losses[:-2]}, time {losses[-2]}, norm {losses[-1]}')
-        if early_stopping.early_stop:
-            break
-    
     # save parameters
     logger.info(f"save param to {save_dir / 'params.json'}")
     with open(save_dir / "params.json", "w") as f:
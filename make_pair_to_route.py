@@ -1,13 +1,17 @@
 import networkx as nx
 import sqlite3
+import ast
 import pathlib
 import tqdm
 import json
 from grid import Grid
 import shapely.wkt
 import concurrent.futures
-import functools
-import pickle
+import multiprocessing
+import collections
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
 
 def load_edges(data_dir):
     """
@@ -69,20 +73,65 @@ def make_graph(data_dir):
     # return DG, G
     return DG
 
-def make_node_to_state(G, n_states, latlon_to_state, db_path):
+def make_csr_graph_from_edges(nodes_edges):
+    """
+    make the directed graph as a scipy.sparse CSR matrix from the edges of load_edges
+    return the graph and the list of the latlons of the nodes (the index of the list is the node id)
+    """
+    node_to_id = {}
+    starts, ends, distances = [], [], []
+    for start_latlon, end_latlon, distance in nodes_edges[1:]:
+        starts.append(node_to_id.setdefault(start_latlon, len(node_to_id)))
+        ends.append(node_to_id.setdefault(end_latlon, len(node_to_id)))
+        distances.append(distance)
+    n_nodes = len(node_to_id)
+    starts, ends, distances = np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64), np.array(distances, dtype=float)
+
+    # as in nx.DiGraph, the last edge overwrites the former ones between the same nodes (instead of summing them up)
+    _, last = np.unique((starts * n_nodes + ends)[::-1], return_index=True)
+    last = len(starts) - 1 - last
+    graph = scipy.sparse.csr_matrix((distances[last], (starts[last], ends[last])), shape=(n_nodes, n_nodes))
+    return graph, list(node_to_id.keys())
+
+def make_csr_graph(data_dir):
+    """
+    make the directed graph of make_graph as a scipy.sparse CSR matrix
+    """
+    nodes_edges = load_edges(data_dir)
+    # the edges are added only for the lines of edge_adj.txt as in make_graph
+    with open(pathlib.Path(data_dir) / "edge_adj.txt", "r") as f:
+        n_edges = sum(1 for _ in f)
+    return make_csr_graph_from_edges(nodes_edges[:n_edges+1])
+
+def make_node_to_state(G, n_states, grid, db_path=None):
     """
     make a mapping from node to state
-    mapping is based on the shortest euclidean distance
+    the states of all the nodes are found at once by grid.latlons_to_states
+    return the array of the states of the nodes in the order of G (-1 if the node is out of the grid)
+    node_to_state is also written to db_path if it is given
     """
 
-    with sqlite3.connect(db_path) as conn:
-        c = conn.cursor()
-        c.execute("DROP TABLE IF EXISTS node_to_state")
-        c.execute("CREATE TABLE IF NOT EXISTS node_to_state (node text, state integer, PRIMARY KEY (node))")
+    nodes = list(G)
+    node_states = grid.latlons_to_states([node[0] for node in nodes], [node[1] for node in nodes])
+    if db_path is not None:
+        with sqlite3.connect(db_path) as conn:
+            c = conn.cursor()
+            c.execute("DROP TABLE IF EXISTS node_to_state")
+            c.execute("CREATE TABLE IF NOT EXISTS node_to_state (node text, state integer, PRIMARY KEY (node))")
+            c.executemany("INSERT INTO node_to_state VALUES (?, ?)", [(str(node), state if state >= 0 else None) for node, state in zip(nodes, node_states.tolist())])
+
+    return node_states
 
-        for node in G:
-            state = latlon_to_state(*node)
-            c.execute("INSERT INTO node_to_state VALUES (?, ?)", (str(node), state))
+def make_state_to_nodes(node_states, n_states):
+    """
+    the CSR index from state to nodes: the nodes in state i are nodes[indptr[i]:indptr[i+1]] (in the order of the node id)
+    """
+    node_states = np.asarray(node_states)
+    in_grid = np.where(node_states >= 0)[0]
+    nodes = in_grid[np.argsort(node_states[in_grid], kind="stable")]
+    indptr = np.zeros(n_states+1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(node_states[in_grid], minlength=n_states))
+    return indptr, nodes
 
 
 def state_pair_to_latlon_routes(state_pair, cursor):
@@ -100,13 +149,13 @@ def state_pair_to_latlon_routes(state_pair, cursor):
     
     latlon_routes = []
     for start_node in start_nodes:
-        start_node = eval(start_node[0])
+        start_node = ast.literal_eval(start_node[0])
         for end_node in end_nodes:
-            end_node = eval(end_node[0])
+            end_node = ast.literal_eval(end_node[0])
             c = cursor.execute("SELECT * FROM paths WHERE start_node=? AND end_node=?", (str(start_node), str(end_node)))
             latlon_route = c.fetchone()
             if latlon_route is not None:
-                latlon_route = eval(latlon_route[2])
+                latlon_route = ast.literal_eval(latlon_route[2])
                 latlon_routes.append(latlon_route)
     
     return latlon_routes
@@ -127,108 +176,201 @@ def check_node_in_state(cursor, state):
     if len(node) == 0:
         return None
     else:
-        return [eval(n[0]) for n in node]
+        return [ast.literal_eval(n[0]) for n in node]
+
 
+# the graph shared with the forked workers of make_state_pair_to_state_route
+_shared_route_graph = None
+
+def process_state_i(i, graph=None, node_states=None, truncate=None, end_states=None, limit=np.inf, state_to_nodes=None):
+    """
+    find the shortest path from state i to all other states (or to end_states if given)
+    one multi-source dijkstra from the nodes in state i gives the shortest path to every node, and the nearest node of each state j is its end node
+    if a node in state i has a direct road to a node in state j, the state route is [i, j]
+    node_states: the array of the states of the nodes (-1 if the node is out of the grid)
+    limit: the search stops at this length, and the farther states have no route
+    state_to_nodes: the index of make_state_to_nodes (the nodes in state i are searched over node_states if None)
+    return the list of (i, j, state_route)
+    """
+    if graph is None:
+        graph, node_states, truncate, state_to_nodes = _shared_route_graph
 
-def process_state_i(i, states, db_path, latlon_to_state, DG, truncate):
+    if state_to_nodes is None:
+        start_nodes = np.where(node_states == i)[0]
+    else:
+        indptr, nodes = state_to_nodes
+        start_nodes = nodes[indptr[i]:indptr[i+1]] if i+1 < len(indptr) else nodes[:0]
+    if len(start_nodes) == 0:
+        return []
+    lengths, predecessors, _ = scipy.sparse.csgraph.dijkstra(graph, indices=start_nodes, min_only=True, return_predecessors=True, limit=limit)
+
+    # the nearest reachable node of each state (ties are broken by the node id)
+    end_nodes = np.where(np.isfinite(lengths) & (node_states >= 0) & (node_states != i))[0]
+    if end_states is not None:
+        end_nodes = end_nodes[np.isin(node_states[end_nodes], end_states)]
+    if len(end_nodes) == 0:
+        return []
+    end_nodes = end_nodes[np.lexsort((end_nodes, lengths[end_nodes], node_states[end_nodes]))]
+    end_nodes = end_nodes[np.r_[True, node_states[end_nodes][1:] != node_states[end_nodes][:-1]]]
+
+    # the states that have a direct road from state i
+    direct_states = set(node_states[graph[start_nodes].indices].tolist())
+
+    state_routes = []
+    for end_node in end_nodes.tolist():
+        j = int(node_states[end_node])
+        if j in direct_states:
+            state_routes.append((i, j, [i, j]))
+            continue
+
+        shortest_path = [end_node]
+        while predecessors[shortest_path[-1]] >= 0:
+            shortest_path.append(predecessors[shortest_path[-1]])
+        if len(shortest_path) >= truncate:
+            continue
+        path_states = node_states[shortest_path[::-1]]
+        state_route = path_states[np.r_[True, path_states[1:] != path_states[:-1]]].tolist()
+        state_route = [state if state >= 0 else None for state in state_route]
+        assert state_route[0] == i, f"different start point {i} {j} -> {state_route}"
+        assert state_route[-1] == j, f"different end point {i} {j} -> {state_route}"
+        state_routes.append((i, j, state_route))
+
+    return state_routes
+
+def make_state_pair_to_state_route(n_states, db_path, node_states, graph, truncate, max_workers=None):
     """
-    find the shortest path from state i to all other states
+    the state routes are written to state_edge_to_route as soon as each start state is processed
     """
 
+    global _shared_route_graph
+    node_states = np.array([state if state is not None else -1 for state in node_states], dtype=np.int64)
+    state_to_nodes = make_state_to_nodes(node_states, n_states)
+    # find the possible states as start state
+    start_states = np.where(np.diff(state_to_nodes[0]) > 0)[0].tolist()
+    print("WARNING", n_states - len(start_states), "states have no node")
+
     with sqlite3.connect(db_path) as conn:
         c = conn.cursor()
+        c.execute("DROP TABLE IF EXISTS state_edge_to_route")
+        c.execute("CREATE TABLE IF NOT EXISTS state_edge_to_route (start_state integer, end_state integer, route text, PRIMARY KEY (start_state, end_state))")
 
-        nodes = check_node_in_state(c, i)
-        # compute path from node
-        paths = []
-        for node in nodes:
-            # paths.append(nx.single_source_dijkstra_path(DG, node))
-            paths.append(nx.single_source_dijkstra(DG, node))
+        # the forked workers share the graph and the node arrays without pickling them
+        _shared_route_graph = (graph, node_states, truncate, state_to_nodes)
+        context = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+            futures = [executor.submit(process_state_i, i) for i in start_states]
+            for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+                c.executemany("INSERT INTO state_edge_to_route VALUES (?, ?, ?)", [(i, j, str(state_route)) for i, j, state_route in future.result()])
+        _shared_route_graph = None
 
-        for j in states:
 
-            if i == j:
-                continue
+def derive_route_limit(graph, truncate):
+    """
+    the bound of the search that gives the same routes as the unbounded search under truncate
+    a route of less than truncate nodes is not longer than truncate times the longest edge, so the farther nodes only make truncated routes
+    """
+    if not np.isfinite(truncate) or graph.nnz == 0:
+        return np.inf
+    return float(truncate * graph.data.max())
 
-            end_nodes = check_node_in_state(c, j)
-            if end_nodes is None:
-                # print("WARNING", j, "has no node")
-                continue
 
-            shortest_path = None
-            shortest_length = float("inf")
-            flag = False
-            # find the shortest path to end_nodes
-            for (length, path), node in zip(paths, nodes):
-                for end_node in end_nodes:
-                    # check if (node, end_node) is in DG
-                    if (node, end_node) in DG.edges:
-                        flag = True
-                        break
-                    if end_node in path:
-                        if length[end_node] < shortest_length:
-                            shortest_length = length[end_node]
-                            shortest_path = path[end_node]
-                if flag:
-                    # in this case, there is a direct road from node to end_node
-                    break
-
-            if flag:
-                state_route = [i, j]
-                assert len(state_route) == 2, f"direct road but not length 2 {i} {j} -> {state_route}"
-            else:
-                if (shortest_path is not None) and (len(shortest_path) < truncate):
-                    state_route = latlon_route_to_state_route(shortest_path, latlon_to_state)
-                    assert state_route[0] == i, f"different start point {i} {j} -> {state_route}"
-                    assert state_route[-1] == j, f"different end point {i} {j} -> {state_route}"
-                else:
-                    state_route = None
-            
-            if state_route is not None:
-                # save with pickle
-                with open(f"temp/state_routes_from_{i}_to_{j}.pkl", "wb") as f:
-                    pickle.dump(state_route, f)
-
-                # c.execute("INSERT INTO state_edge_to_route VALUES (?, ?, ?)", (i, j, str(state_routes)))
-
-def make_state_pair_to_state_route(n_states, db_path, latlon_to_state, DG, truncate):
-
-    states = list(range(n_states))
-    with sqlite3.connect(db_path) as conn:
-        c = conn.cursor()
+class RouteOracle():
+    """
+    computes the state routes on demand instead of precomputing all the pairs (which is infeasible for large n_bins)
+    a route is the same as that of make_state_pair_to_state_route, and it is computed by process_state_i when it is first requested
+    the requested pairs that share the start state are computed by one search
+    the routes (including the non-existing ones) are memoized in the LRU cache of max_cache_size and appended to the disk cache at cache_path
+    the disk cache is a flat int32 file of the records [start_state, end_state, length, *route] (length -1 if the route does not exist)
+    the reader api is the same as route_store.RouteStore
+    limit: the length at which each search stops (derive_route_limit if None), and the routes longer than it do not exist
+    the disk cache should be separated for different limits
+    """
 
-        # find the possible states as start state
-        start_states = []
-        for i in states:
-            nodes = check_node_in_state(c, i)
-            if nodes is None:
-                print("WARNING", i, "has no node")
+    def __init__(self, graph, node_states, truncate=float("inf"), cache_path=None, max_cache_size=2**20, limit=None):
+        self.graph = graph
+        self.node_states = np.array([state if state is not None else -1 for state in node_states], dtype=np.int64)
+        self.state_to_nodes = make_state_to_nodes(self.node_states, self.node_states.max()+1)
+        self.truncate = truncate
+        self.limit = derive_route_limit(graph, truncate) if limit is None else limit
+        self.cache_path = None if cache_path is None else pathlib.Path(cache_path)
+        self.max_cache_size = max_cache_size
+        self.cache = collections.OrderedDict()
+        if self.cache_path is not None and self.cache_path.exists():
+            self.load_cache()
+
+    @staticmethod
+    def from_data_dir(n_bins, data_dir, lat_range, lon_range, truncate, cache_path=None, **kwargs):
+        ranges = Grid.make_ranges_from_latlon_range_and_nbins(lat_range, lon_range, n_bins)
+        grid = Grid(ranges)
+        graph, nodes = make_csr_graph(data_dir)
+        node_states = make_node_to_state(nodes, len(grid.grids), grid)
+        return RouteOracle(graph, node_states, float("inf") if truncate == 0 else truncate, cache_path, **kwargs)
+
+    def load_cache(self):
+        records = np.fromfile(self.cache_path, dtype=np.int32)
+        cursor = 0
+        # a partially written record at the end (e.g., by an interruption) is ignored
+        while cursor + 3 <= len(records):
+            from_state, to_state, length = records[cursor:cursor+3].tolist()
+            if cursor + 3 + max(length, 0) > len(records):
+                break
+            route = records[cursor+3:cursor+3+length].tolist() if length >= 0 else None
+            self.memoize(from_state, to_state, route)
+            cursor += 3 + max(length, 0)
+
+    def memoize(self, from_state, to_state, route):
+        self.cache[(from_state, to_state)] = route
+        self.cache.move_to_end((from_state, to_state))
+        if len(self.cache) > self.max_cache_size:
+            self.cache.popitem(last=False)
+
+    def append_to_cache(self, computed_routes):
+        if self.cache_path is None or len(computed_routes) == 0:
+            return
+        records = []
+        for (from_state, to_state), route in computed_routes.items():
+            records.extend([from_state, to_state, -1] if route is None else [from_state, to_state, len(route)] + [state if state is not None else -1 for state in route])
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_path, "ab") as f:
+            f.write(np.array(records, dtype=np.int32).tobytes())
+
+    def routes(self, from_states, to_states):
+        pairs = [(int(from_state), int(to_state)) for from_state, to_state in zip(from_states, to_states)]
+        results = {}
+        missing = {}
+        for pair in pairs:
+            if pair in results:
                 continue
-            start_states.append(i)
+            if pair in self.cache:
+                self.cache.move_to_end(pair)
+                results[pair] = self.cache[pair]
+            elif pair[0] != pair[1]:
+                missing.setdefault(pair[0], set()).add(pair[1])
+            else:
+                results[pair] = None
 
-    partial_process_state_i = functools.partial(process_state_i, states=states, db_path=db_path, latlon_to_state=latlon_to_state, DG=DG, truncate=truncate)
-    # for i in tqdm.tqdm(start_states):
-        # partial_process_state_i(i)
-    
-    pathlib.Path("temp").mkdir(parents=True, exist_ok=True)
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        # iterator = executor.map(partial_process_state_i, start_states)
-        futures = [executor.submit(partial_process_state_i, i) for i in start_states]
-        for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
-            future.result()
-    
-    with sqlite3.connect(db_path) as conn:
-        c = conn.cursor()
-        c.execute("DROP TABLE IF EXISTS state_edge_to_route")
-        c.execute("CREATE TABLE IF NOT EXISTS state_edge_to_route (start_state integer, end_state integer, route text, PRIMARY KEY (start_state, end_state))")
-        # write to db
-        for i in tqdm.tqdm(start_states):
-            for j in states:
-                if pathlib.Path(f"temp/state_routes_from_{i}_to_{j}.pkl").exists():
-                    with open(f"temp/state_routes_from_{i}_to_{j}.pkl", "rb") as f:
-                        state_routes = pickle.load(f)
-                    c.execute("INSERT INTO state_edge_to_route VALUES (?, ?, ?)", (i, j, str(state_routes)))
+        # one search for each start state
+        computed_routes = {}
+        for from_state, to_states_ in missing.items():
+            for to_state in to_states_:
+                computed_routes[(from_state, to_state)] = None
+            for _, to_state, state_route in process_state_i(from_state, self.graph, self.node_states, self.truncate, end_states=list(to_states_), limit=self.limit, state_to_nodes=self.state_to_nodes):
+                computed_routes[(from_state, to_state)] = state_route
+        for pair, route in computed_routes.items():
+            self.memoize(*pair, route)
+        self.append_to_cache(computed_routes)
+        results.update(computed_routes)
+
+        return [results[pair] for pair in pairs]
+
+    def route(self, from_state, to_state):
+        return self.routes([from_state], [to_state])[0]
+
+    def has_routes(self, from_states, to_states):
+        return np.array([route is not None for route in self.routes(from_states, to_states)], dtype=bool)
 
+    def close(self):
+        pass
 
 
 def run(n_bins, data_dir, lat_range, lon_range, truncate, save_dir):
@@ -245,10 +387,10 @@ def run(n_bins, data_dir, lat_range, lon_range, truncate, save_dir):
     n_states = len(grid.grids)
 
     print("make graph")
-    DG = make_graph(data_dir)
+    graph, nodes = make_csr_graph(data_dir)
 
     print("make node_to_state")
-    make_node_to_state(DG, n_states, grid.latlon_to_state, db_path)
+    node_states = make_node_to_state(nodes, n_states, grid, db_path)
 
     print("make state_pair_to_state_route to", db_path)
-    make_state_pair_to_state_route(n_states, db_path, grid.latlon_to_state, DG, truncate)
\ No newline at end of file
+    make_state_pair_to_state_route(n_states, db_path, node_states, graph, truncate)
\ No newline at end of file
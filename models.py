@@ -17,7 +17,7 @@ class Generator(nn.Module):
         self.prefix_encoding_component = prefix_encoding_component
         self.scoring_component = scoring_component
 
-    def forward(self, x, states=None):
+    def forward(self, x, states=None, target_locations=None):
         locations = x[0]
         times = x[1]
         # encoding of each point (location, time)
@@ -29,10 +29,18 @@ class Generator(nn.Module):
         hiddens, prefix_embedding = self.prefix_encoding_component(embedding_sequence, states)
 
         # decoding to scores as probability of next location and next time
-        location, time = self.scoring_component(hiddens)
+        # when target_locations is given, the location is scored only for the targets and the negative samples (sampled softmax)
+        if target_locations is None:
+            location, time = self.scoring_component(hiddens)
+        else:
+            location, time = self.scoring_component.sampled_forward(hiddens, target_locations)
 
         return [location, time], hiddens
 
+    # the parameters whose gradients are sparse (these need an optimizer for sparse gradients)
+    def sparse_parameters(self):
+        return self.location_encoding_component.sparse_parameters() + self.scoring_component.sparse_parameters()
+
     # for pre-training
     def transition(self, class_id, class_encoder, temp_prefix_encoding_component):
         class_embedding = class_encoder(class_id)
@@ -101,13 +109,19 @@ class LocationEncodingComponent(nn.Module, metaclass=ABCMeta):
     def make_class_encoder(self):
         pass
 
+    def sparse_parameters(self):
+        return []
+
     def start_idx(self):
         return TrajectoryDataset.start_idx(self.n_locations)
 
 class MatrixLocationEncodingComponent(LocationEncodingComponent):
-    def __init__(self, n_locations, dim):
+    def __init__(self, n_locations, dim, sparse=False):
         super(MatrixLocationEncodingComponent, self).__init__()
-        self.embedding_matrix = nn.Embedding(TrajectoryDataset.vocab_size(n_locations), dim)
+        # sparse=True makes the gradient of the embedding matrix sparse (only the rows of the input locations)
+        # this is only for non-DP training: the per-sample norms computed from the rows of the input locations are the same as the dense ones (so clipping is not changed),
+        # but the Gaussian noise of DP-SGD is added to all the rows, so the noisy gradient is dense anyway
+        self.embedding_matrix = nn.Embedding(TrajectoryDataset.vocab_size(n_locations), dim, sparse=sparse)
         self.dim = dim
         self.n_locations = n_locations
 
@@ -115,6 +129,9 @@ class MatrixLocationEncodingComponent(LocationEncodingComponent):
     def forward(self, location):
         return self.embedding_matrix(location)
 
+    def sparse_parameters(self):
+        return [self.embedding_matrix.weight] if self.embedding_matrix.sparse else []
+
     # making a compatible temporary component which encodes class for pre-training
     # warning: this is not currently trainable
     def make_class_encoder(self, privtree):
@@ -247,11 +264,36 @@ class PrefixEncodingComponent(nn.Module, metaclass=ABCMeta):
         pass
     
 
+def fused_gru_parameters(gru_cell):
+    '''
+    the parameters of nn.GRU (one layer, batch_first) that correspond to DPGRUCell
+    both use the gate order (r, z, n) and n = tanh(W_in x + b_in + r * (W_hn h + b_hn)), so the weights are the same
+    '''
+    return {"weight_ih_l0": gru_cell.ih.weight, "weight_hh_l0": gru_cell.hh.weight, "bias_ih_l0": gru_cell.ih.bias, "bias_hh_l0": gru_cell.hh.bias}
+
+def dp_gru_cell_to_gru(gru_cell):
+    gru = nn.GRU(gru_cell.input_size, gru_cell.hidden_size, batch_first=True).to(gru_cell.ih.weight.device)
+    gru.load_state_dict({name: param.detach() for name, param in fused_gru_parameters(gru_cell).items()})
+    return gru
+
+def gru_to_dp_gru_cell(gru):
+    assert gru.num_layers == 1 and not gru.bidirectional, "only a single-layer unidirectional GRU is supported"
+    gru_cell = DPGRUCell(gru.input_size, gru.hidden_size, True).to(gru.weight_ih_l0.device)
+    gru_cell.load_state_dict({"ih.weight": gru.weight_ih_l0.detach(), "ih.bias": gru.bias_ih_l0.detach(), "hh.weight": gru.weight_hh_l0.detach(), "hh.bias": gru.bias_hh_l0.detach()})
+    return gru_cell
+
 class GRUPrefixEncodingComponent(PrefixEncodingComponent):
     def __init__(self, input_dim, hidden_dim, n_layers, bidirectional):
         super(GRUPrefixEncodingComponent, self).__init__()
         self.hidden_dim = hidden_dim
         self.gru_cell = DPGRUCell(input_dim, hidden_dim, True)
+        # the fused kernel is run with the parameters of gru_cell by torch.func.functional_call
+        # this is not registered as a submodule so that the parameters (and checkpoints) are only those of gru_cell
+        object.__setattr__(self, "fused_gru", nn.GRU(input_dim, hidden_dim, batch_first=True, device="meta"))
+
+    def requires_per_sample_gradients(self):
+        # opacus captures the activations of each call of the linear layers by the forward hooks during training
+        return torch.is_grad_enabled() and self.training and len(self.gru_cell.ih._forward_hooks) > 0
 
     def forward(self, embedding_sequence, hidden_states=None):
         batch_size, seq_len, _ = embedding_sequence.shape
@@ -262,10 +304,21 @@ class GRUPrefixEncodingComponent(PrefixEncodingComponent):
         else:
             hidden = torch.zeros(batch_size, self.hidden_dim).to(embedding_sequence.device)
 
-        # recurrently encode the prefix
+        # fused kernel when per-sample gradients are not needed (evaluation, sampling, non-DP training)
+        if not self.requires_per_sample_gradients():
+            hiddens, hidden = torch.func.functional_call(self.fused_gru, fused_gru_parameters(self.gru_cell), (embedding_sequence, hidden.unsqueeze(0).contiguous()))
+            return hiddens, hidden[0]
+
+        # the input-to-hidden projections of all the steps at once, and only the hidden-to-hidden recurrence in the loop (the same computation as DPGRUCell)
+        gates_x = self.gru_cell.ih(embedding_sequence)
+        r_x, z_x, n_x = torch.split(gates_x, self.hidden_dim, -1)
         hiddens = []
         for i in range(seq_len):
-            hidden = self.gru_cell(embedding_sequence[:,i,:], hidden)
+            r_h, z_h, n_h = torch.split(self.gru_cell.hh(hidden), self.hidden_dim, -1)
+            r = torch.sigmoid(r_x[:,i,:] + r_h)
+            z = torch.sigmoid(z_x[:,i,:] + z_h)
+            n = torch.tanh(n_x[:,i,:] + r * n_h)
+            hidden = (1 - z) * n + z * hidden
             hiddens.append(hidden)
         hiddens = torch.stack(hiddens, dim=1)
         return hiddens, hidden
@@ -284,18 +337,53 @@ class ScoringComponent(nn.Module, metaclass=ABCMeta):
     def to_location_distribution(self, locations, target=-1):
         return locations[:,target,:]
 
+    def sparse_parameters(self):
+        return []
+
 class LinearScoringComponent(ScoringComponent):
-    def __init__(self, hidden_dim, n_locations, n_times):
+    def __init__(self, hidden_dim, n_locations, n_times, n_negative_samples=0):
         super(LinearScoringComponent, self).__init__()
         self.fc_location = nn.Linear(hidden_dim, n_locations)
         self.fc_time = nn.Linear(hidden_dim, n_times)
         self.multitask = False
+        self.n_negative_samples = n_negative_samples
 
     def forward(self, prefix_embedding):
         location = F.log_softmax(self.fc_location(prefix_embedding), dim=-1)
         time = F.log_softmax(self.fc_time(prefix_embedding), dim=-1)
         return location, time
 
+    def sampled_forward(self, prefix_embedding, target_locations):
+        '''
+        sampled softmax for training: the log distribution over the target (index 0) and n_negative_samples locations
+        the negative samples are uniformly drawn and shared in the batch, so the correction of the sampling probability is constant and cancels in the softmax
+        the rows of fc_location are looked up by F.embedding with sparse=True, so the gradient of fc_location.weight only has the rows of the targets and the negative samples
+        this is only for non-DP training: the per-sample norms computed from these rows are valid for clipping,
+        but opacus computes per-sample gradients by the hooks of nn.Linear, which do not see these look-ups, and the noise of DP-SGD is dense anyway
+        '''
+        n_locations = self.fc_location.out_features
+        negative_locations = torch.randint(n_locations, (self.n_negative_samples,), device=prefix_embedding.device)
+        # the ignored targets are looked up as 0 and ignored by the loss
+        targets = target_locations.masked_fill(target_locations >= n_locations, 0)
+
+        target_logits = (prefix_embedding * F.embedding(targets, self.fc_location.weight, sparse=True)).sum(dim=-1, keepdim=True) + self.fc_location.bias[targets].unsqueeze(-1)
+        negative_logits = torch.matmul(prefix_embedding, F.embedding(negative_locations, self.fc_location.weight, sparse=True).T) + self.fc_location.bias[negative_locations]
+        # remove the negative samples that hit the target
+        negative_logits = negative_logits.masked_fill(negative_locations == targets.unsqueeze(-1), float("-inf"))
+
+        location = F.log_softmax(torch.cat([target_logits, negative_logits], dim=-1), dim=-1)
+        time = F.log_softmax(self.fc_time(prefix_embedding), dim=-1)
+        return location, time
+
+    # the target of the output of sampled_forward is always 0 except for the ignored ones
+    def to_sampled_target(self, target_locations):
+        n_locations = self.fc_location.out_features
+        ignored = target_locations == TrajectoryDataset.ignore_idx(n_locations)
+        return torch.zeros_like(target_locations).masked_fill(ignored, TrajectoryDataset.ignore_idx(self.n_negative_samples+1))
+
+    def sparse_parameters(self):
+        return [self.fc_location.weight] if self.n_negative_samples > 0 else []
+
 class DotScoringComponent(ScoringComponent):
     def __init__(self, hidden_dim, n_locations, n_times, location_encoding_component, multitask, consistent):
         super(DotScoringComponent, self).__init__()
@@ -439,15 +527,15 @@ def compute_loss_generator(target_locations, target_times, output_locations, out
     return loss
 
 
-def construct_generator(model_name, n_locations, n_times, location_embedding_dim, time_embedding_dim, memory_hidden_dim, multitask, consistent):
+def construct_generator(model_name, n_locations, n_times, location_embedding_dim, time_embedding_dim, memory_hidden_dim, multitask, consistent, sparse_embedding=False, n_negative_samples=0):
 
     time_encoding_component = MatrixTimeEncodingComponent(n_times-1, time_embedding_dim)
     input_dim = location_embedding_dim + time_embedding_dim
     prefix_encoding_component = GRUPrefixEncodingComponent(input_dim, memory_hidden_dim, 1, False)
     
     if model_name == "baseline":
-        location_encoding_component = MatrixLocationEncodingComponent(n_locations, location_embedding_dim)
-        scoring_component = LinearScoringComponent(memory_hidden_dim, n_locations, n_times)
+        location_encoding_component = MatrixLocationEncodingComponent(n_locations, location_embedding_dim, sparse_embedding)
+        scoring_component = LinearScoringComponent(memory_hidden_dim, n_locations, n_times, n_negative_samples)
     elif model_name == "hrnet":
         location_encoding_component = LinearHierarchicalLocationEncodingComponent(n_locations, location_embedding_dim)
         scoring_component = DotScoringComponent(memory_hidden_dim, n_locations, n_times, location_encoding_component, multitask, consistent)
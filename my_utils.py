@@ -14,6 +14,7 @@ from grid import Grid, QuadTree, priv_tree
 import subprocess
 import hydra
 import os
+import concurrent.futures
 
 
 def get_original_dataset_name(dataset):
@@ -332,6 +333,60 @@ def plot_density(counts, n_locations, save_path, anotation=None, coef=1):
         plt.savefig(save_path)
         plt.close()
 
+# the process that renders the figures in the background
+_plot_executor = None
+
+def get_plot_executor():
+    global _plot_executor
+    if _plot_executor is None:
+        _plot_executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+    return _plot_executor
+
+
+class DensityPlotWriter():
+    '''
+    collects the distributions to be plotted and dumps them into a single compressed npz file
+    the figures are rendered from the npz file by render_densities (in a background process if render is True)
+    '''
+    def __init__(self, save_path, render=False):
+        self.save_path = pathlib.Path(save_path)
+        self.render = render
+        self.densities = {}
+        self.meta = {}
+
+    def add(self, counts, n_locations, name, anotation=None, coef=1):
+        if type(counts) is Counter:
+            counts_ = np.zeros(n_locations)
+            for key, value in counts.items():
+                counts_[key] = value
+            counts = counts_
+        elif type(counts) is torch.Tensor:
+            counts = counts.detach().cpu().numpy()
+        self.densities[name] = np.asarray(counts, dtype=float)
+        self.meta[name] = {"n_locations": int(n_locations), "anotation": None if anotation is None else int(anotation), "coef": float(coef)}
+
+    def close(self):
+        # return the future of the rendering if render is True
+        if len(self.densities) == 0:
+            return None
+        self.save_path.parent.mkdir(exist_ok=True, parents=True)
+        np.savez_compressed(self.save_path, __meta__=np.array(json.dumps(self.meta)), **self.densities)
+        self.densities = {}
+        self.meta = {}
+        if self.render:
+            return get_plot_executor().submit(render_densities, self.save_path)
+
+
+def render_densities(npz_path, img_dir=None):
+    npz_path = pathlib.Path(npz_path)
+    img_dir = npz_path.parent if img_dir is None else pathlib.Path(img_dir)
+    img_dir.mkdir(exist_ok=True, parents=True)
+    with np.load(npz_path) as densities:
+        meta = json.loads(str(densities["__meta__"]))
+        for name, param in meta.items():
+            plot_density(densities[name], param["n_locations"], img_dir / f"{name}.png", anotation=param["anotation"], coef=param["coef"])
+
+
 def add_noise(values, sensitivity, epsilon):
     # add Laplace noise
     if epsilon == float("inf"):
@@ -435,19 +490,19 @@ def save(save_path, trajectories, option="w"):
     "if a record is string that includes "," or " ", it causes error"
     with open(save_path, option) as f:
         for trajectory in trajectories:
+            line = []
             for record in trajectory:
                 if record == str:
                     assert "," not in record, f"record {record} includes ','"
                     assert " " not in record, f"record {record} includes ' '"
-                    f.write(f"{record},")
+                    line.append(f"{record}")
                 elif hasattr(record, "__iter__"):
-                    f.write(" ".join([str(v) for v in record]))
-                    f.write(",")
+                    line.append(" ".join([str(v) for v in record]))
                 else:
-                    f.write(f"{record},")
-            # remove last ","
-            f.seek(f.tell()-1)
-            f.write("\n")
+                    line.append(f"{record}")
+            # the line is written at once instead of seeking back the last "," because seek is ignored in the append mode
+            if len(line) > 0:
+                f.write(",".join(line) + "\n")
     # send(save_path)
 
 def compute_num_params(model):
@@ -466,37 +521,69 @@ def compute_num_params(model):
 
     return num_params
 
+def sample_lines(save_path, size=0, seed=0):
+    # the mask of the lines sampled by np.random.choice with the seed (None if size is 0)
+    if size == 0:
+        return None
+    # set seed
+    np.random.seed(seed)
+    # count the number of lines in the text
+    with open(save_path, "r") as f:
+        for i, _ in enumerate(f):
+            pass
+    n_lines = i + 1
+    # sample lines
+    indice = np.random.choice(n_lines, size=size, replace=False)
+    mask = np.zeros(n_lines, dtype=bool)
+    mask[indice] = True
+    return mask
+
+def parse_line(line):
+    trajectory = []
+    for record in line.split(","):
+        record = record.strip()
+        if record == "":
+            continue
+        if " " in record:
+            trajectory.append([float(v) for v in record.split(" ")])
+        else:
+            trajectory.append(int(float(record)))
+    return trajectory
+
 def load(save_path, size=0, seed=0):
     # get(save_path)
-    if size != 0:
-        # set seed
-        np.random.seed(seed)
-        # count the number of lines in the text
-        with open(save_path, "r") as f:
-            for i, _ in enumerate(f):
-                pass
-        n_lines = i + 1
-        # sample lines
-        indice = np.random.choice(n_lines, size=size, replace=False)
-    else:
-        indice = None
+    mask = sample_lines(save_path, size, seed)
 
     trajectories = []
     with open(save_path, "r") as f:
-        for i, line in enumerate(f.readlines()):
-            if indice is not None and i not in indice:
+        for i, line in enumerate(f):
+            if mask is not None and not mask[i]:
                 continue
-            trajectory = []
-            for record in line.split(","):
-                record = record.strip()
-                if record == "":
-                    continue
-                if " " in record:
-                    trajectory.append([float(v) for v in record.split(" ")])
-                else:
-                    trajectory.append(int(float(record)))
-            trajectories.append(trajectory)
+            trajectories.append(parse_line(line))
     return trajectories
+
+def load_chunks(save_path, size=0, seed=0, max_chunk_bytes=2**30):
+    """
+    the streaming version of load
+    yields the chunks of the trajectories in the order of the lines, where the text of a chunk is at most max_chunk_bytes (or one line)
+    the sampled lines are the same as load
+    """
+    mask = sample_lines(save_path, size, seed)
+
+    chunk = []
+    chunk_bytes = 0
+    with open(save_path, "r") as f:
+        for i, line in enumerate(f):
+            if mask is not None and not mask[i]:
+                continue
+            if len(chunk) > 0 and chunk_bytes + len(line) > max_chunk_bytes:
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(parse_line(line))
+            chunk_bytes += len(line)
+    if len(chunk) > 0:
+        yield chunk
     
 
 def load_latlon_range(dataset):
@@ -0,0 +1,13 @@
+import argparse
+from my_utils import render_densities
+
+# render the density figures from the npz files dumped by DensityPlotWriter
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('npz_paths', type=str, nargs='+')
+    parser.add_argument('--img_dir', type=str, default=None)
+    args = parser.parse_args()
+
+    for npz_path in args.npz_paths:
+        render_densities(npz_path, args.img_dir)
+        print("rendered", npz_path)
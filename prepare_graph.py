@@ -2,6 +2,8 @@ import osmnx as ox
 import os
 import sys
 import geopandas as gpd
+import numpy as np
+import shapely
 
 # sys.path.append("../../priv_traj_gen")
 from my_utils import load, load_latlon_range
@@ -58,30 +60,51 @@ def make_edge_property_file(gdf_edges, save_dir):
     road_types = set(gdf_edges["highway"])
     road_type_to_id = {road_type:i for i, road_type in enumerate(road_types)}
 
+    # the geometries are serialized at once (with the full precision as str(geometry))
+    wkts = shapely.to_wkt(np.asarray(gdf_edges["geometry"]), rounding_precision=-1)
+    road_types = [road_type_to_id[road_type] for road_type in gdf_edges["highway"]]
     with open(os.path.join(save_dir, "edge_property.txt"), "w") as f:
-        for i, row in gdf_edges.iterrows():
-            wkt = row["geometry"]
-            road_type = road_type_to_id[row["highway"]]
-            length = row["length"]
-            f.write(f'{i+1},{road_type},0,{length},"{wkt}"\n')
+        f.write("".join([f'{i+1},{road_type},0,{length},"{wkt}"\n' for i, road_type, length, wkt in zip(gdf_edges.index, road_types, gdf_edges["length"].tolist(), wkts)]))
+
+def make_edge_adj_csr(gdf_edges):
+    """
+    the successors of each edge (the edges whose u is the v of the edge) in the order of the rows
+    the edges are sorted by u once and the successors are found by binary search, instead of filtering all the edges for each edge
+    return indptr and the fids of the successors in the CSR format
+    """
+    us = np.asarray(gdf_edges["u"])
+    vs = np.asarray(gdf_edges["v"])
+    fids = np.asarray(gdf_edges["fid"])
+
+    # stable sort keeps the order of the rows in each group
+    order = np.argsort(us, kind="stable")
+    sorted_us = us[order]
+    starts = np.searchsorted(sorted_us, vs, side="left")
+    counts = np.searchsorted(sorted_us, vs, side="right") - starts
+
+    indptr = np.zeros(len(us)+1, dtype=np.int64)
+    indptr[1:] = np.cumsum(counts)
+    positions = np.repeat(starts, counts) + np.arange(indptr[-1]) - np.repeat(indptr[:-1], counts)
+    return indptr, fids[order[positions]]
 
 def make_edge_adj_file(gdf_edges, save_dir):
     # ,2,3,-1,-1
     # line id-1: adj1, adj2, adj3, adj4, -1, ..., -1
     # -1 means no adj
+    # the same adjacency is also saved as CSR in edge_adj.npz (the successors of the line i are indices[indptr[i]:indptr[i+1]])
 
-    adjss = []
-    for i, row in gdf_edges.iterrows():
-        is_end_node = row["v"]
-        adjs = gdf_edges[gdf_edges["u"] == is_end_node]["fid"]
-        adjs = [adj for adj in adjs.tolist()]
-        adjss.append(adjs)
+    indptr, indices = make_edge_adj_csr(gdf_edges)
+    np.savez(os.path.join(save_dir, "edge_adj.npz"), indptr=indptr, indices=indices)
 
-    max_num_adjs = max([len(adjs) for adjs in adjss])
+    counts = np.diff(indptr)
+    max_num_adjs = counts.max()
+    adjss = np.full((len(counts), max_num_adjs), -1, dtype=np.int64)
+    adjss[np.arange(max_num_adjs) < counts[:, None]] = indices
     with open(os.path.join(save_dir, "edge_adj.txt"), "w") as f:
-        for adjs in adjss:
-            adjs.extend([-1]*(max_num_adjs-len(adjs)))
-            f.write("," + ",".join([str(adj) for adj in adjs])+"\n")
+        if max_num_adjs == 0:
+            f.write(",\n" * len(counts))
+        else:
+            np.savetxt(f, adjss, fmt=",%d", delimiter="")
 
 
 def make_mtnet_training_data(data_dir, save_dir):
@@ -0,0 +1,220 @@
+import ast
+import json
+import os
+import pathlib
+import sqlite3
+import numpy as np
+import tqdm
+
+# a route store is a directory of two .npy files that are memory-mapped by the reader
+# states.npy: the flat array of the states of all the routes
+# index.npy: the (n_states, n_states, 2) int64 table of (offset, length) of the route from a state to a state in states.npy (length 0 if the route does not exist)
+# source.json: the mtime and the size of paths.db the store is exported from
+STATES_NAME = "states.npy"
+INDEX_NAME = "index.npy"
+SOURCE_NAME = "source.json"
+
+
+def states_dtype(n_states):
+    # int16 is enough up to n_bins=179
+    return np.int16 if n_states <= np.iinfo(np.int16).max else np.int32
+
+
+class RouteStore():
+    """
+    reader of the route store
+    the states out of the grid (None in state_edge_to_route) are -1
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = pathlib.Path(store_dir)
+        self.states = np.load(self.store_dir / STATES_NAME, mmap_mode="r")
+        self.index = np.load(self.store_dir / INDEX_NAME, mmap_mode="r")
+        self.n_states = self.index.shape[0]
+
+    def route(self, from_state, to_state):
+        """
+        return the route from from_state to to_state as a list of states (None if the route does not exist)
+        """
+        offset, length = self.index[from_state, to_state]
+        if length == 0:
+            return None
+        return self.states[offset:offset+length].tolist()
+
+    def routes(self, from_states, to_states):
+        """
+        batched version of route
+        """
+        entries = self.index[np.asarray(from_states, dtype=np.int64), np.asarray(to_states, dtype=np.int64)]
+        return [self.states[offset:offset+length].tolist() if length > 0 else None for offset, length in entries.tolist()]
+
+    def has_routes(self, from_states, to_states):
+        return self.index[np.asarray(from_states, dtype=np.int64), np.asarray(to_states, dtype=np.int64), 1] > 0
+
+    def close(self):
+        pass
+
+
+class SqliteRouteStore():
+    """
+    the reader api on the state_edge_to_route table of paths.db (make_pair_to_route)
+    """
+
+    def __init__(self, db_path):
+        self.db_path = pathlib.Path(db_path)
+        self.conn = sqlite3.connect(self.db_path)
+
+    def route(self, from_state, to_state):
+        c = self.conn.execute("SELECT route FROM state_edge_to_route WHERE start_state=? AND end_state=?", (int(from_state), int(to_state)))
+        route = c.fetchone()
+        if route is None:
+            return None
+        route = ast.literal_eval(route[0])
+        return route if len(route) > 0 else None
+
+    def routes(self, from_states, to_states):
+        return [self.route(from_state, to_state) for from_state, to_state in zip(from_states, to_states)]
+
+    def has_routes(self, from_states, to_states):
+        return np.array([route is not None for route in self.routes(from_states, to_states)], dtype=bool)
+
+    def close(self):
+        self.conn.close()
+
+
+class RouteStoreWriter():
+    """
+    writer of the route store
+    the states are streamed to a temporary file and the index table is a memory-mapped file so that the memory usage does not depend on the number of routes
+    the store is moved to store_dir when it is closed
+    """
+
+    def __init__(self, store_dir, n_states):
+        self.store_dir = pathlib.Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.n_states = n_states
+        self.dtype = states_dtype(n_states)
+        self.states_tmp_path = self.store_dir / f"{STATES_NAME}.{os.getpid()}.tmp"
+        self.index_tmp_path = self.store_dir / f"{INDEX_NAME}.{os.getpid()}.tmp"
+        self.states_file = open(self.states_tmp_path, "wb")
+        self.index = np.lib.format.open_memmap(self.index_tmp_path, mode="w+", dtype=np.int64, shape=(n_states, n_states, 2))
+        self.n_written = 0
+
+    def add(self, from_state, to_state, route):
+        route = np.array([state if state is not None else -1 for state in route], dtype=self.dtype)
+        route.tofile(self.states_file)
+        self.index[from_state, to_state] = (self.n_written, len(route))
+        self.n_written += len(route)
+
+    def close(self):
+        self.states_file.close()
+        self.index.flush()
+        del self.index
+
+        # convert the raw states into .npy in chunks
+        states_path = self.store_dir / f"{STATES_NAME}.{os.getpid()}.npy.tmp"
+        if self.n_written == 0:
+            with open(states_path, "wb") as f:
+                np.save(f, np.zeros(0, dtype=self.dtype))
+        else:
+            raw_states = np.memmap(self.states_tmp_path, dtype=self.dtype, mode="r", shape=(self.n_written,))
+            states = np.lib.format.open_memmap(states_path, mode="w+", dtype=self.dtype, shape=(self.n_written,))
+            chunk_size = 2**24
+            for start in range(0, self.n_written, chunk_size):
+                states[start:start+chunk_size] = raw_states[start:start+chunk_size]
+            states.flush()
+            del states, raw_states
+        self.states_tmp_path.unlink()
+
+        os.replace(states_path, self.store_dir / STATES_NAME)
+        os.replace(self.index_tmp_path, self.store_dir / INDEX_NAME)
+
+
+def infer_n_states(db_path):
+    # the states are on the square grid of (n_bins+2)*(n_bins+2)
+    with sqlite3.connect(db_path) as conn:
+        max_state = conn.execute("SELECT MAX(MAX(start_state), MAX(end_state)) FROM state_edge_to_route").fetchone()[0]
+    max_state = -1 if max_state is None else max_state
+    return int(np.ceil(np.sqrt(max_state+1))) ** 2
+
+
+def make_source_info(db_path):
+    stat = pathlib.Path(db_path).stat()
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def is_exported_from(store_dir, db_path):
+    """
+    whether the route store in store_dir is exported from the current paths.db (False if paths.db is rebuilt after the export)
+    """
+    store_dir = pathlib.Path(store_dir)
+    if not (store_dir / INDEX_NAME).exists() or not (store_dir / SOURCE_NAME).exists():
+        return False
+    with open(store_dir / SOURCE_NAME, "r") as f:
+        return json.load(f) == make_source_info(db_path)
+
+
+def export_route_db(db_path, store_dir, n_states=None):
+    """
+    export the state_edge_to_route table of paths.db to the route store
+    n_states: the number of states of the grid (inferred from the largest state if None)
+    the routes are parsed by ast.literal_eval instead of eval
+    the mtime and the size of paths.db are recorded in source.json to detect the rebuild of paths.db
+    """
+    source_info = make_source_info(db_path)
+    if n_states is None:
+        n_states = infer_n_states(db_path)
+    writer = RouteStoreWriter(store_dir, n_states)
+    with sqlite3.connect(db_path) as conn:
+        c = conn.execute("SELECT start_state, end_state, route FROM state_edge_to_route")
+        for from_state, to_state, route in tqdm.tqdm(c):
+            route = ast.literal_eval(route)
+            if len(route) > 0:
+                writer.add(from_state, to_state, route)
+    writer.close()
+    with open(pathlib.Path(store_dir) / SOURCE_NAME, "w") as f:
+        json.dump(source_info, f)
+    return RouteStore(store_dir)
+
+
+def match_routes(store, states, starts, ends):
+    """
+    whether the route from states[start] to states[end] is the same as states[start:end+1] for each pair of start and end
+    states: the flat int array of the states of the trajectories
+    the route store is compared by the index table without materializing the routes, and the other stores are queried once per distinct pair
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if len(starts) == 0:
+        return np.zeros(0, dtype=bool)
+    from_states, to_states = states[starts], states[ends]
+    lengths = ends - starts + 1
+
+    if isinstance(store, RouteStore):
+        offsets, route_lengths = store.index[from_states, to_states].T
+        matched = route_lengths == lengths
+        candidates = np.flatnonzero(matched)
+        if len(candidates) > 0:
+            # compare the states of the candidates elementwise
+            candidate_lengths = lengths[candidates]
+            positions = np.arange(candidate_lengths.sum()) - np.repeat(np.cumsum(candidate_lengths) - candidate_lengths, candidate_lengths)
+            equal = states[np.repeat(starts[candidates], candidate_lengths) + positions] == store.states[np.repeat(offsets[candidates], candidate_lengths) + positions]
+            n_mismatches = np.bincount(np.repeat(np.arange(len(candidates)), candidate_lengths), weights=~equal, minlength=len(candidates))
+            matched[candidates] = n_mismatches == 0
+        return matched
+
+    pairs, inverse = np.unique(np.stack([from_states, to_states], axis=1), axis=0, return_inverse=True)
+    routes = store.routes(pairs[:, 0], pairs[:, 1])
+    return np.array([routes[i] == states[start:end+1].tolist() for i, start, end in zip(inverse.reshape(-1).tolist(), starts.tolist(), ends.tolist())], dtype=bool)
+
+
+def open_route_store(path):
+    """
+    path: the directory of the route store or paths.db (or an opened store or a route oracle, which is returned as is)
+    """
+    if hasattr(path, "routes"):
+        return path
+    path = pathlib.Path(path)
+    if path.is_dir():
+        return RouteStore(path)
+    return SqliteRouteStore(path)
@@ -0,0 +1,97 @@
+import unittest
+import sys
+import numpy as np
+import networkx as nx
+sys.path.append('./')
+import data_post_processing
+from grid import Grid
+
+class DataPostProcessingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # a random road network around the grid with the coordinates of osmnx ('y': lat, 'x': lon)
+        self.lat_range, self.lon_range = [39.8, 40.0], [116.2, 116.5]
+        rng = np.random.default_rng(0)
+        self.G = nx.MultiDiGraph()
+        for node in range(60):
+            self.G.add_node(node, y=rng.uniform(*self.lat_range), x=rng.uniform(*self.lon_range))
+        for _ in range(200):
+            u, v = rng.choice(60, 2, replace=False).tolist()
+            self.G.add_edge(u, v, length=float(rng.uniform(100, 1000)))
+
+    def test_graph_to_csr(self):
+        G = nx.MultiDiGraph()
+        G.add_edge("a", "b", length=5.)
+        G.add_edge("a", "b", length=3.)
+        G.add_edge("b", "c", length=1.)
+        G.add_node("d")
+        graph, nodes = data_post_processing.graph_to_csr(G, "length")
+        self.assertEqual(nodes, ["a", "b", "c", "d"])
+        # the minimum length of the parallel edges
+        self.assertEqual(graph[0, 1], 3.)
+        self.assertEqual(graph[1, 0], 0.)
+        self.assertEqual(graph.nnz, 2)
+
+        # both directions for the undirected graph, and the weight is 1 if the attribute does not exist
+        graph, nodes = data_post_processing.graph_to_csr(nx.Graph([(0, 1), (1, 2)]), "length")
+        self.assertEqual(graph.toarray().tolist(), [[0, 1, 0], [1, 0, 1], [0, 1, 0]])
+
+    def test_batched_shortest_paths(self):
+        graph, nodes = data_post_processing.graph_to_csr(self.G, "length")
+        rng = np.random.default_rng(1)
+        sources = rng.integers(0, len(nodes), 300)
+        targets = rng.integers(0, len(nodes), 300)
+        # source == target and the duplicated pairs
+        sources[:10] = targets[:10]
+        sources[10:20], targets[10:20] = sources[20:30], targets[20:30]
+        paths = data_post_processing.batched_shortest_paths(graph, sources, targets, chunk_size=7)
+
+        for source, target in zip(sources.tolist(), targets.tolist()):
+            if nx.has_path(self.G, nodes[source], nodes[target]):
+                self.assertEqual([nodes[node] for node in paths[(source, target)]], nx.shortest_path(self.G, nodes[source], nodes[target], weight="length"))
+            else:
+                self.assertIsNone(paths[(source, target)])
+        self.assertEqual(paths[(sources[0], sources[0])], [sources[0]])
+
+        # the unreachable target
+        self.G.add_node(60, y=39.9, x=116.3)
+        graph, nodes = data_post_processing.graph_to_csr(self.G, "length")
+        self.assertEqual(data_post_processing.batched_shortest_paths(graph, [0, 60], [60, 60]), {(0, 60): None, (60, 60): [60]})
+
+    def test_snap_to_nodes(self):
+        node_lats = np.array([self.G.nodes[node]["y"] for node in self.G.nodes])
+        node_lons = np.array([self.G.nodes[node]["x"] for node in self.G.nodes])
+        rng = np.random.default_rng(2)
+        lats, lons = rng.uniform(*self.lat_range, 50), rng.uniform(*self.lon_range, 50)
+        indice = data_post_processing.snap_to_nodes(node_lats, node_lons, lats, lons)
+
+        # the nearest nodes by the haversine distance
+        lat1, lon1, lat2, lon2 = (np.radians(values) for values in (lats[:, None], lons[:, None], node_lats[None], node_lons[None]))
+        distances = np.sin((lat2-lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2)**2
+        self.assertEqual(indice.tolist(), distances.argmin(axis=1).tolist())
+
+    def test_batched_meta_post_process(self):
+        original_grid = Grid(Grid.make_ranges_from_latlon_range_and_nbins(self.lat_range, self.lon_range, 4))
+        post_process_grid = Grid(Grid.make_ranges_from_latlon_range_and_nbins(self.lat_range, self.lon_range, 8))
+        rng = np.random.default_rng(3)
+        gene_traj = [rng.integers(0, 36, rng.integers(1, 4)).tolist() for _ in range(50)]
+        our_trajs = data_post_processing.batched_meta_post_process(gene_traj, original_grid, post_process_grid, self.G)
+
+        # the nearest node of the center of the states, the shortest path by networkx, and the states of the nodes
+        nodes = list(self.G.nodes)
+        node_lats = np.array([self.G.nodes[node]["y"] for node in nodes])
+        node_lons = np.array([self.G.nodes[node]["x"] for node in nodes])
+        expected = []
+        for traj in gene_traj:
+            if len(traj) <= 1:
+                continue
+            source, target = [nodes[data_post_processing.snap_to_nodes(node_lats, node_lons, *original_grid.state_to_center_latlon(state))] for state in traj[:2]]
+            if not nx.has_path(self.G, source, target):
+                continue
+            path = nx.shortest_path(self.G, source, target, weight="length")
+            states = [post_process_grid.latlon_to_state(self.G.nodes[node]["y"], self.G.nodes[node]["x"]) for node in path]
+            expected.append(data_post_processing.remove_consecutive_duplicates(states))
+        self.assertEqual(our_trajs, expected)
+
+if __name__ == '__main__':
+    unittest.main()
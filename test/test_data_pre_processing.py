@@ -1,12 +1,16 @@
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 import sys
+import json
+import pathlib
+import shutil
 import folium
+import numpy as np
 
 sys.path.append('./')
 import data_pre_processing
 from grid import Grid
-from my_utils import load, load_latlon_range
+from my_utils import load, save, load_latlon_range
 from evaluation import compensate_trajs
 
 class TestDataPreProcessing(unittest.TestCase):
@@ -31,6 +35,114 @@ class TestDataPreProcessing(unittest.TestCase):
         for i in range(len(trajs)):
             self.assertEqual(trajs[i], reversed_stay_trajs[i])
 
+    def make_clustered_trajectories(self, n_trajectories=100):
+        # the records stay around the centers (within 100m) and the centers are more than 1km apart, so that the distances are far from the threshold
+        rng = np.random.default_rng(0)
+        trajectories = []
+        for _ in range(n_trajectories):
+            n_centers = rng.integers(1, 6)
+            centers = np.array([39.9, 116.3]) + rng.integers(-5, 5, (n_centers, 2)) * 0.015
+            trajectory = []
+            time = 0.
+            for center in centers:
+                for _ in range(rng.integers(1, 8)):
+                    lat, lon = center + rng.uniform(-0.0003, 0.0003, 2)
+                    trajectory.append((time, lat, lon))
+                    time += float(rng.choice([60, 300, 600, 900]))
+            trajectories.append(trajectory)
+        return trajectories
+
+    def test_process_trajectories(self):
+        trajectories = self.make_clustered_trajectories()
+        for location_threshold, time_threshold, startend in [(200, 10, False), (200, 0, False), (0, 0, False), (200, 10, True)]:
+            expected = [data_pre_processing.process_trajectory(trajectory, location_threshold, time_threshold, startend) for trajectory in trajectories]
+            stay_trajectories, time_trajectories = data_pre_processing.process_trajectories(trajectories, location_threshold, time_threshold, startend)
+            self.assertEqual(stay_trajectories, [stay_trajectory for stay_trajectory, _ in expected])
+            self.assertEqual(time_trajectories, [time_trajectory for _, time_trajectory in expected])
+
+        # the chunks of the workers are concatenated in the order
+        time_trajectories, stay_trajectories = data_pre_processing.make_stay_trajectory(trajectories, 10, 200, chunk_size=7)
+        expected = [data_pre_processing.process_trajectory(trajectory, 200, 10, False) for trajectory in trajectories]
+        self.assertEqual(list(stay_trajectories), [stay_trajectory for stay_trajectory, _ in expected])
+        self.assertEqual(list(time_trajectories), [time_trajectory for _, time_trajectory in expected])
+
+    def test_make_complessed_dataset(self):
+        grid = Grid(Grid.make_ranges_from_latlon_range_and_nbins([39.8, 40.0], [116.2, 116.5], 6))
+        rng = np.random.default_rng(0)
+        trajectories = []
+        for _ in range(200):
+            # random walks that stay in a cell for a while and sometimes go out of the grid
+            latlons = np.cumsum(rng.choice([0, 0, 0, 0.04, -0.04], (rng.integers(1, 10), 2)), axis=0) + np.array([39.9, 116.35])
+            trajectories.append([tuple(latlon) for latlon in latlons.tolist()])
+        time_trajectories = [[(i, i+0.5) for i in range(len(trajectory))] for trajectory in trajectories]
+        indice = rng.choice(len(trajectories), 150, replace=False).tolist()
+
+        for indice_ in [None, indice]:
+            # the per-trajectory conversion by latlon_to_state and compless
+            expected_dataset, expected_times, expected_indice = [], [], []
+            for ind in range(len(trajectories)):
+                if indice_ is not None and ind not in indice_:
+                    continue
+                state_trajectory = [grid.latlon_to_state(lat, lon) for lat, lon in trajectories[ind]]
+                state_trajectory, time_trajectory = data_pre_processing.compless(state_trajectory, time_trajectories[ind])
+                if len(state_trajectory) > 1:
+                    expected_dataset.append(state_trajectory)
+                    expected_times.append(time_trajectory)
+                    expected_indice.append(ind)
+
+            dataset, times, added_indice = data_pre_processing.make_complessed_dataset(time_trajectories, trajectories, grid, indice_)
+            self.assertTrue(any(None in trajectory for trajectory in dataset))
+            self.assertEqual(dataset, expected_dataset)
+            self.assertEqual(times, expected_times)
+            self.assertEqual(added_indice, expected_indice)
+
+        # check_in_range removes the trajectories that have a record out of the grid
+        raw_trajectories = [[(0, lat, lon) for lat, lon in trajectory] for trajectory in trajectories]
+        expected = [trajectory for trajectory in raw_trajectories if all(grid.is_in_range(lat, lon) for _, lat, lon in trajectory)]
+        self.assertEqual(data_pre_processing.check_in_range(raw_trajectories, grid), expected)
+
+    def test_run_by_chunks(self):
+        lat_range, lon_range, n_bins = [39.8, 40.0], [116.2, 116.5], 4
+        raw_data_dir = pathlib.Path("./test/data/test_run_by_chunks")
+        raw_data_dir.mkdir(parents=True, exist_ok=True)
+        trajectories = self.make_clustered_trajectories(200)
+        # some trajectories go out of the grid
+        trajectories[::7] = [trajectory + [(trajectory[-1][0]+60, 41., 116.3)] for trajectory in trajectories[::7]]
+        save(raw_data_dir / "raw_data.csv", trajectories)
+
+        # the whole data in memory
+        grid = Grid(Grid.make_ranges_from_latlon_range_and_nbins(lat_range, lon_range, n_bins))
+        raw_trajs = data_pre_processing.check_in_range(load(raw_data_dir / "raw_data.csv", 150, 0), grid)
+        time_trajs, trajs = data_pre_processing.make_stay_trajectory(raw_trajs, 10, 200)
+        expected_trajs, expected_times, expected_indice = data_pre_processing.make_complessed_dataset(time_trajs, trajs, grid)
+        expected_times = [[time[0] for time in traj] for traj in expected_times]
+
+        logger = MagicMock()
+        try:
+            with patch("data_pre_processing.args", MagicMock(seed=0), create=True):
+                for i, max_chunk_bytes in enumerate([2**30, 1000]):
+                    training_data_dir = raw_data_dir / "150" / f"{i}"
+                    with patch("data_pre_processing.make_training_data_path", return_value=training_data_dir):
+                        data_pre_processing.run("peopleflow", lat_range, lon_range, n_bins, 10, 200, 150, 0, 0, logger, max_chunk_bytes=max_chunk_bytes)
+                    self.assertEqual(load(training_data_dir / "training_data.csv"), expected_trajs)
+                    self.assertEqual(load(training_data_dir / "training_data_time.csv"), expected_times)
+                    with open(training_data_dir / "indice.json", "r") as f:
+                        self.assertEqual(json.load(f), expected_indice)
+                    self.assertEqual(list(training_data_dir.glob("*.tmp")), [])
+
+                # an interrupted run leaves no training_data.csv, so that the next run remakes the training data
+                training_data_dir = raw_data_dir / "150" / "interrupted"
+                with patch("data_pre_processing.make_training_data_path", return_value=training_data_dir), patch("data_pre_processing.make_distance_data", side_effect=KeyboardInterrupt):
+                    with self.assertRaises(KeyboardInterrupt):
+                        data_pre_processing.run("peopleflow", lat_range, lon_range, n_bins, 10, 200, 150, 0, 0, logger)
+                self.assertFalse((training_data_dir / "training_data.csv").exists())
+                with patch("data_pre_processing.make_training_data_path", return_value=training_data_dir):
+                    data_pre_processing.run("peopleflow", lat_range, lon_range, n_bins, 10, 200, 150, 0, 0, logger)
+                self.assertEqual(load(training_data_dir / "training_data.csv"), expected_trajs)
+                self.assertTrue((training_data_dir / "params.json").exists())
+        finally:
+            shutil.rmtree(raw_data_dir)
+
     def test_geolife_dataset(self):
         dataset = "geolife_test"
         n_bins = 30
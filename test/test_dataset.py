@@ -5,8 +5,9 @@ import sys
 import numpy as np
 import pathlib
 import json
+import torch
 sys.path.append('./')
-from dataset import TrajectoryDataset
+from dataset import TrajectoryDataset, LengthBucketedBatchSplittingSampler, LengthBucketedBatchMemoryManager
 from my_utils import set_logger
 
 class TrajectoryDatasetTestCase(unittest.TestCase):
@@ -76,6 +77,48 @@ class TrajectoryDatasetTestCase(unittest.TestCase):
         self.assertEqual(trajs[30], [self.n_locations, 0, 1, 4])
 
 
+    def test_length_bucketed_batch_splitting_sampler(self):
+        class OptimizerMock:
+            def __init__(self):
+                self.skips = []
+            def signal_skip_step(self, do_skip):
+                self.skips.append(do_skip)
+
+        lengths = [1, 9, 2, 8, 3, 7, 4, 6]
+        logical_batches = [[0, 1, 2, 3, 4, 5, 6, 7], [], [1, 3]]
+        optimizer = OptimizerMock()
+        sampler = LengthBucketedBatchSplittingSampler(sampler=logical_batches, max_batch_size=3, optimizer=optimizer, lengths=lengths)
+        physical_batches = list(sampler)
+
+        self.assertEqual(physical_batches, [[0, 2, 4], [6, 7, 5], [3, 1], [], [3, 1]])
+        # the optimizer steps only at the end of each logical batch
+        self.assertEqual(optimizer.skips, [True, True, False, False, False])
+
+    def test_length_bucketed_batch_memory_manager(self):
+        class OptimizerMock:
+            def __init__(self):
+                self.skips = []
+            def signal_skip_step(self, do_skip):
+                self.skips.append(do_skip)
+
+        class DatasetMock(torch.utils.data.Dataset):
+            def __init__(self, data):
+                self.data = data
+            def __len__(self):
+                return len(self.data)
+            def __getitem__(self, index):
+                return self.data[index]
+
+        data = [[0]*length for length in [1, 9, 2, 8, 3, 7, 4, 6]]
+        data_loader = torch.utils.data.DataLoader(DatasetMock(data), batch_sampler=[[0, 1, 2, 3, 4, 5, 6, 7], [1, 3]], collate_fn=lambda batch: [len(trajectory) for trajectory in batch])
+        optimizer = OptimizerMock()
+        with LengthBucketedBatchMemoryManager(data_loader=data_loader, max_physical_batch_size=3, optimizer=optimizer) as physical_data_loader:
+            physical_batches = list(physical_data_loader)
+
+        # the physical batches are made of the trajectories of similar lengths
+        self.assertEqual(physical_batches, [[1, 2, 3], [4, 6, 7], [8, 9], [8, 9]])
+        self.assertEqual(optimizer.skips, [True, True, False, False])
+
 
 if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+    unittest.main()
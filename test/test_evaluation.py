@@ -1,4 +1,5 @@
 import unittest
+from unittest.mock import patch
 from collections import Counter
 # add parent path
 import sys
@@ -9,6 +10,10 @@ import folium
 import sqlite3
 import struct
 import json
+import random
+import shutil
+import tempfile
+import logging
 
 # from mocks import GeneratorMock, NameSpace
 sys.path.append('./')
@@ -17,7 +22,9 @@ from my_utils import set_logger, load, plot_density, noise_normalize
 from dataset import TrajectoryDataset
 import evaluation
 from grid import Grid
-from run import construct_dataset
+from main import construct_dataset
+from models import construct_generator
+from name_config import result_name
 
 
 def make_data():
@@ -38,6 +45,27 @@ def make_data():
 
     return TrajectoryDataset(traj, traj_time, n_locations, n_split, dataset_name="test", route_data=route_traj)
 
+def make_evaluation_dataset(n_bins=6, n_data=6000, seed=0):
+    # random trajectories whose first locations are concentrated on a few locations (the test locations)
+    rng = np.random.default_rng(seed)
+    n_locations = (n_bins+2)**2
+    trajs = [rng.integers(0, 6, 1).tolist() + rng.integers(0, n_locations, rng.integers(1, 5)).tolist() for _ in range(n_data)]
+    times = [[0] + sorted(rng.integers(1, 24, len(traj)-1).tolist()) for traj in trajs]
+    return TrajectoryDataset(trajs, times, n_locations, 2, dataset_name="evaluation_test")
+
+def save_grid_distance_matrix(data_dir, n_bins):
+    # the manhattan distance between the cells
+    cells = np.array([(i, j) for i in range(n_bins+2) for j in range(n_bins+2)], dtype=float)
+    np.save(data_dir / f"distance_matrix_bin{n_bins}.npy", np.abs(cells[:, None] - cells[None]).sum(-1))
+
+def make_evaluation_kwargs(**overrides):
+    from hydra import compose, initialize
+    with initialize(version_base=None, config_path="../conf"):
+        kwargs = dict(compose(config_name="config"))
+    kwargs.update({"render_plots": False, "cache_auxiliary_information": False})
+    kwargs.update(overrides)
+    return kwargs
+
 def make_args():
     args = NameSpace()
     args.eval_interval = 1
@@ -62,6 +90,120 @@ def make_args():
     
 
 
+class EvaluateTestCase(unittest.TestCase):
+    # evaluate a small random generator on the synthetic data end to end
+
+    def setUp(self):
+        self.data_dir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        patcher = patch("evaluation.get_datadir", return_value=self.data_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dataset = make_evaluation_dataset()
+        (self.data_dir / str(self.dataset)).mkdir()
+        save_grid_distance_matrix(self.data_dir / str(self.dataset), 6)
+        self.save_dir = self.data_dir / "model" / "0"
+        self.save_dir.mkdir(parents=True)
+        self.logger = logging.getLogger(__name__)
+        kwargs = make_evaluation_kwargs()
+        torch.manual_seed(0)
+        self.generator = construct_generator("baseline", self.dataset.n_locations, self.dataset.n_time_split+1, kwargs["location_embedding_dim"], kwargs["time_embedding_dim"], kwargs["memory_hidden_dim"], kwargs["multitask"], kwargs["consistent"])
+
+    def evaluate(self, dataset=None, **overrides):
+        dataset = self.dataset if dataset is None else dataset
+        kwargs = make_evaluation_kwargs(**overrides)
+        evaluation.compute_auxiliary_information(dataset, self.save_dir, kwargs["test_threshold"], self.logger, **kwargs)
+        random.seed(0)
+        np.random.seed(0)
+        torch.manual_seed(0)
+        return evaluation.evaluate(self.generator, dataset, self.save_dir, self.logger, **kwargs)
+
+    def test_adaptive_evaluation(self):
+        kwargs = {"adaptive_evaluation": True, "n_bootstrap_blocks": 2, "n_bootstrap": 5, "evaluate_first_next_location": False}
+        # the width of the intervals of the js is at most 1, so the generation stops at the first check (2 batches of 1000)
+        results = self.evaluate(evaluation_tolerance=1.01, **kwargs)
+        self.assertEqual(results["n_generated"], 2000)
+        # only the js are bootstrapped
+        self.assertIn("target_jss", results["confidence_intervals"])
+        self.assertTrue(all(name.endswith(("_js", "_jss")) for name in results["confidence_intervals"]))
+        # the intervals contain the estimates on all the generated data
+        for name, (lower, upper) in results["confidence_intervals"].items():
+            self.assertLessEqual(lower, np.mean(results[name]))
+            self.assertGreaterEqual(upper, np.mean(results[name]))
+
+        # the generation does not stop if the tolerance is not satisfied
+        results = self.evaluate(evaluation_tolerance=0, **kwargs)
+        self.assertGreaterEqual(results["n_generated"], len(self.dataset.references))
+
+    def test_multi_resolution_evaluation(self):
+        # the missing distance matrix of an evaluation bin is found before computing anything
+        with self.assertRaisesRegex(FileNotFoundError, "distance_matrix_bin2.npy"):
+            self.evaluate(evaluation_bins=[2], evaluate_first_next_location=False)
+        self.assertFalse(hasattr(self.dataset, "first_location_counts"))
+
+        save_grid_distance_matrix(self.data_dir / str(self.dataset), 2)
+        results = self.evaluate(evaluation_bins=[2], evaluate_first_next_location=False)
+        bin_keys = [key for key in results if key.startswith("bin2_")]
+        self.assertIn("bin2_route_jss", bin_keys)
+        self.assertIn("bin2_distance_js", bin_keys)
+        # the metrics at the coarser resolution are computed on the downsampled data
+        for key in bin_keys:
+            self.assertIn(key[len("bin2_"):], results)
+        self.assertEqual(self.dataset.downsampled_datasets[0].n_locations, 16)
+
+    def test_auxiliary_information_cache(self):
+        # the auxiliary information reloaded from the cache equals the freshly computed one
+        kwargs = make_evaluation_kwargs()
+        data_path = self.data_dir / "training_data.csv"
+        data_path.write_text("")
+        self.dataset.data_paths = [data_path]
+        evaluation.compute_auxiliary_information(self.dataset, self.save_dir, kwargs["test_threshold"], self.logger, **kwargs)
+        cache_path = self.data_dir / "auxiliary_information.pkl"
+        evaluation.save_auxiliary_information(self.dataset, cache_path)
+
+        dataset = make_evaluation_dataset()
+        evaluation.load_auxiliary_information(dataset, cache_path, **kwargs)
+        for name in evaluation.AUXILIARY_INFORMATION_ATTRIBUTES:
+            self.assertEqual(getattr(dataset, name), getattr(self.dataset, name), name)
+        self.assertEqual(list(dataset.first_order_test_data_loader.dataset.indices), list(self.dataset.first_order_test_data_loader.dataset.indices))
+        for batch, expected_batch in zip(dataset.first_order_test_data_loader, self.dataset.first_order_test_data_loader):
+            self.assertEqual(batch.keys(), expected_batch.keys())
+            for key, value in batch.items():
+                if torch.is_tensor(value):
+                    self.assertTrue(torch.equal(value, expected_batch[key]), key)
+                else:
+                    self.assertEqual(value, expected_batch[key], key)
+        self.assertEqual([function.__name__ for function in dataset.counting_functions], [function.__name__ for function in self.dataset.counting_functions])
+
+        # compute_auxiliary_information reads the cache back by the key of the data files
+        with patch("evaluation.load_auxiliary_information", wraps=evaluation.load_auxiliary_information) as load_auxiliary_information:
+            for _ in range(2):
+                evaluation.compute_auxiliary_information(self.dataset, self.save_dir, kwargs["test_threshold"], self.logger, **{**kwargs, "cache_auxiliary_information": True})
+            self.assertEqual(load_auxiliary_information.call_count, 1)
+
+    def run_evaluation(self, model_dir, **overrides):
+        kwargs = make_evaluation_kwargs(model_name="baseline", model_seed=0, evaluation_interval=1, evaluate_first_next_location=False, **overrides)
+        with patch("evaluation.make_model_dir", return_value=model_dir), patch("evaluation.set_logger", return_value=self.logger), patch("main.construct_dataset", return_value=self.dataset):
+            evaluation.run(**kwargs)
+        return [json.loads((model_dir / result_name(i, kwargs["consistent"])).read_text()) for i in range(2)]
+
+    def test_parallel_evaluation(self):
+        # two checkpoints evaluated by two workers give the same results as the serial evaluation
+        kwargs = make_evaluation_kwargs()
+        state_dicts = []
+        for i in range(2):
+            torch.manual_seed(i)
+            state_dicts.append(construct_generator("baseline", self.dataset.n_locations, self.dataset.n_time_split+1, kwargs["location_embedding_dim"], kwargs["time_embedding_dim"], kwargs["memory_hidden_dim"], kwargs["multitask"], kwargs["consistent"]).state_dict())
+        for mode in ["serial", "parallel"]:
+            (self.data_dir / mode).mkdir()
+            for i, state_dict in enumerate(state_dicts):
+                torch.save(state_dict, self.data_dir / mode / f"model_{i}")
+        serial_results = self.run_evaluation(self.data_dir / "serial", n_evaluation_workers=0)
+        parallel_results = self.run_evaluation(self.data_dir / "parallel", n_evaluation_workers=2, n_threads_per_evaluation_worker=1)
+        self.assertEqual(serial_results, parallel_results)
+        # the checkpoints are different models
+        self.assertNotEqual(serial_results[0], serial_results[1])
+
 class CompensateTrajsTestCase(unittest.TestCase):
     def setUp(self):
         pass
@@ -474,6 +616,198 @@ class EvaluationTestCase(unittest.TestCase):
         divergence = compute_divergence(count1, 3, count2, 3, 5, positive=False, kl=False)
         print(divergence, "a")
 
+    def test_pipelined_counting(self):
+        import multiprocessing
+        from types import SimpleNamespace
+        kwargs = {"evaluate_passing": True, "evaluate_source": True, "evaluate_emp_next": True, "evaluate_target": True, "evaluate_destination": True, "evaluate_route": True, "evaluate_distance": False}
+        _, counting_functions, counters = evaluation.make_counting_functions(len(self.top_base_locations), **kwargs)
+        dataset = SimpleNamespace(top_base_locations=self.top_base_locations, counting_functions=counting_functions)
+        rng = np.random.default_rng(0)
+        batches = [[rng.integers(0, self.n_locations, rng.integers(1, 6)).tolist() for _ in range(20)] for _ in range(10)]
+
+        # sequential counting
+        for batch in batches:
+            for counting_function, counter in zip(counting_functions, counters):
+                counting_function(batch, batch, dataset, counter)
+
+        # pipelined counting
+        _, _, pipelined_counters = evaluation.make_counting_functions(len(self.top_base_locations), **kwargs)
+        context = multiprocessing.get_context("fork")
+        batch_queue = context.Queue(maxsize=2)
+        result_queue = context.Queue()
+        workers = [context.Process(target=evaluation.count_batches, args=(worker_id, [(None, dataset, pipelined_counters)], batch_queue, result_queue), daemon=True) for worker_id in range(2)]
+        for worker in workers:
+            worker.start()
+        for batch in batches + [None, None]:
+            evaluation.put_to_workers(batch_queue, None if batch is None else (batch, batch), workers)
+        evaluation.merge_counters(pipelined_counters, [partial_counters[0] for partial_counters in evaluation.gather_from_workers(result_queue, workers)])
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(counters, pipelined_counters)
+
+    def test_make_downsampling_array(self):
+        for from_bin, to_bin in [(30, 14), (14, 6), (6, 2)]:
+            downsampling_dict = evaluation.make_downsampling_dict(from_bin, to_bin)
+            downsampling_array = evaluation.make_downsampling_array(from_bin, to_bin)
+            self.assertEqual(len(downsampling_array), (from_bin+2)**2)
+            self.assertTrue(downsampling_array.max() < (to_bin+2)**2)
+            for state, downsampled_state in downsampling_dict.items():
+                self.assertEqual(downsampling_array[state], downsampled_state)
+
+    def test_downsample_trajs(self):
+        downsampling = evaluation.make_downsampling_array(6, 2)
+        rng = np.random.default_rng(0)
+        trajs = [rng.integers(0, 64, rng.integers(1, 8)).tolist() for _ in range(50)]
+        time_trajs = [list(range(len(traj))) for traj in trajs]
+        downsampled_trajs, indice, downsampled_time_trajs = evaluation.downsample_trajs(trajs, downsampling, time_trajs)
+        self.assertEqual(indice, list(range(len(trajs))))
+        for traj, time_traj, downsampled_traj, downsampled_time_traj in zip(trajs, time_trajs, downsampled_trajs, downsampled_time_trajs):
+            # the consecutive same states are merged into the first one
+            expected_traj = [int(downsampling[traj[0]])]
+            expected_time_traj = [time_traj[0]]
+            for state, time in zip(traj[1:], time_traj[1:]):
+                if downsampling[state] != expected_traj[-1]:
+                    expected_traj.append(int(downsampling[state]))
+                    expected_time_traj.append(time)
+            self.assertEqual(downsampled_traj, expected_traj)
+            self.assertEqual(downsampled_time_traj, expected_time_traj)
+
+        # the dict of make_downsampling_dict gives the same result
+        downsampling_dict = evaluation.make_downsampling_dict(6, 2)
+        self.assertEqual(evaluation.downsample_trajs(trajs, downsampling_dict)[0], downsampled_trajs)
+
+    def test_auxiliary_information_cache_key(self):
+        kwargs = {"evaluate_passing": True, "evaluate_source": True, "evaluate_emp_next": True, "evaluate_target": True, "evaluate_destination": True, "evaluate_route": True, "evaluate_distance": False}
+        data_dir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, data_dir)
+        distance_matrix_path = data_dir / "distance_matrix_bin2.npy"
+        np.save(distance_matrix_path, np.zeros((16, 16)))
+        data_path = data_dir / "training_data.csv"
+        data_path.write_text("0,1,2\n")
+        dataset = make_data()
+        dataset.data_paths = [data_path]
+        key = evaluation.compute_auxiliary_information_cache_key(dataset, 20, distance_matrix_path, **kwargs)
+        self.assertEqual(key, evaluation.compute_auxiliary_information_cache_key(dataset, 20, distance_matrix_path, **kwargs))
+        # the key changes if the settings or the data file change
+        self.assertNotEqual(key, evaluation.compute_auxiliary_information_cache_key(dataset, 10, distance_matrix_path, **kwargs))
+        self.assertNotEqual(key, evaluation.compute_auxiliary_information_cache_key(dataset, 20, distance_matrix_path, **{**kwargs, "evaluate_distance": True}))
+        data_path.write_text("0,1,3,4\n")
+        self.assertNotEqual(key, evaluation.compute_auxiliary_information_cache_key(dataset, 20, distance_matrix_path, **kwargs))
+        key = evaluation.compute_auxiliary_information_cache_key(dataset, 20, distance_matrix_path, **kwargs)
+        # the key changes if the code of a dependent module changes
+        read_bytes = pathlib.Path.read_bytes
+        with patch("pathlib.Path.read_bytes", lambda path: read_bytes(path) + (b"#" if path.name == "grid.py" else b"")):
+            self.assertNotEqual(key, evaluation.compute_auxiliary_information_cache_key(dataset, 20, distance_matrix_path, **kwargs))
+
+    def test_find_not_converged(self):
+        intervals = {"passing_js": [0.1, 0.105], "target_jss": [0.2, 0.3]}
+        self.assertEqual(evaluation.find_not_converged(intervals, 0.01), ["target_jss"])
+        self.assertEqual(evaluation.find_not_converged(intervals, 0.2), [])
+
+    def test_make_prefix_index(self):
+        trajs = [[0,1,2], [1], [0,1], [0,2,3], [1,0,1], [0,1,3,4]]
+        first_index = evaluation.make_prefix_index(trajs, 1)
+        self.assertEqual({key: value.tolist() for key, value in first_index.items()}, {0: [0,2,3,5], 1: [4]})
+        second_index = evaluation.make_prefix_index(trajs, 2)
+        self.assertEqual({key: value.tolist() for key, value in second_index.items()}, {(0,1): [0,5], (0,2): [3], (1,0): [4]})
+
+        # the test data loader is the subset of the dataset
+        dataset = make_data()
+        dataset.top_base_locations = [0]
+        _, counters = evaluation.make_first_order_test_data_loader(dataset, 1)
+        self.assertEqual(counters, {0: len(dataset)})
+        n_records = sum(len(batch["input"]) for batch in dataset.first_order_test_data_loader)
+        self.assertEqual(n_records, len(dataset))
+
+    def test_evaluate_next_location_on_test_dataset(self):
+        from models import construct_generator
+        dataset = make_data()
+        dataset.top_base_locations = [0]
+        evaluation.make_first_order_test_data_loader(dataset, 1)
+        next_location_counts = [Counter({1: 100})]
+        generator = construct_generator("baseline", dataset.n_locations, dataset.n_time_split+1, 8, 8, 8, False, False)
+        jss = evaluate_next_location_on_test_dataset(next_location_counts, [0], dataset.n_locations, dataset.first_order_test_data_loader, dataset.first_counters, generator, 1)
+
+        # the same as the mean of the full forward over all the records
+        outputs = []
+        with torch.no_grad():
+            for mini_batch in dataset.first_order_test_data_loader:
+                output, _ = generator([mini_batch["input"], mini_batch["time"]])[0]
+                outputs.append(torch.exp(generator.scoring_component.to_location_distribution(output, 1)))
+        inferred_distribution = torch.cat(outputs).double().mean(dim=0).numpy()
+        target_distribution = evaluation.compute_distribution_from_count(next_location_counts[0], dataset.n_locations, 100)
+        expected = evaluation.compute_distribution_js_for_each_depth(inferred_distribution, target_distribution)
+        np.testing.assert_allclose(jss[0], expected)
+
+    def test_merge_counters_with_weights(self):
+        counters = [Counter(), [Counter(), Counter()]]
+        block_counters = [[Counter({0: 1}), [Counter({1: 2}), Counter()]], [Counter({0: 3, 2: 1}), [Counter(), Counter({3: 1})]]]
+        evaluation.merge_counters(counters, block_counters, [2, 0])
+        self.assertEqual(counters, [Counter({0: 2}), [Counter({1: 4}), Counter()]])
+        evaluation.merge_counters(counters, block_counters)
+        self.assertEqual(counters, [Counter({0: 6, 2: 1}), [Counter({1: 6}), Counter({3: 1})]])
+
+    def test_compute_distribution_js_for_each_depth(self):
+        from my_utils import construct_default_quadtree
+        from scipy.spatial.distance import jensenshannon
+        n_bins = 6
+        n_locations = (n_bins+2)**2
+        rng = np.random.default_rng(0)
+        distribution = rng.random((3, n_locations))
+        target_distribution = rng.random((3, n_locations))
+        jss = evaluation.compute_distribution_js_for_each_depth(distribution, target_distribution)
+
+        # the same as the aggregation by walking the tree
+        tree = construct_default_quadtree(n_bins)
+        tree.make_self_complete()
+        distributions = evaluation.make_target_distributions_of_all_layers(torch.tensor(distribution), tree)
+        target_distributions = evaluation.make_target_distributions_of_all_layers(torch.tensor(target_distribution), tree)
+        expected = np.stack([jensenshannon(target_distributions[depth], distributions[depth], axis=1)**2 for depth in range(tree.max_depth)], axis=1)
+        np.testing.assert_allclose(jss, expected)
+        self.assertIs(evaluation.get_depth_aggregation_matrices(n_bins), evaluation.get_depth_aggregation_matrices(n_bins))
+
+    def test_compute_emd(self):
+        import pyemd
+        n_x = 6
+        cells = np.array([(i, j) for i in range(n_x) for j in range(n_x)], dtype=float)
+        euclidean_matrix = np.sqrt(((cells[:, None] - cells[None]) ** 2).sum(-1))
+        manhattan_matrix = np.abs(cells[:, None] - cells[None]).sum(-1)
+        rng = np.random.default_rng(0)
+        for _ in range(10):
+            first_hist = np.zeros(n_x*n_x)
+            second_hist = np.zeros(n_x*n_x)
+            first_hist[rng.choice(n_x*n_x, 4)] = rng.random(4)
+            second_hist[rng.choice(n_x*n_x, 6)] = rng.random(6)
+            first_hist /= first_hist.sum()
+            second_hist /= second_hist.sum()
+
+            expected = pyemd.emd(first_hist, second_hist, euclidean_matrix)
+            self.assertAlmostEqual(evaluation.compute_emd(first_hist, second_hist, euclidean_matrix, emd_backend="support"), expected)
+            # the grid backend is exact for the grid ground metric
+            expected = pyemd.emd(first_hist, second_hist, manhattan_matrix)
+            self.assertAlmostEqual(evaluation.compute_emd(first_hist, second_hist, manhattan_matrix, emd_backend="grid"), expected)
+            # the grid backend falls back to the support backend for the other metrics
+            self.assertAlmostEqual(evaluation.compute_emd(first_hist, second_hist, euclidean_matrix, emd_backend="grid"), pyemd.emd(first_hist, second_hist, euclidean_matrix))
+
+        # the geodesic distance between the cell centers is not additive along the grid paths
+        latlons = np.radians(np.array([(35 + 0.1*i, 139 + 0.1*j) for i in range(n_x) for j in range(n_x)]))
+        a = np.sin((latlons[:, None, 0] - latlons[None, :, 0])/2)**2 + np.cos(latlons[:, None, 0])*np.cos(latlons[None, :, 0])*np.sin((latlons[:, None, 1] - latlons[None, :, 1])/2)**2
+        geodesic_matrix = 2*6371000*np.arcsin(np.sqrt(a))
+        self.assertTrue(evaluation.is_grid_metric(manhattan_matrix))
+        self.assertFalse(evaluation.is_grid_metric(geodesic_matrix))
+        with self.assertRaises(ValueError):
+            evaluation.compute_grid_emd(first_hist, second_hist, geodesic_matrix)
+
+        count1 = Counter([2,3,4,3,4,4])
+        count2 = Counter([0,1,2,3,4,3,4,4])
+        cells = np.array([(i, j) for i in range(3) for j in range(3)], dtype=float)
+        distance_matrix = np.abs(cells[:, None] - cells[None]).sum(-1)
+        expected = compute_divergence(count1, 6, count2, 8, 9, type="emd", distance_matrix=distance_matrix)
+        for emd_backend in ["support", "grid"]:
+            emd = compute_divergence(count1, 6, count2, 8, 9, type="emd", distance_matrix=distance_matrix, emd_backend=emd_backend)
+            self.assertAlmostEqual(emd, expected)
+
     # def test_evaluate_next_location_on_test_dataset(self):
 
     #     n_locations = 16
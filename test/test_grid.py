@@ -31,6 +31,39 @@ class GridTestCase(unittest.TestCase):
             folium.Marker([lat, lon], popup=f"{i}").add_to(m)
         m.save('./test/data/test_grid.html')
 
+class LatlonsToStatesTestCase(unittest.TestCase):
+
+    def test_latlons_to_states(self):
+        import numpy as np
+        rng = np.random.default_rng(0)
+        grid = Grid(Grid.make_ranges_from_latlon_range_and_nbins([39.8, 40.0], [116.2, 116.5], 6))
+        lats = rng.uniform(39.79, 40.01, 500)
+        lons = rng.uniform(116.19, 116.51, 500)
+        # the points on the edges of the cells
+        x_range, y_range = grid.grids[10]
+        lats = np.concatenate([lats, [y_range[0], y_range[1], y_range[0]]])
+        lons = np.concatenate([lons, [x_range[0], x_range[1], x_range[1]]])
+        expected = [grid.latlon_to_state(lat, lon) for lat, lon in zip(lats, lons)]
+        expected = [-1 if state is None else state for state in expected]
+        self.assertTrue(-1 in expected)
+        self.assertEqual(grid.latlons_to_states(lats, lons).tolist(), expected)
+
+        # a grid that is not a tiling of the edges is handled by the search over the cells
+        irregular_grid = Grid([[(116.2, 116.3), (39.8, 39.9)], [(116.3, 116.5), (39.8, 39.85)], [(116.25, 116.3), (39.9, 40.0)]])
+        expected = [irregular_grid.latlon_to_state(lat, lon) for lat, lon in zip(lats, lons)]
+        expected = [-1 if state is None else state for state in expected]
+        self.assertEqual(irregular_grid.latlons_to_states(lats, lons).tolist(), expected)
+
+    def test_are_in_range(self):
+        import numpy as np
+        rng = np.random.default_rng(0)
+        grid = Grid(Grid.make_ranges_from_latlon_range_and_nbins([39.8, 40.0], [116.2, 116.5], 6))
+        lats = np.concatenate([rng.uniform(39.79, 40.01, 500), [grid.lat_range[0]-1e-6, grid.lat_range[1], grid.lat_range[1]+1e-4]])
+        lons = np.concatenate([rng.uniform(116.19, 116.51, 500), [grid.lon_range[0], grid.lon_range[1], grid.lon_range[1]]])
+        expected = [grid.is_in_range(lat, lon) for lat, lon in zip(lats.tolist(), lons.tolist())]
+        self.assertEqual(grid.are_in_range(lats, lons).tolist(), expected)
+        self.assertEqual(expected[-3:], [True, True, False])
+
 class QuadTreeTestCase(unittest.TestCase):
     def __init__(self, *args, **kwargs):
         super(QuadTreeTestCase, self).__init__(*args, **kwargs)
@@ -5,6 +5,8 @@ import sqlite3
 import json
 import networkx as nx
 import os
+import numpy as np
+import scipy.sparse.csgraph
 
 sys.path.append('./')
 import make_pair_to_route
@@ -24,6 +26,110 @@ class TestDatabase(unittest.TestCase):
             for row in c.fetchall():
                 print(row)
 
+class TestStateRoute(unittest.TestCase):
+
+    def setUp(self):
+        # a random road network on the grid of n_bins=2 in [0, 1] x [0, 1]
+        rng = np.random.default_rng(0)
+        n_nodes = 60
+        self.n_bins = 2
+        self.grid = Grid(Grid.make_ranges_from_latlon_range_and_nbins([0, 1], [0, 1], self.n_bins))
+        latlons = [tuple(latlon) for latlon in rng.uniform(0, 1, (n_nodes, 2)).tolist()]
+        self.nodes_edges = [[]]
+        for _ in range(150):
+            start, end = rng.choice(n_nodes, 2, replace=False)
+            self.nodes_edges.append([latlons[start], latlons[end], rng.uniform(1, 10)])
+        # the duplicated edge is overwritten by the last one
+        self.nodes_edges.append([self.nodes_edges[1][0], self.nodes_edges[1][1], 100.])
+
+    def make_reference_routes(self, truncate):
+        # the shortest state routes of the pairs of nodes by networkx
+        DG = nx.DiGraph()
+        for start_latlon, end_latlon, distance in self.nodes_edges[1:]:
+            DG.add_node(start_latlon)
+            DG.add_node(end_latlon)
+        for start_latlon, end_latlon, distance in self.nodes_edges[1:]:
+            DG.add_edge(start_latlon, end_latlon, weight=distance)
+
+        state_to_nodes = {}
+        for node in DG:
+            state_to_nodes.setdefault(self.grid.latlon_to_state(*node), []).append(node)
+        routes = {}
+        for i, start_nodes in state_to_nodes.items():
+            paths = [nx.single_source_dijkstra(DG, node) for node in start_nodes]
+            for j, end_nodes in state_to_nodes.items():
+                if i == j:
+                    continue
+                if any((node, end_node) in DG.edges for node in start_nodes for end_node in end_nodes):
+                    routes[(i, j)] = [i, j]
+                    continue
+                candidates = [(length[end_node], path[end_node]) for length, path in paths for end_node in end_nodes if end_node in path]
+                if len(candidates) == 0:
+                    continue
+                shortest_path = min(candidates, key=lambda candidate: candidate[0])[1]
+                if len(shortest_path) < truncate:
+                    routes[(i, j)] = make_pair_to_route.latlon_route_to_state_route(shortest_path, self.grid.latlon_to_state)
+        return routes
+
+    def test_make_csr_graph_from_edges(self):
+        graph, nodes = make_pair_to_route.make_csr_graph_from_edges(self.nodes_edges)
+        node_to_id = {node: i for i, node in enumerate(nodes)}
+        self.assertEqual(graph[node_to_id[self.nodes_edges[1][0]], node_to_id[self.nodes_edges[1][1]]], 100.)
+        self.assertEqual(graph.nnz, len(set((start, end) for start, end, _ in self.nodes_edges[1:])))
+
+    def test_make_state_to_nodes(self):
+        node_states = np.array([3, -1, 0, 3, 1, 0])
+        indptr, nodes = make_pair_to_route.make_state_to_nodes(node_states, 5)
+        self.assertEqual([nodes[indptr[i]:indptr[i+1]].tolist() for i in range(5)], [[2, 5], [4], [], [0, 3], []])
+
+    def test_make_state_pair_to_state_route(self):
+        graph, nodes = make_pair_to_route.make_csr_graph_from_edges(self.nodes_edges)
+        n_states = (self.n_bins+2)**2
+        db_path = "./test/data/test_paths.db"
+        for truncate in [float("inf"), 4]:
+            node_states = make_pair_to_route.make_node_to_state(nodes, n_states, self.grid, db_path)
+            make_pair_to_route.make_state_pair_to_state_route(n_states, db_path, node_states, graph, truncate, max_workers=2)
+            with sqlite3.connect(db_path) as conn:
+                c = conn.cursor()
+                c.execute("SELECT start_state, end_state, route FROM state_edge_to_route")
+                routes = {(i, j): eval(route) for i, j, route in c.fetchall()}
+            self.assertEqual(routes, self.make_reference_routes(truncate))
+        os.remove(db_path)
+
+    def test_route_oracle(self):
+        graph, nodes = make_pair_to_route.make_csr_graph_from_edges(self.nodes_edges)
+        n_states = (self.n_bins+2)**2
+        node_states = make_pair_to_route.make_node_to_state(nodes, n_states, self.grid)
+        cache_path = "./test/data/test_route_cache.bin"
+        pairs = [(i, j) for i in range(n_states) for j in range(n_states)]
+        for truncate in [float("inf"), 4]:
+            reference_routes = self.make_reference_routes(truncate)
+            oracle = make_pair_to_route.RouteOracle(graph, node_states, truncate, cache_path, max_cache_size=10)
+            routes = oracle.routes([i for i, _ in pairs], [j for _, j in pairs])
+            self.assertEqual(routes, [reference_routes.get(pair) for pair in pairs])
+            self.assertEqual(len(oracle.cache), 10)
+            self.assertEqual([oracle.route(i, j) for i, j in pairs[:20]], routes[:20])
+
+            # the routes are loaded from the disk cache
+            oracle = make_pair_to_route.RouteOracle(graph, node_states, truncate, cache_path, max_cache_size=len(pairs))
+            self.assertEqual(len(oracle.cache), len(pairs) - n_states)
+            self.assertEqual([oracle.cache.get(pair) for pair in pairs], routes)
+            os.remove(cache_path)
+
+        # the search is bounded by truncate, and an explicit limit drops the longer routes
+        self.assertEqual(make_pair_to_route.RouteOracle(graph, node_states, float("inf")).limit, np.inf)
+        self.assertEqual(make_pair_to_route.RouteOracle(graph, node_states, 4).limit, 4 * graph.data.max())
+        limit = np.median(graph.data) * 2
+        lengths = scipy.sparse.csgraph.dijkstra(graph)
+        oracle = make_pair_to_route.RouteOracle(graph, node_states, limit=limit)
+        reference_routes = self.make_reference_routes(float("inf"))
+        for (i, j), route in zip(pairs, oracle.routes([i for i, _ in pairs], [j for _, j in pairs])):
+            if route is not None:
+                self.assertEqual(route, reference_routes[(i, j)])
+            elif (i, j) in reference_routes:
+                # the nearest node of state j is farther than limit from the nodes of state i
+                self.assertGreater(lengths[np.ix_(node_states == i, node_states == j)].min(), limit)
+
 class TestPreProcessGeolifeTest(unittest.TestCase):
 
     def setUp(self):
@@ -150,7 +256,7 @@ class TestPreProcessChengdu(unittest.TestCase):
         grid = Grid(ranges)
         n_states = (n_bins+2)**2
 
-        make_pair_to_route.make_node_to_state(DG, n_states, grid.latlon_to_state, db_path)
+        make_pair_to_route.make_node_to_state(DG, n_states, grid, db_path)
 
         # plot states and nodes with anotation and different colors
         with sqlite3.connect(db_path) as conn:
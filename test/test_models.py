@@ -4,11 +4,55 @@ import numpy as np
 import torch
 
 
+import os
+import copy
+import json
+import socket
 import sys
 sys.path.append('./')
 from dataset import TrajectoryDataset
-from models import construct_generator, compute_loss_generator
-from main import train_with_discrete_time
+from models import construct_generator, compute_loss_generator, GRUPrefixEncodingComponent, dp_gru_cell_to_gru, gru_to_dp_gru_cell
+from main import train_with_discrete_time, SparseDenseAdam, all_reduce_mean_losses
+from opacus import GradSampleModule
+from opacus.optimizers import DPOptimizer, DistributedDPOptimizer
+from opacus.distributed import DifferentiallyPrivateDistributedDataParallel as DPDDP
+
+
+def find_free_port():
+    # the port that the os assigns to a socket bound to the port 0
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def init_process_group(rank, world_size, port):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    torch.distributed.init_process_group("gloo", rank=rank, world_size=world_size)
+
+def dp_step(rank, world_size, model, dataset, records, save_path, port=None):
+    # one DP-SGD step of the batch sharded across the ranks; the noise is drawn with the fixed seed by the rank 0
+    if world_size > 1:
+        init_process_group(rank, world_size, port)
+        model = DPDDP(model)
+    model = GradSampleModule(model)
+    optimizer_class = DistributedDPOptimizer if world_size > 1 else DPOptimizer
+    optimizer = optimizer_class(torch.optim.SGD(model.parameters(), lr=1), noise_multiplier=1.0, max_grad_norm=0.1, expected_batch_size=len(records) // world_size)
+
+    batch = dataset.make_padded_collate()(records[rank::world_size])
+    torch.manual_seed(0)
+    train_with_discrete_time(model, optimizer, compute_loss_generator, batch["input"], batch["target"], batch["time"], batch["time_target"], batch["reference"], 1, 1)
+
+    if rank == 0:
+        torch.save(model.state_dict(), save_path)
+    if world_size > 1:
+        torch.distributed.destroy_process_group()
+
+def mean_losses_step(rank, world_size, losses_of_ranks, save_path, port):
+    init_process_group(rank, world_size, port)
+    mean_losses = all_reduce_mean_losses(losses_of_ranks[rank])
+    if rank == 0:
+        np.save(save_path, mean_losses)
+    torch.distributed.destroy_process_group()
 
 class TestGenarator:
     
@@ -79,6 +123,111 @@ class TestGenarator:
         expected = [[0,1,0], [1,1,2], [2,1,30]]
         assert sampled == expected
 
+    def test_distributed_dp_step(self, tmp_path):
+        model = construct_generator("baseline", self.dataset.n_locations, self.dataset.n_time_split+1, self.hidden_dim, self.hidden_dim, self.hidden_dim, False, False)
+        records = [self.dataset[i] for i in range(0, 3000, 250)]
+
+        dp_step(0, 1, copy.deepcopy(model), self.dataset, records, tmp_path / "single.pt")
+        torch.multiprocessing.start_processes(dp_step, args=(2, copy.deepcopy(model), self.dataset, records, tmp_path / "distributed.pt", find_free_port()), nprocs=2, start_method="fork")
+
+        single = torch.load(tmp_path / "single.pt")
+        distributed = torch.load(tmp_path / "distributed.pt")
+        for key in single:
+            assert not torch.equal(single[key], model.state_dict()[key.replace("_module.", "")])
+            assert torch.allclose(single[key], distributed[key.replace("_module.", "_module.module.")], atol=1e-6)
+
+    def test_all_reduce_mean_losses(self, tmp_path):
+        # the rank 1 has no non-empty batch, and the mean is over the batches of all the ranks
+        losses_of_ranks = [[[1., 2., 3.], [3., 4., 5.]], []]
+        torch.multiprocessing.start_processes(mean_losses_step, args=(2, losses_of_ranks, tmp_path / "mean_losses.npy", find_free_port()), nprocs=2, start_method="fork")
+        assert np.load(tmp_path / "mean_losses.npy").tolist() == [2., 3., 4.]
+
+        losses_of_ranks = [[[1., 2.]], [[3., 4.], [5., 6.]]]
+        torch.multiprocessing.start_processes(mean_losses_step, args=(2, losses_of_ranks, tmp_path / "mean_losses.npy", find_free_port()), nprocs=2, start_method="fork")
+        assert np.load(tmp_path / "mean_losses.npy").tolist() == [3., 4.]
+
+    def test_tune_physical_batch_size(self, tmp_path):
+        import main
+        from unittest.mock import patch, MagicMock
+        model = construct_generator("baseline", self.dataset.n_locations, self.dataset.n_time_split+1, self.hidden_dim, self.hidden_dim, self.hidden_dim, False, False)
+        cache_path = tmp_path / "physical_batch_size.json"
+
+        # the memory usage of each candidate (the activations are included, so it is larger than the per-sample gradients)
+        used_memories = []
+        compute_tensors_bytes = main.compute_tensors_bytes
+        def record(tensors):
+            used_memories.append(compute_tensors_bytes(tensors))
+            return used_memories[-1]
+        with patch("main.compute_tensors_bytes", side_effect=record):
+            main.tune_physical_batch_size(model, self.dataset, 8, 1024, tmp_path / "unused.json", MagicMock(), n_trials=1)
+        assert len(used_memories) == 4
+        assert all(used_memory < next_used_memory for used_memory, next_used_memory in zip(used_memories[:-1], used_memories[1:]))
+        grad_sample_bytes = sum(param.nelement() * param.element_size() for param in model.parameters()) * 8
+        assert used_memories[-1] > grad_sample_bytes
+
+        # the candidates over the budget (4 and 8) are not chosen
+        memory_budget = (used_memories[1] + used_memories[2]) / 2 / 1024**3
+        physical_batch_size = main.tune_physical_batch_size(model, self.dataset, 8, memory_budget, cache_path, MagicMock(), n_trials=1)
+        assert physical_batch_size in [1, 2]
+
+        # the cache is read back without probing
+        with patch("main.GradSampleModule", side_effect=AssertionError("probed")):
+            assert main.tune_physical_batch_size(model, self.dataset, 8, memory_budget, cache_path, MagicMock(), n_trials=1) == physical_batch_size
+        with open(cache_path, "r") as f:
+            assert list(json.load(f).values()) == [physical_batch_size]
+
+        # the search stops at the out of memory error
+        compute_loss = main.compute_loss_generator
+        def out_of_memory(target, *args):
+            if len(target) >= 2:
+                raise RuntimeError("CUDA out of memory")
+            return compute_loss(target, *args)
+        with patch("main.compute_loss_generator", side_effect=out_of_memory):
+            assert main.tune_physical_batch_size(model, self.dataset, 8, 1024, tmp_path / "oom.json", MagicMock(), n_trials=1) == 1
+
+    def test_sparse_gradients(self):
+        model = construct_generator("baseline", self.dataset.n_locations, self.dataset.n_time_split+1, self.hidden_dim, self.hidden_dim, self.hidden_dim, False, False, sparse_embedding=True, n_negative_samples=8)
+        optimizer = SparseDenseAdam(model.parameters(), model.sparse_parameters(), 1e-2)
+        initial_state = copy.deepcopy(model.state_dict())
+
+        batch = next(iter(self.data_loader))
+        output_locations, _ = model.scoring_component.sampled_forward(torch.zeros(len(batch["target"]), batch["target"].shape[1], self.hidden_dim), batch["target"])
+        # the target and the negative samples
+        assert output_locations.shape[-1] == 9
+        train_with_discrete_time(model, optimizer, compute_loss_generator, batch["input"], batch["target"], batch["time"], batch["time_target"], batch["reference"], 1, 1)
+
+        # only the rows of the input locations are updated
+        updated_rows = (model.state_dict()["location_encoding_component.embedding_matrix.weight"] != initial_state["location_encoding_component.embedding_matrix.weight"]).any(dim=-1)
+        assert set(torch.nonzero(updated_rows).view(-1).tolist()) == set(batch["input"].view(-1).tolist())
+
+    def test_fused_gru(self):
+        prefix_encoding_component = GRUPrefixEncodingComponent(self.hidden_dim, self.hidden_dim, 1, False)
+        embedding_sequence = torch.randn(4, 5, self.hidden_dim)
+
+        # the fused path is the same as the recurrence of DPGRUCell
+        hidden = torch.zeros(4, self.hidden_dim)
+        expected = []
+        for i in range(5):
+            hidden = prefix_encoding_component.gru_cell(embedding_sequence[:,i,:], hidden)
+            expected.append(hidden)
+        hiddens, _ = prefix_encoding_component(embedding_sequence)
+        assert torch.allclose(hiddens, torch.stack(expected, dim=1), atol=1e-6)
+
+        # the per-sample gradient path is the same as the fused path
+        dp_prefix_encoding_component = GradSampleModule(copy.deepcopy(prefix_encoding_component), loss_reduction="sum")
+        dp_hiddens, _ = dp_prefix_encoding_component(embedding_sequence)
+        dp_hiddens.sum().backward()
+        assert torch.allclose(hiddens, dp_hiddens, atol=1e-6)
+        for param in dp_prefix_encoding_component.parameters():
+            assert torch.allclose(param.grad_sample.sum(dim=0), param.grad, atol=1e-5)
+
+        # conversion between DPGRUCell and nn.GRU
+        gru = dp_gru_cell_to_gru(prefix_encoding_component.gru_cell)
+        assert torch.allclose(gru(embedding_sequence)[0], hiddens, atol=1e-6)
+        gru_cell = gru_to_dp_gru_cell(gru)
+        for param, expected_param in zip(gru_cell.parameters(), prefix_encoding_component.gru_cell.parameters()):
+            assert torch.equal(param, expected_param)
+
     # def test_embedding_position(self):
     #     model = construct_generator("hrnet", self.dataset.n_locations, self.dataset.n_time_split+1, self.hidden_dim, self.hidden_dim, self.hidden_dim, False, False)
     #     embedding_matrix = model.location_encoding_component.make_embedding_matrix(1, "cpu")[0]
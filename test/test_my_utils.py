@@ -3,7 +3,10 @@ import unittest
 # add parent path
 import sys
 sys.path.append('./')
-from my_utils import save, load, set_budget, depth_clustering, plot_density
+from my_utils import save, load, set_budget, depth_clustering, plot_density, DensityPlotWriter, render_densities
+from collections import Counter
+import numpy as np
+import pathlib
 
 class DataPreProcessingTestCase(unittest.TestCase):
     def __init__(self, *args, **kwargs):
@@ -38,5 +41,23 @@ class DataPreProcessingTestCase(unittest.TestCase):
     def test_plot_density(self):
         plot_density([0,1,2,3,4,5,6,7,8], 9, "./test/data/test.png", 6)
 
+    def test_density_plot_writer(self):
+        save_path = pathlib.Path("./test/data/test_densities.npz")
+        plot_writer = DensityPlotWriter(save_path, render=True)
+        plot_writer.add([0,1,2,3,4,5,6,7,8], 9, "list", anotation=6)
+        plot_writer.add(Counter({1: 2, 8: 3}), 9, "counter")
+        future = plot_writer.close()
+
+        with np.load(save_path) as densities:
+            self.assertEqual(densities["list"].tolist(), [0,1,2,3,4,5,6,7,8])
+            self.assertEqual(densities["counter"].tolist(), [0,2,0,0,0,0,0,0,3])
+
+        # the rendering is done in the background process
+        future.result()
+        self.assertTrue((save_path.parent / "list.png").exists())
+        self.assertTrue((save_path.parent / "counter.png").exists())
+        for path in [save_path, save_path.parent / "list.png", save_path.parent / "counter.png"]:
+            path.unlink()
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
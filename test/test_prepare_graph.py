@@ -0,0 +1,52 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+sys.path.append('./')
+import prepare_graph
+
+def make_edge_adj_lines(gdf_edges):
+    # the lines of edge_adj.txt by filtering all the edges for each edge
+    adjss = []
+    for i, row in gdf_edges.iterrows():
+        adjss.append(gdf_edges[gdf_edges["u"] == row["v"]]["fid"].tolist())
+    max_num_adjs = max([len(adjs) for adjs in adjss])
+    return ["," + ",".join([str(adj) for adj in adjs + [-1]*(max_num_adjs-len(adjs))]) for adjs in adjss]
+
+class PrepareGraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.save_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.save_dir)
+
+    def read_edge_adj(self):
+        with open(os.path.join(self.save_dir, "edge_adj.txt"), "r") as f:
+            return f.read().splitlines()
+
+    def test_make_edge_adj_csr(self):
+        rng = np.random.default_rng(0)
+        gdf_edges = pd.DataFrame({"u": rng.integers(0, 20, 100), "v": rng.integers(0, 20, 100), "fid": rng.permutation(100)+1})
+        indptr, indices = prepare_graph.make_edge_adj_csr(gdf_edges)
+        # the successors are in the order of the rows
+        for i, v in enumerate(gdf_edges["v"].tolist()):
+            self.assertEqual(indices[indptr[i]:indptr[i+1]].tolist(), gdf_edges[gdf_edges["u"] == v]["fid"].tolist())
+
+    def test_make_edge_adj_file(self):
+        rng = np.random.default_rng(1)
+        gdf_edges = pd.DataFrame({"u": rng.integers(0, 20, 100), "v": rng.integers(0, 20, 100), "fid": np.arange(100)+1})
+        prepare_graph.make_edge_adj_file(gdf_edges, self.save_dir)
+        self.assertEqual(self.read_edge_adj(), make_edge_adj_lines(gdf_edges))
+        csr = np.load(os.path.join(self.save_dir, "edge_adj.npz"))
+        self.assertEqual(csr["indptr"].tolist(), prepare_graph.make_edge_adj_csr(gdf_edges)[0].tolist())
+
+        # no edge has a successor
+        gdf_edges = pd.DataFrame({"u": [0, 1, 2], "v": [3, 4, 5], "fid": [1, 2, 3]})
+        prepare_graph.make_edge_adj_file(gdf_edges, self.save_dir)
+        self.assertEqual(self.read_edge_adj(), make_edge_adj_lines(gdf_edges))
+        self.assertEqual(self.read_edge_adj(), [","]*3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+import sys
+import sqlite3
+import pathlib
+import shutil
+import os
+import numpy as np
+
+sys.path.append('./')
+import route_store
+import evaluation
+from data_pre_processing import make_reversible_trajs, make_reversible_stay_traj
+
+class RouteStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.n_states = 16
+        self.db_path = pathlib.Path("./test/data/test_route_store_paths.db")
+        self.store_dir = pathlib.Path("./test/data/test_route_store")
+        rng = np.random.default_rng(0)
+        self.routes = {}
+        for _ in range(50):
+            from_state, to_state = rng.choice(self.n_states, 2, replace=False).tolist()
+            self.routes[(from_state, to_state)] = [from_state] + rng.integers(0, self.n_states, rng.integers(0, 4)).tolist() + [to_state]
+        # the direct routes of the adjacent states
+        for state in range(self.n_states-1):
+            self.routes[(state, state+1)] = [state, state+1]
+        # the direct routes of the other pairs, so that any pair of different states is connected
+        for from_state in range(self.n_states):
+            for to_state in range(self.n_states):
+                if from_state != to_state and (from_state, to_state) not in self.routes and rng.random() < 0.5:
+                    self.routes[(from_state, to_state)] = [from_state, to_state]
+
+        with sqlite3.connect(self.db_path) as conn:
+            c = conn.cursor()
+            c.execute("DROP TABLE IF EXISTS state_edge_to_route")
+            c.execute("CREATE TABLE IF NOT EXISTS state_edge_to_route (start_state integer, end_state integer, route text, PRIMARY KEY (start_state, end_state))")
+            c.executemany("INSERT INTO state_edge_to_route VALUES (?, ?, ?)", [(i, j, str(route)) for (i, j), route in self.routes.items()])
+
+    def tearDown(self):
+        self.db_path.unlink()
+        shutil.rmtree(self.store_dir, ignore_errors=True)
+
+    def test_export_route_db(self):
+        store = route_store.export_route_db(self.db_path, self.store_dir)
+        self.assertEqual(store.n_states, self.n_states)
+        self.assertEqual(store.states.dtype, np.int16)
+        for (from_state, to_state), route in self.routes.items():
+            self.assertEqual(store.route(from_state, to_state), route)
+        self.assertIsNone(store.route(0, 0))
+
+        # the batched lookup and the sqlite adapter give the same routes
+        from_states, to_states = np.meshgrid(np.arange(self.n_states), np.arange(self.n_states))
+        from_states, to_states = from_states.reshape(-1), to_states.reshape(-1)
+        routes = store.routes(from_states, to_states)
+        self.assertEqual(routes, [self.routes.get(pair) for pair in zip(from_states.tolist(), to_states.tolist())])
+        sqlite_store = route_store.open_route_store(self.db_path)
+        self.assertEqual(sqlite_store.routes(from_states, to_states), routes)
+        self.assertEqual(store.has_routes(from_states, to_states).tolist(), [route is not None for route in routes])
+        sqlite_store.close()
+
+    def test_is_exported_from(self):
+        self.assertFalse(route_store.is_exported_from(self.store_dir, self.db_path))
+        route_store.export_route_db(self.db_path, self.store_dir)
+        self.assertTrue(route_store.is_exported_from(self.store_dir, self.db_path))
+        # paths.db is rebuilt
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("DELETE FROM state_edge_to_route WHERE start_state=0")
+        os.utime(self.db_path, ns=(0, 0))
+        self.assertFalse(route_store.is_exported_from(self.store_dir, self.db_path))
+
+    def test_consumers(self):
+        route_store.export_route_db(self.db_path, self.store_dir)
+        rng = np.random.default_rng(1)
+        trajs = [rng.integers(0, self.n_states, rng.integers(1, 5)).tolist() for _ in range(100)] + [list(range(self.n_states))]
+        # the route store and paths.db give the same results
+        self.assertEqual(evaluation.compensate_trajs(trajs, self.store_dir), evaluation.compensate_trajs(trajs, self.db_path))
+        self.assertEqual(make_reversible_trajs([list(range(self.n_states))], self.store_dir), make_reversible_trajs([list(range(self.n_states))], self.db_path))
+
+    def test_make_reversible_trajs(self):
+        store = route_store.export_route_db(self.db_path, self.store_dir)
+        rng = np.random.default_rng(2)
+        # the trajectories are concatenations of the routes whose adjacent states are directly connected
+        connected = [route for route in self.routes.values() if all(self.routes.get((a, b)) == [a, b] for a, b in zip(route[:-1], route[1:]))]
+        trajs = []
+        for _ in range(100):
+            traj = list(connected[rng.integers(len(connected))])
+            for _ in range(rng.integers(0, 4)):
+                nexts = [route for route in connected if route[0] == traj[-1]]
+                if len(nexts) > 0:
+                    traj += nexts[rng.integers(len(nexts))][1:]
+            trajs.append(traj)
+        trajs.append([0])
+
+        expected = [make_reversible_stay_traj(traj, store) for traj in trajs]
+        self.assertTrue(any(len(traj) < len(reversible_traj) for traj, reversible_traj in zip(expected, trajs)))
+        self.assertEqual(make_reversible_trajs(trajs, store), expected)
+        self.assertEqual(make_reversible_trajs(trajs, self.db_path), expected)
+        self.assertEqual(make_reversible_trajs([], store), [])
+
+        # the reversible trajectories are compensated to the original ones
+        self.assertEqual(evaluation.compensate_trajs(expected[:-1], store)[0], trajs[:-1])
+
+if __name__ == '__main__':
+    unittest.main()